@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+'''
+The wallet agent - keep one wallet warm behind a local Unix socket
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import base64
+import json
+import os
+import socket
+import socketserver
+from wallet import Record
+
+AGENT_SOCK = os.environ.get('WALLET_AGENT_SOCK', 'dist/agent.sock')
+METHODS = ('search', 'iter_search', 'explain', 'add', 'add_many', 'delete',
+           'delete_many', 'update', 'update_many', 'backup', 'restore',
+           'stats', 'cache_info')
+
+
+def encode(value):
+    '''
+    Encode a value for JSON - bytes are wrapped in base64, and records turned
+    into dicts
+    @param {object} value   the value
+    @return {object}        the value ready for JSON
+    '''
+    if isinstance(value, bytes):
+        return { '__bytes__': base64.b64encode(value).decode() }
+    if isinstance(value, Record):
+        return dict([(k, encode(v)) for k, v in value.items()])
+    if isinstance(value, dict):
+        return dict([(k, encode(v)) for k, v in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    return value
+# def encode(value)
+
+
+def decode(value):
+    '''
+    Decode a value from JSON - the reverse of "encode"
+    @param {object} value   the value from JSON
+    @return {object}        the value
+    '''
+    if isinstance(value, dict):
+        if list(value.keys()) == ['__bytes__']:
+            return base64.b64decode(value['__bytes__'])
+        return dict([(k, decode(v)) for k, v in value.items()])
+    # if isinstance(value, dict)
+    if isinstance(value, list):
+        return [tuple(decode(v)) if isinstance(v, list) else decode(v) \
+                for v in value]
+    return value
+# def decode(value)
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+    '''
+    The handler of a client - one JSON request per line, answered by lines of
+    {"item": ...} for streamed results, then {"result": ...} or {"error": ...}
+    '''
+
+    def send(self, msg):
+        '''
+        Send a message to the client
+        @param {dict}   msg     the message
+        '''
+        self.wfile.write((json.dumps(msg) + '\n').encode())
+    # def send(self, msg)
+
+
+    def handle(self):
+        '''
+        Handle the requests of a client, until it disconnects
+        '''
+        wallet = self.server.wallet
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                method = request.get('method')
+                if method == 'shutdown':
+                    self.send({ 'result': None })
+                    self.server.stopping = True
+                    return
+                # if method == 'shutdown'
+                if method not in METHODS:
+                    self.send({ 'error': 'Unknown method: %s' % method })
+                    continue
+                # if method not in METHODS
+                result = getattr(wallet, method)(*decode(request['args']),
+                                                 **decode(request['kwargs']))
+                if method == 'iter_search':
+                    for item in result:
+                        self.send({ 'item': encode(item) })
+                    # for item in result
+                    result = None
+                # if method == 'iter_search'
+                self.send({ 'result': encode(result) })
+            except Exception as e:
+                self.send({ 'error': '%s: %s' % (type(e).__name__, e) })
+            # try - except Exception as e
+        # for line in self.rfile
+    # def handle(self)
+# class AgentHandler(socketserver.StreamRequestHandler)
+
+
+def serve(wallet, path=AGENT_SOCK):
+    '''
+    Serve the wallet on a Unix socket, one client at a time, until shut down
+    @param {Wallet} wallet  the wallet
+    @param {str}    path    path of the socket
+    '''
+    if os.path.exists(path):
+        if connect(path) is not None:
+            print('Agent already running at %s' % path)
+            return
+        # if connect(path) is not None
+        os.remove(path)         # left over by an agent that died
+    # if os.path.exists(path)
+
+    # Only the owner may talk to the agent
+    umask = os.umask(0o177)
+    server = socketserver.UnixStreamServer(path, AgentHandler)
+    os.umask(umask)
+    server.wallet = wallet
+    server.stopping = False
+    print('Agent listening at %s' % path)
+    try:
+        with wallet:
+            while not server.stopping:
+                server.handle_request()
+            # while not server.stopping
+        # with wallet
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        os.remove(path)
+    # try - except KeyboardInterrupt - finally
+# def serve(wallet, path=AGENT_SOCK)
+
+
+def connect(path=AGENT_SOCK):
+    '''
+    Connect to the agent, if there is one running
+    @param {str}    path    path of the socket
+    @return {RemoteWallet}  the wallet of the agent, or None
+    '''
+    if not os.path.exists(path):
+        return None
+    # if not os.path.exists(path)
+    try:
+        return RemoteWallet(path)
+    except OSError:
+        return None
+    # try - except OSError
+# def connect(path=AGENT_SOCK)
+
+
+class RemoteWallet(object):
+    '''
+    The wallet of an agent, with the same methods as Wallet
+    '''
+
+    def __init__(self, path=AGENT_SOCK):
+        '''
+        Initialize the remote wallet
+        @param {str}    path    path of the socket of the agent
+        '''
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+    # def __init__(self, path=AGENT_SOCK)
+
+
+    def call(self, method, args=(), kwargs=None):
+        '''
+        Call a method of the agent's wallet
+        @param {str}    method  name of the method
+        @param {list}   args    positional arguments
+        @param {dict}   kwargs  keyword arguments
+        @return {generator}     streamed items, if any, then the result
+        '''
+        self.sock.sendall((json.dumps({
+            'method':   method,
+            'args':     encode(list(args)),
+            'kwargs':   encode(kwargs or {}),
+        }) + '\n').encode()) # self.sock.sendall( ... )
+        for line in self.rfile:
+            msg = json.loads(line.decode())
+            if 'item' in msg:
+                yield decode(msg['item'])
+            elif 'error' in msg:
+                raise RuntimeError(msg['error'])
+            else:
+                yield decode(msg['result'])
+                return
+            # else - if ... elif
+        # for line in self.rfile
+        raise RuntimeError('Agent disconnected')
+    # def call(self, method, args=(), kwargs=None)
+
+
+    def __getattr__(self, name):
+        '''
+        Forward the methods of Wallet to the agent
+        @param {str}    name    name of the method
+        @return {function}      the method
+        '''
+        if name not in METHODS or name == 'iter_search':
+            raise AttributeError(name)
+        # if name not in METHODS or name == 'iter_search'
+        return lambda *args, **kwargs: next(self.call(name, args, kwargs))
+    # def __getattr__(self, name)
+
+
+    def iter_search(self, *args, **kwargs):
+        '''
+        Stream the records from the agent, see Wallet.iter_search
+        @return {generator}     the target passwords, one by one
+        '''
+        for item in self.call('iter_search', args, kwargs):
+            if item is None:    # the final result
+                return
+            # if item is None
+            yield item
+        # for item in self.call('iter_search', args, kwargs)
+    # def iter_search(self, *args, **kwargs)
+
+
+    def shutdown(self):
+        '''
+        Shut the agent down
+        '''
+        next(self.call('shutdown'))
+        self.close()
+    # def shutdown(self)
+
+
+    def close(self):
+        '''
+        Disconnect from the agent
+        '''
+        self.rfile.close()
+        self.sock.close()
+    # def close(self)
+
+
+    def __enter__(self):
+        '''
+        Enter the context
+        @return {RemoteWallet}  the remote wallet itself
+        '''
+        return self
+    # def __enter__(self)
+
+
+    def __exit__(self, *args):
+        '''
+        Exit the context - disconnect from the agent
+        @param {list}   args    the exception info, to be ignored
+        '''
+        self.close()
+    # def __exit__(self, *args)
+# class RemoteWallet(object)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+'''
+The asyncio front end of the wallet
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from wallet import Wallet, cipher_chunk
+
+
+class AsyncWallet(object):
+    '''
+    The asyncio wallet class - the wallet lives on a thread of its own, where
+    all the SQLite work runs one call at a time, while passwords found are
+    decrypted on a process pool, off both that thread and the event loop
+    '''
+    LIMIT = 16          # calls in flight at once, by default
+
+    def __init__(self, key, db_name='data', table_name='data', workers=None,
+                 limit=None, **kwargs):
+        '''
+        Initialize the wallet - it is opened on first use
+        @param {str}    key         key to unlock the wallet
+        @param {str}    db_name     name of the database
+        @param {str}    table_name  name of the table
+        @param {int}    workers     size of the process pool for decryption,
+                                    shared with the wallet for its batch cipher
+                                    work, default to the number of CPU cores
+        @param {int}    limit       calls in flight at once, beyond which they
+                                    wait for their turn
+        @param {dict}   kwargs      other arguments of Wallet
+        '''
+        self.key = key
+        self.args = (key, db_name, table_name, )
+        self.kwargs = kwargs
+        self.workers = workers or os.cpu_count() or 1
+        self.limit = limit or self.LIMIT
+        self.slots = None   # created within the event loop
+        self.wallet = None
+        self.thread = ThreadPoolExecutor(max_workers=1)
+        self.pool = None
+        self.lock = threading.Lock()    # the pool is started from either thread
+        self.streams = set()    # of iter_search, closed along with the wallet
+    # def __init__(self, key, db_name='data', ..., limit=None, **kwargs)
+
+
+    async def run(self, func, *args, **kwargs):
+        '''
+        Run a function on the thread of the wallet. Once cancelled, it does not
+        run at all if it has not started yet, and its result is dropped if it
+        has
+        @param {function}   func    the function, taking the wallet first
+        @param {list}       args    positional arguments
+        @param {dict}       kwargs  keyword arguments
+        @return {object}            the result of the function
+        '''
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.limit)
+        # if self.slots is None
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.thread, functools.partial(self.call, func, *args,
+                                               **kwargs))
+        # async with self.slots
+    # async def run(self, func, *args, **kwargs)
+
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call a function with the wallet, opening it first if not yet - only on
+        the thread of the wallet
+        @param {function}   func    the function, taking the wallet first
+        @param {list}       args    positional arguments
+        @param {dict}       kwargs  keyword arguments
+        @return {object}            the result of the function
+        '''
+        if self.wallet is None:
+            wallet = Wallet(*self.args, workers=self.workers, **self.kwargs)
+            if self.workers > 1:    # one process pool for both, not one each
+                wallet.pool = self.process_pool()
+            # if self.workers > 1
+            self.wallet = wallet
+        # if self.wallet is None
+        return func(self.wallet, *args, **kwargs)
+    # def call(self, func, *args, **kwargs)
+
+
+    def process_pool(self):
+        '''
+        Get the process pool, shared with the wallet - created on first use,
+        and starting its processes on first work
+        @return {ProcessPoolExecutor}   the process pool
+        '''
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(self.workers)
+            # if self.pool is None
+            return self.pool
+        # with self.lock
+    # def process_pool(self)
+
+
+    async def map_cipher(self, method, items):
+        '''
+        Run a batch method of the cipher over the items, split into chunks
+        across the process pool when there are enough of them, otherwise by
+        the cipher of the wallet, on its thread
+        @param {str}    method  name of the batch method, e.g. "decrypt_many"
+        @param {list}   items   the items
+        @return {list}          the results, in the same order as the items
+        '''
+        if self.workers <= 1 or len(items) < Wallet.PARALLEL_MIN:
+            return await self.run(lambda w: getattr(w.cipher, method)(items))
+        # if self.workers <= 1 or len(items) < Wallet.PARALLEL_MIN
+        loop = asyncio.get_running_loop()
+        pool = self.process_pool()
+        size = -(-len(items) // self.workers)
+        results = []
+        for chunk in await asyncio.gather(*[
+                loop.run_in_executor(pool, cipher_chunk, self.key, method,
+                                     items[i:i+size]) \
+                for i in range(0, len(items), size)]):
+            results += chunk
+        # for chunk in await asyncio.gather( ... )
+        return results
+    # async def map_cipher(self, method, items)
+
+
+    async def iter_search(self, pattern=None, show=False, batch_size=None,
+                          fields=None):
+        '''
+        Stream all password matching the filter regex pattern, batch by batch.
+        If show, then yield decrypted "pwd" field
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {int}    batch_size  number of rows to fetch and decrypt at once
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {generator}         the target passwords, one by one, as
+                                    Records
+        '''
+        # Batches are read on the thread of the wallet, with the passwords
+        # cached filled in, and the others decrypted on the process pool
+        batches = await self.run(Wallet.iter_batches, pattern, show,
+                                 batch_size or Wallet.BATCH_SIZE, fields)
+        self.streams.add(batches)
+        try:
+            while True:
+                batch = await self.run(lambda w: next(batches, None))
+                if batch is None:
+                    break
+                # if batch is None
+                results, misses = batch
+                if misses:
+                    pwds = await self.map_cipher('decrypt_many',
+                                                 [r['pwd'] for r in misses])
+                    await self.run(Wallet.remember, misses, pwds)
+                # if misses
+                for record in results:
+                    yield record
+                # for record in results
+            # while True
+        finally:    # not awaited, so that it is done even when cancelled -
+                    # unless closed already along with the wallet
+            if batches in self.streams:
+                self.streams.discard(batches)
+                self.thread.submit(batches.close)
+            # if batches in self.streams
+        # try - finally
+    # async def iter_search(self, pattern=None, show=False, ..., fields=None)
+
+
+    async def search(self, pattern=None, show=False, fields=None):
+        '''
+        Find all password matching the filter regex pattern
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {list}              the list of target passwords, as Records
+        '''
+        return [record async for record in \
+                self.iter_search(pattern, show, Wallet.SEARCH_BATCH, fields)]
+    # async def search(self, pattern=None, show=False, fields=None)
+
+
+    async def explain(self, *args, **kwargs):
+        '''
+        Explain how the records matching the pattern are found, see Wallet
+        '''
+        return await self.run(Wallet.explain, *args, **kwargs)
+    # async def explain(self, *args, **kwargs)
+
+
+    async def add(self, *args, **kwargs):
+        '''
+        Add a new password, see Wallet
+        '''
+        return await self.run(Wallet.add, *args, **kwargs)
+    # async def add(self, *args, **kwargs)
+
+
+    async def add_many(self, *args, **kwargs):
+        '''
+        Add new passwords in bulk, see Wallet
+        '''
+        return await self.run(Wallet.add_many, *args, **kwargs)
+    # async def add_many(self, *args, **kwargs)
+
+
+    async def delete(self, *args, **kwargs):
+        '''
+        Delete a password, see Wallet
+        '''
+        return await self.run(Wallet.delete, *args, **kwargs)
+    # async def delete(self, *args, **kwargs)
+
+
+    async def delete_many(self, *args, **kwargs):
+        '''
+        Delete passwords in bulk, see Wallet
+        '''
+        return await self.run(Wallet.delete_many, *args, **kwargs)
+    # async def delete_many(self, *args, **kwargs)
+
+
+    async def update(self, *args, **kwargs):
+        '''
+        Update a password, see Wallet
+        '''
+        return await self.run(Wallet.update, *args, **kwargs)
+    # async def update(self, *args, **kwargs)
+
+
+    async def update_many(self, *args, **kwargs):
+        '''
+        Update passwords in bulk, see Wallet
+        '''
+        return await self.run(Wallet.update_many, *args, **kwargs)
+    # async def update_many(self, *args, **kwargs)
+
+
+    async def close(self):
+        '''
+        Close the streams still open and the wallet, on its thread, then shut
+        down the thread and the process pool
+        '''
+        streams = list(self.streams)
+        self.streams.clear()
+        def close_all(wallet):
+            for stream in streams:
+                stream.close()
+            # for stream in streams
+            wallet.close()
+        # def close_all(wallet)
+        if self.wallet is not None:
+            await self.run(close_all)
+            self.wallet = None
+        # if self.wallet is not None
+        self.thread.shutdown(wait=False)
+        with self.lock:     # shut down by the wallet as well, if opened
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+            # if self.pool is not None
+        # with self.lock
+    # async def close(self)
+
+
+    async def __aenter__(self):
+        '''
+        Enter the context
+        @return {AsyncWallet}       the wallet itself
+        '''
+        return self
+    # async def __aenter__(self)
+
+
+    async def __aexit__(self, *args):
+        '''
+        Exit the context - close the wallet
+        @param {list}   args        the exception info, to be ignored
+        '''
+        await self.close()
+    # async def __aexit__(self, *args)
+
+
+    def __str__(self):
+        '''
+        To string
+        @returns {str}      the string format of the class
+        '''
+        return 'AsyncWallet<key="%s", target="%s">' % \
+               (self.key, 'dist/%s.%s' % self.args[1:])
+    # def __str__(self)
+# class AsyncWallet(object)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the cipher - the batched salting engine against the previous one,
+with the compact format, which passwords are now saved in, alongside
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import os
+import random
+import sys
+import timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Crypto.Cipher import AES
+from encryption import Cipher
+
+
+def legacy_encrypt(cipher, msg):
+    '''
+    The previous encryption, which salts by inserting one byte at a time
+    @param {Cipher} cipher  the cipher
+    @param {str}    msg     the message to be encrypted
+    @returns {bytes}        the encrypted bytes
+    '''
+    msg = list(msg.encode())
+    dummy = [d for d in cipher.DUMMY if d not in msg]
+    while len(msg) + len(cipher.QUOTE) + len(dummy) < cipher.DATA_LENGTH:
+        msg.insert(random.randint(0, len(msg)), random.choice(dummy))
+    # while len(msg) + len(cipher.QUOTE) + len(dummy) < cipher.DATA_LENGTH
+    msg = bytes(msg + list(cipher.QUOTE) + dummy)
+    key = cipher.key.encode()
+    while len(key) < cipher.KEY_LENGTH:
+        key += key
+    # while len(key) < cipher.KEY_LENGTH
+    return AES.new(key[:cipher.KEY_LENGTH], cipher.mode, cipher.iv).encrypt(msg)
+# def legacy_encrypt(cipher, msg)
+
+
+def legacy_decrypt(cipher, data):
+    '''
+    The previous decryption, which unsalts with a Python-level loop
+    @param {Cipher} cipher  the cipher
+    @param {bytes}  data    the encrypted bytes
+    @returns {str}          the decrypted message
+    '''
+    key = cipher.key.encode()
+    while len(key) < cipher.KEY_LENGTH:
+        key += key
+    # while len(key) < cipher.KEY_LENGTH
+    data = AES.new(key[:cipher.KEY_LENGTH], cipher.mode, cipher.iv).decrypt(data)
+    fields = data.split(cipher.QUOTE)
+    data, dummy = cipher.QUOTE.join(fields[:-1]), fields[-1]
+    return bytes([d for d in data if d not in dummy]).decode()
+# def legacy_decrypt(cipher, data)
+
+
+def main():
+    '''
+    The main entry
+    '''
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cipher = Cipher('benchmark key')
+    msgs = ['password-%06d' % i for i in range(count)]
+    raws = [m.encode() for m in msgs]
+    blobs = cipher.encrypt_many(msgs)
+    salted_blobs = [cipher.encrypt_salted(r) for r in raws]
+    legacy_blobs = [legacy_encrypt(cipher, m) for m in msgs]
+
+    # The salting engine against the previous one, then the compact format -
+    # "encrypt" and "decrypt" of Cipher write and read the compact one
+    timings = [
+        ('legacy encrypt',          lambda: [legacy_encrypt(cipher, m) \
+                                             for m in msgs]),
+        ('salted encrypt',          lambda: [cipher.encrypt_salted(r) \
+                                             for r in raws]),
+        ('compact encrypt',         lambda: [cipher.encrypt(m) for m in msgs]),
+        ('compact encrypt_many',    lambda: cipher.encrypt_many(msgs)),
+        ('legacy decrypt',          lambda: [legacy_decrypt(cipher, b) \
+                                             for b in legacy_blobs]),
+        ('salted decrypt',          lambda: [cipher.decrypt(b) \
+                                             for b in salted_blobs]),
+        ('compact decrypt',         lambda: [cipher.decrypt(b) for b in blobs]),
+        ('compact decrypt_many',    lambda: cipher.decrypt_many(blobs)),
+    ] # timings = [ ... ]
+    base = None
+    for name, func in timings:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        base = seconds if name.startswith('legacy') else base
+        print('%-20s %6d msgs  %8.3f s  %8.1f us/msg  x%.1f' % \
+              (name, count, seconds, seconds / count * 1e6, base / seconds))
+    # for name, func in timings
+
+    # Sanity check - all paths decrypt to the same messages, in either format
+    for enc in [legacy_encrypt(cipher, msgs[0]), cipher.encrypt(msgs[0]),
+                cipher.encrypt_many(msgs[:1])[0],
+                cipher.encrypt_salted(raws[0])]:
+        assert cipher.decrypt(enc) == msgs[0]
+    # for enc in [ ... ]
+    assert legacy_decrypt(cipher, legacy_blobs[0]) == msgs[0]
+    assert legacy_decrypt(cipher, salted_blobs[0]) == msgs[0]
+    assert cipher.decrypt_many(blobs) == cipher.decrypt_many(legacy_blobs) == \
+           cipher.decrypt_many(salted_blobs) == msgs
+# def main()
+
+
+if __name__ == '__main__':
+    main()
+# if __name__ == '__main__'
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+Load generator of the wallet service - throughput and latency percentiles
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from wallet import Wallet
+
+KEY = 'benchmark key'
+PORT = 8766
+
+
+def client(args):
+    '''
+    Send requests from one client over a kept-alive connection
+    @param {tuple}  args    (port, token, requests, batch, mix, size, seed)
+    @return {list}          latencies of the HTTP requests, in seconds
+    '''
+    port, token, requests, batch, mix, size, seed = args
+    rand = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = { 'Authorization': 'Bearer %s' % token,
+                'Content-Type': 'application/json' }
+    latencies = []
+    for n in range(requests):
+        calls = []
+        for i in range(batch):
+            k = rand.randrange(size)
+            if rand.random() < mix:
+                calls.append({ 'jsonrpc': '2.0', 'id': i, 'method': 'find',
+                               'params': [{ 'name': '^user-%06d$' % k }, True] })
+            else:
+                calls.append({ 'jsonrpc': '2.0', 'id': i, 'method': 'add',
+                               'params': ['password', 'load-%d-%d' % (seed, n),
+                                          'site-%03d' % (k % 997)] })
+            # else - if rand.random() < mix
+        # for i in range(batch)
+        body = json.dumps(calls if batch > 1 else calls[0]).encode()
+        start = time.perf_counter()
+        conn.request('POST', '/', body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        latencies.append(time.perf_counter() - start)
+        assert response.status == 200, response.status
+        results = json.loads(data.decode())
+        results = results if batch > 1 else [results]
+        assert all('result' in r for r in results), results
+    # for n in range(requests)
+    conn.close()
+    return latencies
+# def client(args)
+
+
+def percentile(values, p):
+    '''
+    The percentile of the values
+    @param {list}   values  the sorted values
+    @param {float}  p       the percentile, 0 - 100
+    @return {float}         the value at the percentile
+    '''
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+# def percentile(values, p)
+
+
+def main():
+    '''
+    The main entry
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--size', type=int, default=10000,
+                        help='number of records in the synthetic wallet')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='number of client processes')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='HTTP requests per client')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='JSON-RPC calls per HTTP request')
+    parser.add_argument('--mix', type=float, default=0.9,
+                        help='ratio of finds among the calls, adds otherwise')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of worker threads of the service')
+    args = parser.parse_args()
+
+    # Serve a synthetic wallet from a scratch folder
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='load_')
+    os.chdir(folder)
+    proc = None
+    try:
+        wallet = Wallet(KEY)
+        wallet.add_many([('password-%06d' % i, 'user-%06d' % i,
+                          'site-%03d' % (i % 997)) for i in range(args.size)])
+        wallet.close()
+        f = open(os.path.join('dist', 'key.log'), 'w')
+        f.write(KEY + '\n')
+        f.close()
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'shell.py'),
+                                 'serve', str(PORT), str(args.workers)],
+                                stdout=subprocess.DEVNULL)
+        token_file = os.path.join('dist', 'serve.token')
+        while not os.path.exists(token_file) or os.path.getsize(token_file) == 0:
+            time.sleep(0.05)
+        # while not os.path.exists(token_file) or ...
+        f = open(token_file, 'r')
+        token = f.read().strip()
+        f.close()
+
+        # Run the clients
+        start = time.perf_counter()
+        pool = multiprocessing.Pool(args.clients)
+        latencies = sorted(sum(pool.map(client, [
+            (PORT, token, args.requests, args.batch, args.mix, args.size, i) \
+            for i in range(args.clients)]), []))
+        seconds = time.perf_counter() - start
+        pool.close()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        # if proc is not None
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    # try - finally
+
+    calls = len(latencies) * args.batch
+    print('%d clients x %d requests x %d calls, %d workers' % \
+          (args.clients, args.requests, args.batch, args.workers))
+    print('throughput:  %10.1f requests/s  %10.1f calls/s' % \
+          (len(latencies) / seconds, calls / seconds))
+    print('latency:     p50 %.2f ms  p99 %.2f ms  max %.2f ms' % \
+          (percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+           latencies[-1] * 1e3))
+# def main()
+
+
+if __name__ == '__main__':
+    main()
+# if __name__ == '__main__'
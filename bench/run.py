@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark suite of the hot paths of Cipher and Wallet
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from encryption import Cipher
+from wallet import Wallet
+
+SIZES = [1000, 10000, 100000]
+OPS = 100           # operations per timing of the single-record methods
+REPEAT = 3          # best of this many rounds for each timing
+THRESHOLD = 1.25    # slower than the baseline by this ratio is a regression
+KEY = 'benchmark key'
+
+
+def timing(func, repeat=REPEAT):
+    '''
+    Time a function, best of a few rounds
+    @param {function}   func    the function to be timed
+    @param {int}        repeat  number of rounds
+    @return {float}             the best time in seconds
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    # for _ in range(repeat)
+    return best
+# def timing(func, repeat=REPEAT)
+
+
+def bench_cipher(results):
+    '''
+    Time the cipher, per message - in the compact format, which "encrypt"
+    writes, and in the salted one, named apart so that neither is compared
+    against a baseline of the other
+    @param {dict}   results     the results to be filled in
+    '''
+    cipher = Cipher(KEY)
+    msgs = ['password-%06d' % i for i in range(OPS)]
+    raws = [m.encode() for m in msgs]
+    blobs = cipher.encrypt_many(msgs)
+    salted = [cipher.encrypt_salted(r) for r in raws]
+    results['cipher/compact_encrypt'] = \
+        timing(lambda: [cipher.encrypt(m) for m in msgs]) / OPS
+    results['cipher/compact_decrypt'] = \
+        timing(lambda: [cipher.decrypt(b) for b in blobs]) / OPS
+    results['cipher/compact_encrypt_many'] = \
+        timing(lambda: cipher.encrypt_many(msgs)) / OPS
+    results['cipher/compact_decrypt_many'] = \
+        timing(lambda: cipher.decrypt_many(blobs)) / OPS
+    results['cipher/salted_encrypt'] = \
+        timing(lambda: [cipher.encrypt_salted(r) for r in raws]) / OPS
+    results['cipher/salted_decrypt'] = \
+        timing(lambda: cipher.decrypt_many(salted)) / OPS
+# def bench_cipher(results)
+
+
+def bench_wallet(results, size, workers):
+    '''
+    Time the wallet on a synthetic wallet of "size" records. Single-record
+    methods are timed per operation, searches per query
+    @param {dict}   results     the results to be filled in
+    @param {int}    size        number of records in the wallet
+    @param {int}    workers     size of the process pool of the wallet
+    '''
+    prefix = 'wallet/%d/' % size
+    wallet = Wallet(KEY, 'bench_%d' % size, workers=workers)
+    start = time.perf_counter()
+    wallet.add_many([('password-%06d' % i, 'user-%06d' % i, 'site-%03d' % \
+                      (i % 997), 'record %d' % i) for i in range(size)])
+    results[prefix + 'add_many'] = time.perf_counter() - start
+
+    # Single-record methods - each round works on records of its own
+    rounds = iter(range(REPEAT * 2))
+    def add():
+        r = next(rounds)
+        for i in range(OPS):
+            wallet.add('password', 'new-%d-%d' % (r, i), 'bench')
+        # for i in range(OPS)
+    # def add()
+    results[prefix + 'add'] = timing(add) / OPS
+    ids = iter(range(1, size + 1, max(size // (OPS * REPEAT * 2), 1)))
+    results[prefix + 'update'] = timing(lambda: [
+        wallet.update(next(ids), pwd='new password') for _ in range(OPS)
+    ]) / OPS # results[prefix + 'update'] = timing( ... ) / OPS
+    results[prefix + 'delete'] = timing(lambda: [
+        wallet.delete(next(ids)) for _ in range(OPS)
+    ]) / OPS # results[prefix + 'delete'] = timing( ... ) / OPS
+
+    # Searches - all, by regex, by literal prefix, by exact name
+    patterns = [
+        ('all',     None),
+        ('regex',   { 'name': r'user-\d+7$' }),
+        ('prefix',  { 'name': r'^user-0001' }),
+        ('exact',   { 'name': r'^user-000123$', 'site': r'^site-123$' }),
+    ] # patterns = [ ... ]
+    for name, pattern in patterns:
+        for show in (False, True):
+            results[prefix + 'search/%s%s' % (name, '/show' if show else '')] = \
+                timing(lambda: wallet.search(pattern, show))
+        # for show in (False, True)
+    # for name, pattern in patterns
+    results[prefix + 'search/all/fields'] = \
+        timing(lambda: wallet.search(None, False, ('name', 'site')))
+    wallet.close()
+# def bench_wallet(results, size, workers)
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare the results against the baseline
+    @param {dict}   results     the results
+    @param {dict}   baseline    the baseline results
+    @param {float}  threshold   the ratio beyond which it is a regression
+    @return {list}              the regressions, (name, baseline, result)
+    '''
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print('%-40s %12.6f s' % (name, seconds))
+            continue
+        # if base is None
+        ratio = seconds / base if base else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append((name, base, seconds, ))
+            flag = '  REGRESSION'
+        # if ratio > threshold
+        print('%-40s %12.6f s  x%.2f%s' % (name, seconds, ratio, flag))
+    # for name, seconds in sorted(results.items())
+    return regressions
+# def compare(results, baseline, threshold)
+
+
+def main():
+    '''
+    The main entry
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated sizes of the synthetic wallets')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='size of the process pool of the wallet')
+    parser.add_argument('--output', default='bench_output.json',
+                        help='file to write the results to, as JSON')
+    parser.add_argument('--baseline', default=None,
+                        help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown ratio to flag as a regression')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    output = os.path.abspath(args.output)
+    baseline = {}
+    if args.baseline:
+        f = open(args.baseline, 'r')
+        baseline = json.load(f)['results']
+        f.close()
+    # if args.baseline
+
+    # Run in a scratch folder, as the wallet works under "dist"
+    results = {}
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='bench_')
+    os.chdir(folder)
+    try:
+        bench_cipher(results)
+        for size in sizes:
+            bench_wallet(results, size, args.workers)
+        # for size in sizes
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    # try - finally
+
+    # Save and compare the results
+    f = open(output, 'w')
+    json.dump({
+        'meta': {
+            'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'cpus':     os.cpu_count(),
+            'sizes':    sizes,
+        },
+        'results':  results,
+    }, f, indent=4, sort_keys=True) # json.dump({ ... })
+    f.close()
+    regressions = compare(results, baseline, args.threshold)
+    print('Results written to %s' % output)
+    if regressions:
+        print('%d regression(s) against %s' % (len(regressions), args.baseline))
+        sys.exit(1)
+    # if regressions
+# def main()
+
+
+if __name__ == '__main__':
+    main()
+# if __name__ == '__main__'
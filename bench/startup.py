@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+Startup benchmark of the shell - import time of each command, by -X importtime
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from wallet import Wallet
+
+KEY = 'benchmark key'
+SIZE = 100
+REPEAT = 5          # median of this many runs of each command
+# The commands: (label, arguments, budget of the import time in milliseconds,
+# modules that must not be imported at all)
+COMMANDS = [
+    ('help',        [],                                       40,
+     ('Crypto', 'json', 'http', 'socketserver', 'concurrent')),
+    ('find',        ['find', 'name=^user-000001$', 'False'],  40,
+     ('Crypto', 'http', 'socketserver', 'concurrent')),
+    ('find True',   ['find', 'name=^user-000001$', 'True'],   80,
+     ('http', 'socketserver', 'concurrent')),
+    ('explain',     ['explain', 'name=^user-000001$'],        40,
+     ('Crypto', 'json', 'http', 'socketserver', 'concurrent')),
+]
+
+
+def run(args):
+    '''
+    Run the shell once, with the import times reported
+    @param {list}   args    arguments of the shell
+    @return {tuple}         (wall time in seconds, import time in seconds,
+                            names of all the modules imported)
+    '''
+    # With the bytecode cached, as it is once installed
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime',
+                           os.path.join(ROOT, 'shell.py')] + args, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    seconds = time.perf_counter() - start
+
+    # Lines of "import time: self [us] | cumulative | package", nested ones
+    # indented - the top level ones add up to the total
+    total = 0
+    modules = set()
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # if not line.startswith('import time:') or ...
+        _, cumulative, name = line.split('|')
+        modules.add(name.strip())
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+        # if not name[1:].startswith(' ')
+    # for line in proc.stderr.decode().splitlines()
+    return (seconds, total / 1e6, modules, )
+# def run(args)
+
+
+def main():
+    '''
+    The main entry
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--repeat', type=int, default=REPEAT,
+                        help='runs of each command, the median reported')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale of the budgets, for slower machines')
+    args = parser.parse_args()
+
+    # Run in a scratch folder, as the wallet works under "dist"
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='startup_')
+    os.chdir(folder)
+    results = []
+    try:
+        wallet = Wallet(KEY)
+        wallet.add_many([('password-%06d' % i, 'user-%06d' % i, 'site') \
+                         for i in range(SIZE)])
+        wallet.close()
+        f = open(os.path.join('dist', 'key.log'), 'w')
+        f.write(KEY + '\n')
+        f.close()
+        run([])     # warm up, with the bytecode written
+        for label, cmd, budget, banned in COMMANDS:
+            runs = [run(cmd) for _ in range(args.repeat)]
+            wall = sorted([r[0] for r in runs])[len(runs) // 2]
+            imports = sorted([r[1] for r in runs])[len(runs) // 2]
+            found = sorted(set([m for m in runs[0][2] \
+                                if m.split('.')[0] in banned]))
+            results.append((label, wall, imports, budget * args.scale / 1e3,
+                            found, ))
+        # for label, cmd, budget, banned in COMMANDS
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    # try - finally
+
+    print('%-12s %10s %10s %10s' % ('command', 'wall', 'imports', 'budget'))
+    failed = False
+    for label, wall, imports, budget, found in results:
+        over = imports > budget or found
+        failed = failed or over
+        print('%-12s %7.1f ms %7.1f ms %7.1f ms  %s' % \
+              (label, wall * 1e3, imports * 1e3, budget * 1e3,
+               'FAIL' if over else 'ok'))
+        if found:
+            print('    should not import: %s' % ', '.join(found))
+        # if found
+    # for label, wall, imports, budget, found in results
+    if failed:
+        sys.exit(1)
+    # if failed
+# def main()
+
+
+if __name__ == '__main__':
+    main()
+# if __name__ == '__main__'
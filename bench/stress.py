@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+'''
+Stress test of concurrent access - reader and writer processes on one wallet
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import argparse
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from wallet import Wallet
+
+KEY = 'benchmark key'
+SITE = 'stress'
+
+
+def writer(args):
+    '''
+    Add records of its own, a group of them per commit
+    @param {tuple}  args    (index, writes, group, concurrent)
+    @return {tuple}         (names added, errors)
+    '''
+    index, writes, group, concurrent = args
+    wallet = Wallet(KEY, concurrent=concurrent)
+    added = []
+    errors = 0
+    for start in range(0, writes, group):
+        names = ['w%d-%d' % (index, n) for n in \
+                 range(start, min(start + group, writes))]
+        try:
+            with wallet.group():
+                for name in names:
+                    wallet.add('pwd-%s' % name, name, SITE)
+                # for name in names
+            # with wallet.group()
+            added += names
+        except sqlite3.OperationalError:
+            errors += 1
+        # try - except sqlite3.OperationalError
+    # for start in range(0, writes, group)
+    wallet.close()
+    return (added, errors, )
+# def writer(args)
+
+
+def reader(args):
+    '''
+    Search and decrypt all the records written, until the writers are done
+    @param {tuple}  args    (done, concurrent) - the event set once done
+    @return {tuple}         (reads, errors, wrong) - wrong if a password does
+                            not match its name, or fewer records than before
+    '''
+    done, concurrent = args
+    wallet = Wallet(KEY, concurrent=concurrent)
+    reads = 0
+    errors = 0
+    wrong = 0
+    last = 0
+    while not done.is_set():
+        try:
+            records = wallet.search({ 'site': '^%s$' % SITE }, True)
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        # try - except sqlite3.OperationalError
+        reads += 1
+        wrong += sum([r['pwd'] != 'pwd-%s' % r['name'] for r in records])
+        wrong += len(records) < last
+        last = len(records)
+    # while not done.is_set()
+    wallet.close()
+    return (reads, errors, wrong, )
+# def reader(args)
+
+
+def main():
+    '''
+    The main entry
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--readers', type=int, default=4,
+                        help='number of reader processes')
+    parser.add_argument('--writers', type=int, default=4,
+                        help='number of writer processes')
+    parser.add_argument('--writes', type=int, default=200,
+                        help='records added by each writer')
+    parser.add_argument('--group', type=int, default=10,
+                        help='records added per commit')
+    parser.add_argument('--legacy', action='store_true',
+                        help='without the concurrent mode, for comparison')
+    args = parser.parse_args()
+    concurrent = not args.legacy
+
+    # Run in a scratch folder, as the wallet works under "dist"
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp(prefix='stress_')
+    os.chdir(folder)
+    try:
+        Wallet(KEY, concurrent=concurrent).close()
+        manager = multiprocessing.Manager()
+        done = manager.Event()
+        pool = multiprocessing.Pool(args.readers + args.writers)
+        start = time.perf_counter()
+        readers = pool.map_async(reader, [(done, concurrent, )] * args.readers)
+        writers = pool.map(writer, [(i, args.writes, args.group, concurrent, ) \
+                                    for i in range(args.writers)])
+        seconds = time.perf_counter() - start
+        done.set()
+        readers = readers.get()
+        pool.close()
+
+        # Check every record added is there, and nothing else
+        wallet = Wallet(KEY, concurrent=concurrent)
+        found = dict([(r['name'], r['pwd']) for r in \
+                      wallet.search({ 'site': '^%s$' % SITE }, True)])
+        wallet.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
+    # try - finally
+
+    added = sum([w[0] for w in writers], [])
+    correct = sorted(found) == sorted(added) and \
+              all([found[name] == 'pwd-%s' % name for name in added]) and \
+              sum([r[2] for r in readers]) == 0
+    reads = sum([r[0] for r in readers])
+    print('%d readers, %d writers x %d writes, %d per commit, %s mode' % \
+          (args.readers, args.writers, args.writes, args.group,
+           'legacy' if args.legacy else 'concurrent'))
+    print('writes:  %6d in %.2f s  %10.1f /s  %d errors' % \
+          (len(added), seconds, len(added) / seconds,
+           sum([w[1] for w in writers])))
+    print('reads:   %6d in %.2f s  %10.1f /s  %d errors' % \
+          (reads, seconds, reads / seconds, sum([r[1] for r in readers])))
+    print('correct: %s' % correct)
+    if not correct:
+        sys.exit(1)
+    # if not correct
+# def main()
+
+
+if __name__ == '__main__':
+    main()
+# if __name__ == '__main__'
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+Cache of decrypted passwords
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import time
+from collections import OrderedDict, deque
+
+
+class PlainCache(object):
+    '''
+    The LRU cache of decrypted passwords, keyed by record id and the encrypted
+    password as saved - encrypted with a random nonce (or salt) every time it
+    is written, so that an entry is never served for a record changed since,
+    even by another process in the same second, or for another record taking
+    its id - with entries expiring after a TTL. The plaintext is kept in bytearrays, to
+    be zeroed once evicted, invalidated or cleared, or once expired - as soon
+    as the cache is used next, or swept by "sweep"
+    '''
+
+    def __init__(self, size=256, ttl=300.0):
+        '''
+        Initialize the cache
+        @param {int}    size    maximum number of entries
+        @param {float}  ttl     seconds for an entry to live
+        '''
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()    # id -> (enc, expiry, bytearray)
+        self.expiries = deque()         # (expiry, id), the earliest first
+        self.hits = 0
+        self.misses = 0
+    # def __init__(self, size=256, ttl=300.0)
+
+
+    def wipe(self, id):
+        '''
+        Remove an entry, zeroing its plaintext
+        @param {int}    id      id of the record
+        '''
+        entry = self.entries.pop(id, None)
+        if entry is not None:
+            plain = entry[2]
+            plain[:] = bytes(len(plain))
+        # if entry is not None
+    # def wipe(self, id)
+
+
+    def get(self, id, enc):
+        '''
+        Get the decrypted password of a record
+        @param {int}    id      id of the record
+        @param {bytes}  enc     the encrypted password of the record
+        @return {str}           the password, or None if not cached
+        '''
+        self.sweep()
+        entry = self.entries.get(id)
+        if entry is not None and \
+           (entry[0] != enc or entry[1] <= time.monotonic()):
+            self.wipe(id)       # stale or expired
+            entry = None
+        # if entry is not None and ...
+        if entry is None:
+            self.misses += 1
+            return None
+        # if entry is None
+        self.hits += 1
+        self.entries.move_to_end(id)
+        return entry[2].decode('utf-8')
+    # def get(self, id, enc)
+
+
+    def put(self, id, enc, pwd):
+        '''
+        Cache the decrypted password of a record, evicting the least recently
+        used entries beyond the size
+        @param {int}    id      id of the record
+        @param {bytes}  enc     the encrypted password of the record
+        @param {str}    pwd     the password
+        '''
+        if self.size <= 0:
+            return
+        # if self.size <= 0
+        self.sweep()
+        self.wipe(id)
+        expiry = time.monotonic() + self.ttl
+        self.entries[id] = (enc, expiry, bytearray(pwd.encode('utf-8')))
+        self.expiries.append((expiry, id, ))
+        if len(self.expiries) > 2 * self.size:  # mostly of entries gone
+            self.expiries = deque(sorted([(e[1], k, ) for k, e in \
+                                          self.entries.items()]))
+        # if len(self.expiries) > 2 * self.size
+        while len(self.entries) > self.size:
+            self.wipe(next(iter(self.entries)))
+        # while len(self.entries) > self.size
+    # def put(self, id, enc, pwd)
+
+
+    def sweep(self):
+        '''
+        Wipe the entries expired - the TTL is the same for all, so that they
+        expire in the order they are put
+        '''
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, id = self.expiries.popleft()
+            entry = self.entries.get(id)
+            if entry is not None and entry[1] == expiry:    # not put again
+                self.wipe(id)
+            # if entry is not None and entry[1] == expiry
+        # while self.expiries and self.expiries[0][0] <= now
+    # def sweep(self)
+
+
+    def discard(self, ids):
+        '''
+        Invalidate the entries of the records
+        @param {list}   ids     ids of the records
+        '''
+        for id in ids:
+            self.wipe(id)
+        # for id in ids
+    # def discard(self, ids)
+
+
+    def clear(self):
+        '''
+        Invalidate all the entries
+        '''
+        for id in list(self.entries):
+            self.wipe(id)
+        # for id in list(self.entries)
+        self.expiries.clear()
+    # def clear(self)
+
+
+    def info(self):
+        '''
+        Report the statistics of the cache
+        @return {dict}          hits, misses, hit ratio and size of the cache
+        '''
+        self.sweep()
+        total = self.hits + self.misses
+        return {
+            'hits':     self.hits,
+            'misses':   self.misses,
+            'ratio':    self.hits / total if total else 0.0,
+            'size':     len(self.entries),
+        } # return { ... }
+    # def info(self)
+# class PlainCache(object)
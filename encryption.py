@@ -4,10 +4,10 @@ Encryption library
 @author:    MarcoXZh3
 @version:   0.0.1
 '''
-import json
+import functools
+import mmap
+import os
 import random
-from Crypto import Random
-from Crypto.Cipher import AES
 
 
 class Cipher(object):
@@ -17,92 +17,468 @@ class Cipher(object):
 
     DATA_LENGTH = 1024  # 1024 bytes = 8192 bits
     KEY_LENGTH  = 32     # 32 bytes = 256 bits
+
+    # The compact format: "VERSION", nonce, then AES-GCM of the length of the
+    # message (2 bytes), the message and zero padding up to the next bucket,
+    # then the tag. It is always shorter than "DATA_LENGTH", while the salted
+    # format never is, so that the length tells the two apart
+    VERSION     = 1
+    BUCKETS     = (64, 128, 256, 512)
+    NONCE_LENGTH = 12
+    TAG_LENGTH  = 16
+
+    # The streaming format of files: "MAGIC", "VERSION" and a random nonce
+    # prefix, followed by frames of AES-GCM chunks of up to "CHUNK_SIZE" bytes
+    MAGIC       = b'PWBACKUP'
+    CHUNK_SIZE  = 1 << 16
+    # Modes of AES, as in Crypto.Cipher.AES - which is only imported once the
+    # first context is created, to keep the startup light
+    MODE_EAX    = 9
+    MODE_GCM    = 11
+    BLOCK_SIZE  = 16
     DUMMY       = ''.join([chr(i) for i in range(33, 127)]).encode()
     QUOTE       = '~~~'.encode()
 
+    # Map random bytes onto "DUMMY" uniformly - reject those beyond the largest
+    # multiple of len(DUMMY), then wrap the rest around
+    DRAW_TABLE  = (DUMMY * (256 // len(DUMMY) + 1))[:256]
+    DRAW_REJECT = bytes(range(256 // len(DUMMY) * len(DUMMY), 256))
+
 
-    def __init__(self, key, mode=AES.MODE_EAX):
+    def __init__(self, key, mode=MODE_EAX):
         '''
         Initialize the cipher
         @param {str}    key     the key of the cipher
         '''
-        self.key = key[:]
+        self.contexts = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.metrics = None
+        self.key = key
         self.mode = mode
-        self.iv = bytes([0] * AES.block_size)
-    # def __init__(self, key, mode=AES.MODE_EAX)
+        self.iv = bytes([0] * self.BLOCK_SIZE)
+    # def __init__(self, key, mode=MODE_EAX)
 
 
-    def encrypt(self, msg):
+    @property
+    def key(self):
         '''
-        Encryption
-        @param {str}    msg     the message to be encrypted
-        @returns {bytes}        the encrypted bytes
+        The key of the cipher
+        @returns {str}          the key
         '''
-        msg = list(msg.encode())
+        return self._key
+    # def key(self)
 
-        # Generate dummy bytes -- all those in "DUMMY" but not in "data"
-        dummy = [d for d in self.DUMMY if d not in msg]
 
-        # Salt "msg" with "dummy", then append "QUOTE" and "dummy"
-        while len(msg) + len(self.QUOTE) + len(dummy) < self.DATA_LENGTH:
-            msg.insert(random.randint(0, len(msg)), random.choice(dummy))
-        # while len(msg) + len(self.QUOTE) + len(dummy) < self.DATA_LENGTH
-        msg += list(self.QUOTE) + dummy
-        msg = bytes(msg)
+    @key.setter
+    def key(self, key):
+        '''
+        Change the key of the cipher, which invalidates the cached contexts
+        @param {str}    key     the new key
+        '''
+        self._key = key[:]
+        self.clear_cache()
+    # def key(self, key)
+
 
-        # Prepare the key
+    def derive_key(self):
+        '''
+        Derive the AES key from the cipher key
+        @returns {bytes}        the key of "KEY_LENGTH" bytes
+        '''
         key = self.key.encode()
         while len(key) < self.KEY_LENGTH:
             key += key
         # while len(key) < self.KEY_LENGTH
+        return key[:self.KEY_LENGTH]
+    # def derive_key(self)
 
-        # Encrypt the salted bytes
-        return AES.new(key[:self.KEY_LENGTH], self.mode, self.iv).encrypt(msg)
-    # def encrypt(self, data)
 
+    def key_id(self):
+        '''
+        Identify the key, without revealing it
+        @returns {str}          the id of the key, as hex
+        '''
+        import hashlib
+        import hmac
+        return hmac.new(self.derive_key(), b'key id', hashlib.sha256)\
+                   .hexdigest()[:16]
+    # def key_id(self)
 
-    def decrypt(self, data):
+
+    def context(self):
         '''
-        Decrypt bytes width password
+        Create a fresh AES context, with the key derivation and the mode setup
+        cached by key and mode
+        @returns {object}       the AES context for one message
         '''
-        # Prepare the key
-        key = self.key.encode()
-        while len(key) < self.KEY_LENGTH:
-            key += key
-        # while len(key) < self.KEY_LENGTH
+        factory = self.contexts.get((self.key, self.mode))
+        if factory is not None:
+            self.cache_hits += 1
+            return factory()
+        # if factory is not None
+
+        self.cache_misses += 1
+        from Crypto.Cipher import AES
+        key = self.derive_key()
+        if self.mode == self.MODE_EAX:
+            # EAX encrypts by CTR, starting at OMAC of the nonce -- the nonce is
+            # fixed, so is the counter; this is where all the setup cost goes.
+            # As an int, which pycryptodome takes in all versions
+            from Crypto.Hash import CMAC
+            counter = CMAC.new(key, bytes(AES.block_size), ciphermod=AES)\
+                          .update(self.iv).digest()
+            factory = functools.partial(AES.new, key, AES.MODE_CTR,
+                                        initial_value=int.from_bytes(counter,
+                                                                     'big'),
+                                        nonce=b'')
+        else:
+            factory = functools.partial(AES.new, key, self.mode, self.iv)
+        # else - if self.mode == self.MODE_EAX
+        self.contexts[(self.key, self.mode)] = factory
+        return factory()
+    # def context(self)
+
+
+    def sealer(self):
+        '''
+        Create AES-GCM contexts of the compact format, with the key derivation
+        cached by key
+        @returns {function}     the factory of contexts, taking the nonce
+        '''
+        factory = self.contexts.get((self.key, self.MODE_GCM))
+        if factory is None:
+            from Crypto.Cipher import AES
+            factory = functools.partial(AES.new, self.derive_key(), AES.MODE_GCM,
+                                        mac_len=self.TAG_LENGTH)
+            self.contexts[(self.key, self.MODE_GCM)] = factory
+        # if factory is None
+        return factory
+    # def sealer(self)
+
+
+    def clear_cache(self):
+        '''
+        Invalidate the cached contexts
+        '''
+        self.contexts.clear()
+    # def clear_cache(self)
+
+
+    def cache_info(self):
+        '''
+        Statistics of the context cache
+        @returns {dict}         hits, misses and size of the cache
+        '''
+        return {
+            'hits':     self.cache_hits,
+            'misses':   self.cache_misses,
+            'size':     len(self.contexts),
+        } # return { ... }
+    # def cache_info(self)
+
 
-        # Decrypt the data
-        data = AES.new(key[:self.KEY_LENGTH], self.mode, self.iv).decrypt(data)
+    def instrument(self, metrics):
+        '''
+        Record timings and counts of encryption and decryption
+        @param {Metrics}    metrics     where to record them
+        '''
+        self.metrics = metrics
+        for name in ('encrypt_many', 'decrypt_many'):
+            setattr(self, name,
+                    metrics.wrap('cipher.%s' % name, getattr(self, name)))
+        # for name in ('encrypt_many', 'decrypt_many')
+    # def instrument(self, metrics)
+
+
+    def draw(self, k):
+        '''
+        Draw random bytes of "DUMMY" in bulk
+        @param {int}    k       number of bytes to draw
+        @returns {bytes}        the random bytes
+        '''
+        data = b''
+        while len(data) < k:
+            data += os.urandom(k - len(data) + (k >> 2) + 16)\
+                      .translate(self.DRAW_TABLE, self.DRAW_REJECT)
+        # while len(data) < k
+        return data[:k]
+    # def draw(self, k)
+
+
+    def salt(self, msg, pool=None):
+        '''
+        Salt the message bytes in one pass: "msg" interleaved with dummy bytes,
+        followed by "QUOTE" and the dummy bytes
+        @param {bytes}  msg     the message bytes to be salted
+        @param {bytes}  pool    pre-drawn random bytes of "DUMMY", optional
+        @returns {bytes}        the salted bytes
+        '''
+        # Generate dummy bytes -- all those in "DUMMY" but not in "msg"
+        dummy = self.DUMMY.translate(None, msg)
+
+        # Salt "msg" with "dummy" -- pick the slots for "msg" at random, and
+        # fill in all the others with random dummy bytes
+        size = self.DATA_LENGTH - len(self.QUOTE) - len(dummy)
+        if len(msg) < size and dummy:
+            # Bytes in "pool" but not in "dummy" are dropped, which leaves the
+            # rest uniformly distributed over "dummy"
+            data = pool.translate(None, msg)[:size] if pool else b''
+            while len(data) < size:
+                data += self.draw(size - len(data)).translate(None, msg)
+            # while len(data) < size
+            data = bytearray(data[:size])
+            slots = sorted(random.sample(range(size), len(msg)))
+            for i, d in zip(slots, msg):
+                data[i] = d
+            # for i, d in zip(slots, msg)
+            msg = bytes(data)
+        # if len(msg) < size and dummy
+
+        # Append "QUOTE" and "dummy"
+        return msg + self.QUOTE + dummy
+    # def salt(self, msg, pool=None)
 
-        # Unsalt, split by the last "QUOTE", and the right most part is "dummy"
+
+    def bucket(self, msg):
+        '''
+        Find the bucket to pad the message bytes to, in the compact format
+        @param {bytes}  msg     the message bytes
+        @returns {int}          the size of the bucket, or None if too long
+        '''
+        for size in self.BUCKETS:
+            if len(msg) + 2 <= size:
+                return size
+            # if len(msg) + 2 <= size
+        # for size in self.BUCKETS
+        return None
+    # def bucket(self, msg)
+
+
+    def seal(self, msg, nonce):
+        '''
+        Encrypt the message bytes in the compact format
+        @param {bytes}  msg     the message bytes, short enough for a bucket
+        @param {bytes}  nonce   the random nonce of "NONCE_LENGTH" bytes
+        @returns {bytes}        the encrypted bytes
+        '''
+        header = bytes([self.VERSION])
+        data = len(msg).to_bytes(2, 'big') + msg
+        data += bytes(self.bucket(msg) - len(data))
+        ctx = self.sealer()(nonce=nonce)
+        ctx.update(header)
+        data, tag = ctx.encrypt_and_digest(data)
+        return header + nonce + data + tag
+    # def seal(self, msg, nonce)
+
+
+    def unseal(self, data):
+        '''
+        Decrypt the bytes in the compact format
+        @param {bytes}  data    the encrypted bytes
+        @returns {bytes}        the message bytes
+        '''
+        header, nonce = data[:1], data[1:1 + self.NONCE_LENGTH]
+        ctx = self.sealer()(nonce=nonce)
+        ctx.update(header)
+        data = ctx.decrypt_and_verify(data[1 + self.NONCE_LENGTH:
+                                           -self.TAG_LENGTH],
+                                      data[-self.TAG_LENGTH:])
+        return data[2:2 + int.from_bytes(data[:2], 'big')]
+    # def unseal(self, data)
+
+
+    def is_compact(self, data):
+        '''
+        Check whether the encrypted bytes are in the compact format
+        @param {bytes}  data    the encrypted bytes
+        @returns {bool}         whether in the compact format, otherwise salted
+        '''
+        return len(data) < self.DATA_LENGTH and data[:1] == bytes([self.VERSION])
+    # def is_compact(self, data)
+
+
+    def encrypt(self, msg):
+        '''
+        Encryption
+        @param {str}    msg     the message to be encrypted
+        @returns {bytes}        the encrypted bytes
+        '''
+        return self.encrypt_many([msg])[0]
+    # def encrypt(self, msg)
+
+
+    def encrypt_many(self, msgs):
+        '''
+        Encrypt a batch of messages, with the randomness drawn in bulk. They
+        are in the compact format, or salted if too long for its buckets
+        @param {list}   msgs    the messages to be encrypted
+        @returns {list}         the encrypted bytes, one for each message
+        '''
+        msgs = [msg.encode() for msg in msgs]
+        if self.metrics is not None:
+            self.metrics.count('encrypt', len(msgs))
+        # if self.metrics is not None
+
+        # Draw the nonces for the whole batch at once
+        nonces = os.urandom(len(msgs) * self.NONCE_LENGTH)
+
+        # Encrypt each message
+        results = []
+        for i, msg in enumerate(msgs):
+            if self.bucket(msg) is None:
+                results.append(self.encrypt_salted(msg))
+            else:
+                results.append(self.seal(msg, nonces[i * self.NONCE_LENGTH:
+                                                     (i + 1) * self.NONCE_LENGTH]))
+            # else - if self.bucket(msg) is None
+        # for i, msg in enumerate(msgs)
+        return results
+    # def encrypt_many(self, msgs)
+
+
+    def encrypt_salted(self, msg, pool=None):
+        '''
+        Encrypt the message bytes in the salted format, padded to "DATA_LENGTH"
+        @param {bytes}  msg     the message bytes
+        @param {bytes}  pool    pre-drawn random bytes of "DUMMY", optional
+        @returns {bytes}        the encrypted bytes
+        '''
+        return self.context().encrypt(self.salt(msg, pool))
+    # def encrypt_salted(self, msg, pool=None)
+
+
+    def unsalt(self, data):
+        '''
+        Unsalt the decrypted bytes
+        @param {bytes}  data    the salted bytes
+        @returns {bytes}        the message bytes
+        '''
+        # Split by the last "QUOTE", and the right most part is "dummy"
         fields = data.split(self.QUOTE)
         data, dummy = self.QUOTE.join(fields[:-1]), fields[-1]
-        data = bytes([d for d in data if d not in dummy])
 
-        # Return the data in bytes
-        return data.decode()
+        # Delete all "dummy" bytes at once
+        return data.translate(None, dummy)
+    # def unsalt(self, data)
+
+
+    def decrypt(self, data):
+        '''
+        Decrypt bytes width password
+        @param {bytes}  data    the encrypted bytes
+        @returns {str}          the decrypted message
+        '''
+        return self.decrypt_many([data])[0]
     # def decrypt(self, data)
 
 
+    def decrypt_many(self, blobs):
+        '''
+        Decrypt a batch of encrypted bytes, in either format
+        @param {list}   blobs   the encrypted bytes
+        @returns {list}         the decrypted messages, one for each blob
+        '''
+        if self.metrics is not None:
+            self.metrics.count('decrypt', len(blobs))
+        # if self.metrics is not None
+        return [(self.unseal(data) if self.is_compact(data) else \
+                 self.unsalt(self.context().decrypt(data))).decode()
+                for data in blobs]
+    # def decrypt_many(self, blobs)
+
+
+    def reencrypt_many(self, blobs, key):
+        '''
+        Decrypt a batch of encrypted bytes, and encrypt them again by another key
+        @param {list}   blobs   the encrypted bytes
+        @param {str}    key     the other key
+        @returns {list}         the encrypted bytes by the other key
+        '''
+        return Cipher(key).encrypt_many(self.decrypt_many(blobs))
+    # def reencrypt_many(self, blobs, key)
+
+
+    def fingerprint_digests(self, digests):
+        '''
+        Fingerprint a batch of SHA-1 digests of messages by HMAC, keyed by the
+        cipher key - equal messages get equal fingerprints, which tell nothing
+        of them without the key
+        @param {list}   digests the SHA-1 digests, as bytes or hex
+        @returns {list}         the fingerprints, as hex
+        '''
+        import hashlib
+        import hmac
+        base = hmac.new(self.derive_key(), b'fingerprint', hashlib.sha256)
+        results = []
+        for digest in digests:
+            if isinstance(digest, str):
+                digest = bytes.fromhex(digest)
+            # if isinstance(digest, str)
+            mac = base.copy()
+            mac.update(digest)
+            results.append(mac.hexdigest()[:32])
+        # for digest in digests
+        return results
+    # def fingerprint_digests(self, digests)
+
+
+    def fingerprint_many(self, msgs):
+        '''
+        Fingerprint a batch of messages, see "fingerprint_digests"
+        @param {list}   msgs    the messages
+        @returns {list}         the fingerprints, as hex
+        '''
+        import hashlib
+        return self.fingerprint_digests([hashlib.sha1(msg.encode()).digest() \
+                                         for msg in msgs])
+    # def fingerprint_many(self, msgs)
+
+
+    def fingerprint_blobs(self, blobs):
+        '''
+        Fingerprint a batch of encrypted messages, see "fingerprint_digests"
+        @param {list}   blobs   the encrypted bytes
+        @returns {list}         the fingerprints, as hex
+        '''
+        return self.fingerprint_many(self.decrypt_many(blobs))
+    # def fingerprint_blobs(self, blobs)
+
+
+    def reencrypt_fingerprint_many(self, blobs, key):
+        '''
+        Decrypt a batch of encrypted bytes, then encrypt and fingerprint them
+        by another key
+        @param {list}   blobs   the encrypted bytes
+        @param {str}    key     the other key
+        @returns {list}         (encrypted bytes, fingerprint) by the other key
+        '''
+        other = Cipher(key)
+        msgs = self.decrypt_many(blobs)
+        return list(zip(other.encrypt_many(msgs), other.fingerprint_many(msgs)))
+    # def reencrypt_fingerprint_many(self, blobs, key)
+
+
     def save(self, path, msg):
         '''
         Save message to file
         @param {str}    path    the path of the file
         @param {str}    msg     the message to be saved
         '''
-        data = self.encrypt(msg)
-        f = open(path, 'wb')
-        f.write(data)
-        f.close()
+        self.save_stream(path, [msg.encode()])
     # def save(self, path, msg)
 
 
     def load(self, path):
         '''
-        Load message from file
-        @param {str}    msg     the message to be loaded
+        Load message from file, in either the streaming format or the single
+        blob saved by earlier versions
         @param {str}    path    the path of the file
+        @returns {str}          the message loaded
         '''
+        if self.is_stream(path):
+            return b''.join(self.load_stream(path)).decode()
+        # if self.is_stream(path)
         f = open(path, 'rb')
         data = f.read()
         f.close()
@@ -110,6 +486,123 @@ class Cipher(object):
     # def load(self, path)
 
 
+    def seal_chunk(self, header, seq, data, last):
+        '''
+        Encrypt a chunk of the streaming format into its frame
+        @param {bytes}  header  the header of the file
+        @param {int}    seq     sequence number of the chunk
+        @param {bytes}  data    the chunk
+        @param {bool}   last    whether it is the last chunk
+        @returns {bytes}        the frame - length, encrypted bytes and tag
+        '''
+        ctx = self.sealer()(nonce=header[len(self.MAGIC) + 1:] + \
+                                  seq.to_bytes(4, 'big'))
+        ctx.update(header + (b'\x01' if last else b'\x00'))
+        data, tag = ctx.encrypt_and_digest(data)
+        return len(data).to_bytes(4, 'big') + data + tag
+    # def seal_chunk(self, header, seq, data, last)
+
+
+    def save_stream(self, path, chunks):
+        '''
+        Save message bytes to file in the streaming format, chunk by chunk, in
+        constant memory. The nonce of each chunk counts them, and the last one
+        is marked, so that frames reordered, dropped or cut off fail to load.
+        The file is replaced only once complete
+        @param {str}        path    the path of the file
+        @param {iterator}   chunks  the message bytes, in pieces of any size
+        @returns {int}              number of message bytes saved
+        '''
+        header = self.MAGIC + bytes([self.VERSION]) + \
+                 os.urandom(self.NONCE_LENGTH - 4)
+        buf = bytearray()
+        seq = 0
+        total = 0
+        f = open(path + '.tmp', 'wb', buffering=self.CHUNK_SIZE * 4)
+        try:
+            f.write(header)
+            for piece in chunks:
+                view = memoryview(piece)
+                total += len(view)
+                while len(buf) + len(view) >= self.CHUNK_SIZE:
+                    n = self.CHUNK_SIZE - len(buf)
+                    buf += view[:n]
+                    view = view[n:]
+                    f.write(self.seal_chunk(header, seq, bytes(buf), False))
+                    buf.clear()
+                    seq += 1
+                # while len(buf) + len(view) >= self.CHUNK_SIZE
+                buf += view
+            # for piece in chunks
+            f.write(self.seal_chunk(header, seq, bytes(buf), True))
+        except:
+            f.close()
+            os.remove(path + '.tmp')
+            raise
+        # try - except
+        f.close()
+        os.replace(path + '.tmp', path)
+        return total
+    # def save_stream(self, path, chunks)
+
+
+    def load_stream(self, path):
+        '''
+        Load message bytes from file in the streaming format, chunk by chunk,
+        through a memory map. Each chunk is authenticated before it is yielded
+        @param {str}    path    the path of the file
+        @returns {generator}    the message bytes, chunk by chunk
+        '''
+        if not self.is_stream(path):
+            raise ValueError('Not in the streaming format: %s' % path)
+        # if not self.is_stream(path)
+        f = open(path, 'rb')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = len(self.MAGIC) + 1 + self.NONCE_LENGTH - 4
+            header = data[:pos]
+            seq = 0
+            while True:
+                if pos + 4 > len(data):
+                    raise ValueError('Truncated file: %s' % path)
+                # if pos + 4 > len(data)
+                end = pos + 4 + int.from_bytes(data[pos:pos + 4], 'big')
+                if end + self.TAG_LENGTH > len(data):
+                    raise ValueError('Truncated file: %s' % path)
+                # if end + self.TAG_LENGTH > len(data)
+                last = end + self.TAG_LENGTH == len(data)
+                ctx = self.sealer()(nonce=header[len(self.MAGIC) + 1:] + \
+                                          seq.to_bytes(4, 'big'))
+                ctx.update(header + (b'\x01' if last else b'\x00'))
+                yield ctx.decrypt_and_verify(data[pos + 4:end],
+                                             data[end:end + self.TAG_LENGTH])
+                if last:
+                    break
+                # if last
+                pos = end + self.TAG_LENGTH
+                seq += 1
+            # while True
+        finally:
+            data.close()
+            f.close()
+        # try - finally
+    # def load_stream(self, path)
+
+
+    @classmethod
+    def is_stream(cls, path):
+        '''
+        Check whether a file is in the streaming format
+        @param {str}    path    the path of the file
+        @returns {bool}         whether in the streaming format
+        '''
+        f = open(path, 'rb')
+        head = f.read(len(cls.MAGIC) + 1)
+        f.close()
+        return head == cls.MAGIC + bytes([cls.VERSION])
+    # def is_stream(cls, path)
+
+
     def __str__(self):
         '''
         To string
@@ -137,6 +630,7 @@ def main():
     '''
     The main entry
     '''
+    import json
     msg = '~This这 - is是 ^ a一 @ piece条 # of $ text文本 %% acting作为 ' + \
           '& as * the ( 原始raw ) 信息message! +'
     password = '此处为密码!~'
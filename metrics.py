@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+Operation timings and counters
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import functools
+import time
+import types
+
+
+class Metrics(object):
+    '''
+    The metrics class - latency histograms and counters of named operations
+    '''
+
+    # Upper bounds, in seconds, of the buckets of the latency histograms
+    BUCKETS = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, 10.0, float('inf')]
+
+
+    def __init__(self, hook=None):
+        '''
+        Initialize the metrics
+        @param {function}   hook    called as hook(kind, name, value) for every
+                                    count ("count") and timing ("timing"), to
+                                    forward them elsewhere, optional
+        '''
+        self.hook = hook
+        self.counts = {}
+        self.timings = {}
+    # def __init__(self, hook=None)
+
+
+    def count(self, name, n=1):
+        '''
+        Count an operation
+        @param {str}    name    name of the operation
+        @param {int}    n       number to count
+        '''
+        self.counts[name] = self.counts.get(name, 0) + n
+        if self.hook is not None:
+            self.hook('count', name, n)
+        # if self.hook is not None
+    # def count(self, name, n=1)
+
+
+    def record(self, name, seconds):
+        '''
+        Record the latency of an operation
+        @param {str}    name    name of the operation
+        @param {float}  seconds the latency
+        '''
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = {
+                'count':        0,
+                'total':        0.0,
+                'max':          0.0,
+                'histogram':    [0] * len(self.BUCKETS),
+            } # timing = { ... }
+            self.timings[name] = timing
+        # if timing is None
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                timing['histogram'][i] += 1
+                break
+            # if seconds <= bound
+        # for i, bound in enumerate(self.BUCKETS)
+        if self.hook is not None:
+            self.hook('timing', name, seconds)
+        # if self.hook is not None
+    # def record(self, name, seconds)
+
+
+    def wrap(self, name, func):
+        '''
+        Wrap a function to record its latency. For a generator, the time spent
+        producing the items is recorded once it is exhausted or closed
+        @param {str}        name    name of the operation
+        @param {function}   func    the function
+        @return {function}          the wrapped function
+        '''
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                self.record(name, time.perf_counter() - start)
+                raise
+            # try - except
+            if isinstance(result, types.GeneratorType):
+                return self.timed_iter(name, result,
+                                       time.perf_counter() - start)
+            # if isinstance(result, types.GeneratorType)
+            self.record(name, time.perf_counter() - start)
+            return result
+        # def timed(*args, **kwargs)
+        return timed
+    # def wrap(self, name, func)
+
+
+    def timed_iter(self, name, items, seconds=0.0):
+        '''
+        Iterate the items, recording the time spent producing them
+        @param {str}        name    name of the operation
+        @param {iterator}   items   the items
+        @param {float}      seconds time already spent
+        @return {generator}         the items
+        '''
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                # try - except StopIteration - finally
+                yield item
+            # while True
+        finally:
+            self.record(name, seconds)
+        # try - finally
+    # def timed_iter(self, name, items, seconds=0.0)
+
+
+    def report(self):
+        '''
+        Report the metrics
+        @return {dict}          counts, and timings with histograms keyed by
+                                the upper bounds of the buckets
+        '''
+        timings = {}
+        for name, timing in self.timings.items():
+            timings[name] = {
+                'count':        timing['count'],
+                'total':        timing['total'],
+                'mean':         timing['total'] / timing['count'],
+                'max':          timing['max'],
+                'histogram':    dict([('<=%g' % bound, n) for bound, n in \
+                                      zip(self.BUCKETS, timing['histogram']) \
+                                      if n > 0]),
+            } # timings[name] = { ... }
+        # for name, timing in self.timings.items()
+        return {
+            'counts':   dict(self.counts),
+            'timings':  timings,
+        } # return { ... }
+    # def report(self)
+
+
+    def reset(self):
+        '''
+        Reset all the metrics
+        '''
+        self.counts.clear()
+        self.timings.clear()
+    # def reset(self)
+# class Metrics(object)
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+'''
+The wallet service - JSON-RPC over HTTP on localhost
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import collections
+import hmac
+import http.server
+import inspect
+import json
+import os
+import secrets
+import selectors
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from agent import decode, encode
+from wallet import Wallet
+
+HOST = '127.0.0.1'
+PORT = 8765
+TOKEN_FILE = 'dist/serve.token'
+# Methods served, by their names in JSON-RPC - with those of the shell as well
+METHODS = {
+    'search':       'search',
+    'find':         'search',
+    'explain':      'explain',
+    'add':          'add',
+    'add_many':     'add_many',
+    'delete':       'delete',
+    'del':          'delete',
+    'delete_many':  'delete_many',
+    'update':       'update',
+    'update_many':  'update_many',
+}
+# Calls of these in a row within a batch are run as one call of the bulk ones
+BULK = {
+    'add':      ('add_many',    ('pwd', 'name', 'site', 'desc')),
+    'delete':   ('delete_many', ('id', 'name', 'site')),
+    'update':   ('update_many', ('id', 'name', 'site', 'pwd', 'desc')),
+}
+
+
+def error(id, code, message):
+    '''
+    Make a JSON-RPC error response
+    @param {object} id      id of the request
+    @param {int}    code    the error code
+    @param {str}    message the error message
+    @return {dict}          the response
+    '''
+    return { 'jsonrpc': '2.0', 'id': id,
+             'error': { 'code': code, 'message': message } }
+# def error(id, code, message)
+
+
+def bind(func, params):
+    '''
+    Bind the params of a JSON-RPC request to the arguments of a method, as
+    calling it would
+    @param {function}   func    the method
+    @param {object}     params  positional or keyword arguments
+    @return {dict}              the arguments by name, or None if the params
+                                do not fit the method
+    '''
+    try:
+        if isinstance(params, dict):
+            return dict(inspect.signature(func).bind(**params).arguments)
+        elif isinstance(params, list):
+            return dict(inspect.signature(func).bind(*params).arguments)
+        # elif isinstance(params, list)
+    except TypeError:
+        pass
+    # try - except TypeError
+    return None
+# def bind(func, params)
+
+
+class BatchFailed(Exception):
+    '''
+    Raised within the group of a batch to roll it back, once a call fails
+    '''
+    pass
+# class BatchFailed(Exception)
+
+
+class RPCHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    The handler of JSON-RPC requests, POSTed one or a batch at a time
+    '''
+    protocol_version = 'HTTP/1.1'   # keep the connections alive
+    timeout = 5                     # to read a request once it is ready
+    disable_nagle_algorithm = True  # no delay for the small responses
+
+    def handle(self):
+        '''
+        Handle one request only - the server waits for the next one on the
+        connection kept alive, without holding a worker thread meanwhile
+        '''
+        self.close_connection = True
+        self.handle_one_request()
+    # def handle(self)
+
+
+    def finish(self):
+        '''
+        Flush the response, and close the files unless kept alive
+        '''
+        if self.close_connection:
+            http.server.BaseHTTPRequestHandler.finish(self)
+        else:
+            self.wfile.flush()
+        # else - if self.close_connection
+    # def finish(self)
+
+
+    def pending(self):
+        '''
+        Tell whether the next request is read into the buffer already, e.g.
+        pipelined, so that there is nothing to wait for on the connection
+        @return {bool}          whether the next request is pending
+        '''
+        self.connection.setblocking(False)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        # try - except OSError - finally
+    # def pending(self)
+
+
+    def do_POST(self):
+        '''
+        Handle a POST of JSON-RPC requests
+        '''
+        auth = self.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth, 'Bearer %s' % self.server.token):
+            self.reply(401, None)
+            return
+        # if not hmac.compare_digest( ... )
+        try:
+            body = json.loads(self.rfile.read(
+                int(self.headers.get('Content-Length', 0))).decode())
+        except ValueError:
+            self.reply(200, error(None, -32700, 'Parse error'))
+            return
+        # try - except ValueError
+        if isinstance(body, list):
+            responses = self.server.call_many(body) if body else \
+                        error(None, -32600, 'Invalid Request')
+        else:
+            responses = self.server.call_many([body])
+            responses = responses[0] if responses else None
+        # else - if isinstance(body, list)
+        self.reply(200, responses)
+    # def do_POST(self)
+
+
+    def reply(self, status, response):
+        '''
+        Send the response, if any
+        @param {int}    status      the HTTP status
+        @param {object} response    the JSON-RPC response(s), or None
+        '''
+        data = b'' if response is None or response == [] else \
+               json.dumps(response).encode()
+        self.send_response(204 if status == 200 and not data else status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    # def reply(self, status, response)
+
+
+    def log_message(self, *args):
+        '''
+        Keep quiet - no log for every request
+        '''
+        pass
+    # def log_message(self, *args)
+# class RPCHandler(http.server.BaseHTTPRequestHandler)
+
+
+class WalletServer(http.server.HTTPServer):
+    '''
+    The HTTP server of the wallet, with requests handled on a pool of worker
+    threads, each of which keeps a wallet of its own open. A connection kept
+    alive holds a worker for one request at a time: in between, it waits on
+    a selector thread, which hands it back to the pool once readable
+    '''
+    IDLE = 60           # seconds a connection may wait for its next request
+
+    def __init__(self, wallet, address=(HOST, PORT), workers=4, token=None):
+        '''
+        Initialize the server
+        @param {Wallet} wallet  the wallet, whose key and database to serve
+        @param {tuple}  address (host, port) to listen on
+        @param {int}    workers number of worker threads
+        @param {str}    token   the bearer token that clients must present
+        '''
+        http.server.HTTPServer.__init__(self, address, RPCHandler)
+        self.args = (wallet.key, os.path.basename(wallet.db), wallet.table, )
+        self.token = token or secrets.token_hex(16)
+        self.workers = ThreadPoolExecutor(workers)
+        self.local = threading.local()
+
+        # The connections waiting for their next requests, parked by the
+        # workers and registered by the selector thread, woken up to do so
+        self.selector = selectors.DefaultSelector()
+        self.parked = collections.deque()
+        self.waker = socket.socketpair()
+        self.selector.register(self.waker[0], selectors.EVENT_READ)
+        self.stopping = False
+        self.waiter = threading.Thread(target=self.wait_forever, daemon=True)
+        self.waiter.start()
+    # def __init__(self, wallet, address=(HOST, PORT), workers=4, token=None)
+
+
+    def process_request(self, request, client_address):
+        '''
+        Hand the first request of a connection over to a worker thread
+        @param {socket} request         the connection
+        @param {tuple}  client_address  the address of the client
+        '''
+        self.workers.submit(self.process_request_thread, request,
+                            client_address)
+    # def process_request(self, request, client_address)
+
+
+    def process_request_thread(self, request, client_address):
+        '''
+        Handle the first request of a connection on a worker thread
+        @param {socket} request         the connection
+        @param {tuple}  client_address  the address of the client
+        '''
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        # try - except Exception
+        self.keep(handler)
+    # def process_request_thread(self, request, client_address)
+
+
+    def next_request(self, handler):
+        '''
+        Handle the next request of a connection kept alive, on a worker thread
+        @param {RPCHandler} handler the handler of the connection
+        '''
+        try:
+            handler.handle()
+            handler.finish()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            handler.close_connection = True
+        # try - except Exception
+        self.keep(handler)
+    # def next_request(self, handler)
+
+
+    def keep(self, handler):
+        '''
+        Close the connection once done, or wait for its next request - on the
+        selector thread, unless pending already
+        @param {RPCHandler} handler the handler of the connection
+        '''
+        if handler.close_connection or self.stopping:
+            self.shutdown_request(handler.request)
+        elif handler.pending():
+            self.workers.submit(self.next_request, handler)
+        else:
+            self.parked.append(handler)
+            self.waker[1].send(b'\0')
+        # else - if ... elif
+    # def keep(self, handler)
+
+
+    def wait_forever(self):
+        '''
+        Wait for the next requests of the connections kept alive, on the
+        selector thread, and hand those ready over to the workers - closing
+        those idle for longer than "IDLE"
+        '''
+        while not self.stopping:
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.fileobj is self.waker[0]:
+                    self.waker[0].recv(4096)
+                    continue
+                # if key.fileobj is self.waker[0]
+                self.selector.unregister(key.fileobj)
+                try:
+                    self.workers.submit(self.next_request, key.data[0])
+                except RuntimeError:    # shut down
+                    self.shutdown_request(key.data[0].request)
+                # try - except RuntimeError
+            # for key, _ in self.selector.select(timeout=1.0)
+            while self.parked:
+                handler = self.parked.popleft()
+                self.selector.register(handler.connection, selectors.EVENT_READ,
+                                       (handler, time.monotonic(), ))
+            # while self.parked
+            now = time.monotonic()
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None and now - key.data[1] > self.IDLE:
+                    self.selector.unregister(key.fileobj)
+                    self.shutdown_request(key.data[0].request)
+                # if key.data is not None and ...
+            # for key in list(self.selector.get_map().values())
+        # while not self.stopping
+    # def wait_forever(self)
+
+
+    def server_close(self):
+        '''
+        Stop listening, then stop the selector thread, and close the
+        connections waiting on it
+        '''
+        http.server.HTTPServer.server_close(self)
+        self.stopping = True
+        self.waker[1].send(b'\0')
+        self.waiter.join()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.shutdown_request(key.data[0].request)
+            # if key.data is not None
+        # for key in list(self.selector.get_map().values())
+        while self.parked:
+            self.shutdown_request(self.parked.popleft().request)
+        # while self.parked
+        self.selector.close()
+        self.waker[0].close()
+        self.waker[1].close()
+    # def server_close(self)
+
+
+    def wallet(self):
+        '''
+        Get the wallet of the worker thread, opened on first use
+        @return {Wallet}        the wallet
+        '''
+        wallet = getattr(self.local, 'wallet', None)
+        if wallet is None:
+            wallet = Wallet(*self.args, workers=1, concurrent=True)
+            wallet.connect()
+            self.local.wallet = wallet
+        # if wallet is None
+        return wallet
+    # def wallet(self)
+
+
+    def call_many(self, requests):
+        '''
+        Run a batch of JSON-RPC requests in order, with the adds, deletes or
+        updates in a row run as one bulk call, and all of them committed once.
+        If any call fails, or the commit does, all of them are rolled back,
+        and those that succeeded are answered by errors as well
+        @param {list}   requests    the requests
+        @return {list}              the responses, but to notifications
+        '''
+        wallet = self.wallet()
+        responses = []
+        try:
+            with wallet.group():
+                responses, failed = self.call_group(wallet, requests)
+                if failed:
+                    raise BatchFailed()
+                # if failed
+            # with wallet.group()
+            return responses
+        except BatchFailed:
+            message = 'Rolled back, as another request of the batch failed'
+        except Exception as e:
+            message = 'Rolled back: %s: %s' % (type(e).__name__, e)
+        # try - except BatchFailed - except Exception as e
+        return [r if 'error' in r else error(r['id'], -32603, message) \
+                for r in responses]
+    # def call_many(self, requests)
+
+
+    def call_group(self, wallet, requests):
+        '''
+        Run a batch of JSON-RPC requests in order, within a group of the wallet
+        @param {Wallet} wallet      the wallet
+        @param {list}   requests    the requests
+        @return {tuple}             (the responses, but to notifications,
+                                    whether any call failed)
+        '''
+        responses = []
+        failed = False
+        i = 0
+        while i < len(requests):
+            request = requests[i]
+            if not isinstance(request, dict) or \
+               not isinstance(request.get('method'), str):
+                responses.append(error(None, -32600, 'Invalid Request'))
+                failed = True
+                i += 1
+                continue
+            # if not isinstance(request, dict) or ...
+            method = METHODS.get(request['method'])
+            params = decode(request.get('params', []))
+            if method is None:
+                results = [error(request.get('id'), -32601, 'Method not found')]
+                group = [request]
+                failed = True
+            elif method in BULK and \
+                 bind(getattr(wallet, method), params) is not None:
+                # Gather the same calls in a row - those with params not fit
+                # for the method are left to be called alone, and refused
+                bulk, keys = BULK[method]
+                group = []
+                items = []
+                while i + len(group) < len(requests):
+                    other = requests[i + len(group)]
+                    if not isinstance(other, dict) or \
+                       METHODS.get(other.get('method')) != method:
+                        break
+                    # if not isinstance(other, dict) or ...
+                    args = bind(getattr(wallet, method),
+                                decode(other.get('params', [])))
+                    if args is None:
+                        break
+                    # if args is None
+                    group.append(other)
+                    items.append(dict([(k, v) for k, v in args.items() \
+                                       if k in keys]))
+                # while i + len(group) < len(requests)
+                results = self.invoke(wallet, bulk, [items], group, True)
+                failed = failed or 'error' in results[0]
+            else:
+                group = [request]
+                results = self.invoke(wallet, method, params, group)
+                failed = failed or 'error' in results[0]
+            # else - if ... elif
+            for request, result in zip(group, results):
+                if 'id' in request:
+                    responses.append(result)
+                # if 'id' in request
+            # for request, result in zip(group, results)
+            i += len(group)
+        # while i < len(requests)
+        return (responses, failed, )
+    # def call_group(self, wallet, requests)
+
+
+    def invoke(self, wallet, method, params, group, bulk=False):
+        '''
+        Invoke a method of the wallet for a group of requests
+        @param {Wallet} wallet  the wallet
+        @param {str}    method  name of the method
+        @param {object} params  positional or keyword arguments
+        @param {list}   group   the requests, one unless a bulk call
+        @param {bool}   bulk    whether a bulk call for the group, with one
+                                result for each of the requests
+        @return {list}          the responses, one for each request
+        '''
+        try:
+            if isinstance(params, dict):
+                result = getattr(wallet, method)(**params)
+            else:
+                result = getattr(wallet, method)(*params)
+            # else - if isinstance(params, dict)
+        except TypeError as e:
+            return [error(r.get('id'), -32602, str(e)) for r in group]
+        except Exception as e:
+            return [error(r.get('id'), -32603, '%s: %s' % (type(e).__name__, e))
+                    for r in group]
+        # try - except TypeError as e - except Exception as e
+        results = result if bulk else [result]
+        return [{ 'jsonrpc': '2.0', 'id': r.get('id'), 'result': encode(v) } \
+                for r, v in zip(group, results)]
+    # def invoke(self, wallet, method, params, group, bulk=False)
+# class WalletServer(http.server.HTTPServer)
+
+
+def interrupt(signum, frame):
+    '''
+    Handle a signal to stop, the same way as Ctrl-C
+    @param {int}    signum  the signal
+    @param {frame}  frame   the frame interrupted
+    '''
+    raise KeyboardInterrupt()
+# def interrupt(signum, frame)
+
+
+def serve(wallet, port=PORT, workers=4):
+    '''
+    Serve the wallet on localhost until interrupted or terminated. The token
+    of the clients is written to "TOKEN_FILE", which only the owner may read
+    @param {Wallet} wallet  the wallet, whose key and database to serve
+    @param {int}    port    the port to listen on
+    @param {int}    workers number of worker threads
+    '''
+    server = WalletServer(wallet, (HOST, port), workers)
+    signal.signal(signal.SIGTERM, interrupt)
+    fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.write(fd, (server.token + '\n').encode())
+    os.close(fd)
+    print('Serving at http://%s:%d/ with %d workers, token in %s' % \
+          (HOST, server.server_address[1], workers, TOKEN_FILE))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        server.workers.shutdown(wait=False)
+        os.remove(TOKEN_FILE)
+    # try - except KeyboardInterrupt - finally
+# def serve(wallet, port=PORT, workers=4)
@@ -0,0 +1,928 @@
+# -*- coding: utf-8 -*-
+'''
+The sharded wallet - records partitioned into database files by site
+@author:  MarcoXZh3
+@version: 0.0.1
+'''
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from encryption import Cipher
+from wallet import Wallet, load_records, match_digests, save_records, \
+                   sort_groups
+
+FOLDER = 'dist'
+# Columns copied as they are when records move between shards - encrypted
+# passwords and their fingerprints included, so that no password is decrypted
+COLUMNS = ('created', 'modified', 'name', 'pwd', 'site', 'desc', 'kid', 'fp')
+
+
+def shard_name(db_name, shard):
+    '''
+    Name of the database of a shard
+    @param {str}    db_name the name of the sharded database
+    @param {int}    shard   the index of the shard
+    @return {str}           the name of the database of the shard
+    '''
+    return '%s.%d' % (db_name, shard)
+# def shard_name(db_name, shard)
+
+
+def count_shards(db_name='data'):
+    '''
+    Count the shards of a database in "FOLDER"
+    @param {str}    db_name the name of the sharded database
+    @return {int}           number of shards, 0 if not sharded
+    '''
+    cnt = 0
+    while os.path.exists(os.path.join(FOLDER, shard_name(db_name, cnt))):
+        cnt += 1
+    # while os.path.exists( ... )
+    return cnt
+# def count_shards(db_name='data')
+
+
+def shard_of(site, shards):
+    '''
+    The shard of a site, by its CRC-32 - a site left empty is "Default", as in
+    "Wallet.add"
+    @param {str}    site    the site
+    @param {int}    shards  number of shards
+    @return {int}           the index of the shard
+    '''
+    if site is None or site.strip() == '':
+        site = 'Default'
+    # if site is None or site.strip() == ''
+    return zlib.crc32(site.encode('utf-8')) % shards
+# def shard_of(site, shards)
+
+
+def insert_rows(wallet, rows):
+    '''
+    Insert records as they are, passwords encrypted, into a wallet
+    @param {Wallet} wallet  the wallet
+    @param {list}   rows    the records, each of which is a tuple of the
+                            values of "COLUMNS"
+    '''
+    wallet.connect().executemany(
+        'INSERT INTO %s (%s) VALUES (%s);' % \
+        (wallet.table, ', '.join(COLUMNS), ', '.join(['?'] * len(COLUMNS))),
+        rows)
+# def insert_rows(wallet, rows)
+
+
+def reshard(key, shards, db_name='data', table_name='data', batch_size=None,
+            progress=None):
+    '''
+    Partition the records of a database, or of its shards, into a number of
+    shards. The records are copied as they are, without decrypting any of
+    them, into new files first, which replace the old shards only once all is
+    copied. A database not sharded yet is kept as it is
+    @param {str}        key         key to unlock the wallet
+    @param {int}        shards      number of shards
+    @param {str}        db_name     name of the database
+    @param {str}        table_name  name of the table
+    @param {int}        batch_size  number of records to copy at once
+    @param {function}   progress    called as progress(done, total) after each
+                                    batch, optional
+    @return {int}                   number of records copied
+    '''
+    if shards < 1:
+        raise ValueError('Invalid number of shards: %d' % shards)
+    # if shards < 1
+    batch_size = batch_size or Wallet.SEARCH_BATCH
+    old = count_shards(db_name)
+    if old > 0:
+        sources = [shard_name(db_name, i) for i in range(old)]
+    elif os.path.exists(os.path.join(FOLDER, db_name)):
+        sources = [db_name]
+    else:
+        raise ValueError('No database to reshard: %s' % db_name)
+    # else - if ... elif
+    if old == shards:
+        return 0
+    # if old == shards
+    sources = [Wallet(key, name, table_name) for name in sources]
+    for source in sources:
+        if source.connect().execute(
+                'SELECT 1 FROM %s_rekey;' % table_name).fetchone() is not None:
+            raise ValueError('A re-key is in progress, finish it first')
+        # if source.connect().execute( ... ).fetchone() is not None
+    # for source in sources
+
+    # Copy into new files, left over by an interrupted run if any
+    temps = [shard_name(db_name, i) + '.tmp' for i in range(shards)]
+    for name in temps:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(os.path.join(FOLDER, name + suffix)):
+                os.remove(os.path.join(FOLDER, name + suffix))
+            # if os.path.exists(os.path.join(FOLDER, name + suffix))
+        # for suffix in ('', '-wal', '-shm')
+    # for name in temps
+    fingerprints = any([s.fingerprints for s in sources])
+    targets = [Wallet(key, name, table_name, fingerprints=fingerprints) \
+               for name in temps]
+    total = sum([s.conn.execute('SELECT COUNT(*) FROM %s;' % table_name)\
+                  .fetchone()[0] for s in sources])
+    cnt = 0
+    for source in sources:
+        cur = source.conn.execute('SELECT %s FROM %s ORDER BY id;' % \
+                                  (', '.join(COLUMNS), table_name))
+        rows = cur.fetchmany(batch_size)
+        while rows:
+            buckets = [[] for _ in range(shards)]
+            for row in rows:
+                buckets[shard_of(row[4], shards)].append(row)
+            # for row in rows
+            for target, bucket in zip(targets, buckets):
+                insert_rows(target, bucket)
+            # for target, bucket in zip(targets, buckets)
+            cnt += len(rows)
+            if progress is not None:
+                progress(cnt, total)
+            # if progress is not None
+            rows = cur.fetchmany(batch_size)
+        # while rows
+
+        # The next "~N" suffixes go along with their sites
+        for name, site, next in source.conn.execute(
+                'SELECT name, site, next FROM %s_suffix;' % table_name):
+            targets[shard_of(site, shards)].conn.execute(
+                'INSERT OR REPLACE INTO %s_suffix (name, site, next) ' \
+                'VALUES (?, ?, ?);' % table_name, (name, site, next, ))
+        # for name, site, next in source.conn.execute( ... )
+    # for source in sources
+    for target in targets:
+        if any([s.fts for s in sources]):   # indexed all at once, at last
+            target.reindex()
+        # if any([s.fts for s in sources])
+        target.commit()
+        target.close()
+    # for target in targets
+    for source in sources:
+        source.close()
+    # for source in sources
+
+    # Swap the new shards in - the old ones are moved aside first, so that a
+    # run interrupted here leaves either of them to recover from
+    for i in range(old):
+        os.replace(os.path.join(FOLDER, shard_name(db_name, i)),
+                   os.path.join(FOLDER, shard_name(db_name, i) + '.old'))
+    # for i in range(old)
+    for i, name in enumerate(temps):
+        os.replace(os.path.join(FOLDER, name),
+                   os.path.join(FOLDER, shard_name(db_name, i)))
+    # for i, name in enumerate(temps)
+    for i in range(old):
+        os.remove(os.path.join(FOLDER, shard_name(db_name, i) + '.old'))
+    # for i in range(old)
+    return cnt
+# def reshard(key, shards, db_name='data', ..., progress=None)
+
+
+class SharedPool(object):
+    '''
+    The process pool shared by the shards, started on first use as that of
+    Wallet - so that opening a sharded wallet starts no process, and imports
+    no multiprocessing
+    '''
+
+    def __init__(self, workers):
+        '''
+        Initialize the pool, not started yet
+        @param {int}    workers     number of processes
+        '''
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()    # the shards start it from their threads
+    # def __init__(self, workers)
+
+
+    def map(self, *args, **kwargs):
+        '''
+        Map a function over the process pool, starting it if not yet, see
+        "ProcessPoolExecutor.map"
+        @param {list}   args        positional arguments
+        @param {dict}   kwargs      keyword arguments
+        @return {generator}         the results
+        '''
+        with self.lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(self.workers)
+            # if self.pool is None
+        # with self.lock
+        return self.pool.map(*args, **kwargs)
+    # def map(self, *args, **kwargs)
+
+
+    def shutdown(self, wait=True):
+        '''
+        Shut down the process pool, if started - to be started again if used
+        @param {bool}   wait        whether to wait for the processes to exit
+        '''
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait)
+                self.pool = None
+            # if self.pool is not None
+        # with self.lock
+    # def shutdown(self, wait=True)
+# class SharedPool(object)
+
+
+class ShardedWallet(object):
+    '''
+    The sharded wallet class, with the same methods as Wallet - records are
+    partitioned into the databases of its shards by CRC-32 of their sites.
+    Each shard is a wallet on a thread of its own, so that a search fans out
+    to all of them at once, while the other methods go straight to one. The
+    id of a record tells its shard: id in the shard * number of shards + shard
+    '''
+    SHARDS = 4          # number of shards of a new wallet, by default
+    CODES = Wallet.CODES
+    SEARCH_BATCH = Wallet.SEARCH_BATCH
+
+
+    def __init__(self, key, shards=None, db_name='data', table_name='data',
+                 workers=None, cache=None, **kwargs):
+        '''
+        Initialize the wallet - the shards are opened on first use
+        @param {str}    key         key to unlock the wallet
+        @param {int}    shards      number of shards, default to those of the
+                                    database, or "SHARDS" for a new one
+        @param {str}    db_name     name of the database
+        @param {str}    table_name  name of the table
+        @param {int}    workers     size of the process pool for batch cipher
+                                    work, shared by the shards, default to the
+                                    number of CPU cores
+        @param {PlainCache} cache   where to cache the decrypted passwords,
+                                    optional - each shard gets one alike
+        @param {dict}   kwargs      other arguments of Wallet
+        '''
+        found = count_shards(db_name)
+        if shards and found and not shards == found:
+            raise ValueError('%s has %d shards, not %d - reshard it first' % \
+                             (db_name, found, shards))
+        # if shards and found and not shards == found
+        self.shards = shards or found or self.SHARDS
+        self.key = key
+        self.cipher = Cipher(key)
+        self.db_name = db_name
+        self.table = table_name
+        self.workers = workers or os.cpu_count() or 1
+        self.metrics = None
+        self.wallets = [Wallet(key, shard_name(db_name, i), table_name,
+                               self.workers, cache=None if cache is None else \
+                               type(cache)(cache.size, cache.ttl), **kwargs) \
+                        for i in range(self.shards)]
+        self.threads = None
+        self.pool = SharedPool(self.workers) if self.workers > 1 else None
+        for wallet in self.wallets:
+            wallet.pool = self.pool
+        # for wallet in self.wallets
+    # def __init__(self, key, shards=None, db_name='data', ..., **kwargs)
+
+
+    def run(self, shard, func, *args, **kwargs):
+        '''
+        Run a method of a shard on its thread
+        @param {int}        shard   the index of the shard
+        @param {str}        func    name of the method, or a function taking
+                                    the wallet of the shard first
+        @param {list}       args    positional arguments
+        @param {dict}       kwargs  keyword arguments
+        @return {Future}            the result to come
+        '''
+        if self.threads is None:
+            self.threads = [ThreadPoolExecutor(max_workers=1) \
+                            for _ in range(self.shards)]
+        # if self.threads is None
+        if isinstance(func, str):
+            return self.threads[shard].submit(
+                getattr(self.wallets[shard], func), *args, **kwargs)
+        # if isinstance(func, str)
+        return self.threads[shard].submit(func, self.wallets[shard], *args,
+                                          **kwargs)
+    # def run(self, shard, func, *args, **kwargs)
+
+
+    def call(self, shard, func, *args, **kwargs):
+        '''
+        Call a method of a shard on its thread, and wait for it
+        @param {int}        shard   the index of the shard
+        @param {str}        func    name of the method, or a function taking
+                                    the wallet of the shard first
+        @param {list}       args    positional arguments
+        @param {dict}       kwargs  keyword arguments
+        @return {object}            the result of the method
+        '''
+        return self.run(shard, func, *args, **kwargs).result()
+    # def call(self, shard, func, *args, **kwargs)
+
+
+    def fan_out(self, func, *args, **kwargs):
+        '''
+        Call a method of all the shards at once, and wait for them all
+        @param {str}        func    name of the method, or a function taking
+                                    the wallet of the shard first
+        @param {list}       args    positional arguments
+        @param {dict}       kwargs  keyword arguments
+        @return {list}              the results, one for each shard
+        '''
+        return [future.result() for future in \
+                [self.run(i, func, *args, **kwargs) for i in range(self.shards)]]
+    # def fan_out(self, func, *args, **kwargs)
+
+
+    def split(self, id):
+        '''
+        Split the id of a record into its shard and its id in the shard
+        @param {int}    id      id of the record
+        @return {tuple}         (index of the shard, id in the shard), or None
+                                for an id of no record - ids in the shards
+                                start from 1, so those below the number of
+                                shards are of none
+        '''
+        if id < self.shards:
+            return None
+        # if id < self.shards
+        return (id % self.shards, id // self.shards, )
+    # def split(self, id)
+
+
+    def route(self, items, shard_of_item):
+        '''
+        Group items by their shards, keeping their positions
+        @param {list}       items           the items
+        @param {function}   shard_of_item   the shard of an item, and the item
+                                            to hand over to the shard
+        @return {dict}                      (positions, items) by shard
+        '''
+        groups = {}
+        for i, item in enumerate(items):
+            shard, item = shard_of_item(item)
+            positions, routed = groups.setdefault(shard, ([], []))
+            positions.append(i)
+            routed.append(item)
+        # for i, item in enumerate(items)
+        return groups
+    # def route(self, items, shard_of_item)
+
+
+    def fan_out_many(self, method, items, shard_of_item):
+        '''
+        Run a bulk method on the shards at once, each with its own items
+        @param {str}        method          name of the bulk method
+        @param {list}       items           the items
+        @param {function}   shard_of_item   the shard of an item, and the item
+                                            to hand over to the shard
+        @return {list}                      the results, in the same order as
+                                            the items
+        '''
+        groups = self.route(items, shard_of_item)
+        futures = [(positions, self.run(shard, method, routed), ) \
+                   for shard, (positions, routed) in groups.items()]
+        results = [None] * len(items)
+        for positions, future in futures:
+            for i, result in zip(positions, future.result()):
+                results[i] = result
+            # for i, result in zip(positions, future.result())
+        # for positions, future in futures
+        return results
+    # def fan_out_many(self, method, items, shard_of_item)
+
+
+    def instrument(self, metrics):
+        '''
+        Record timings and counts of all the shards, see Wallet
+        @param {Metrics}    metrics     where to record them
+        '''
+        self.metrics = metrics
+        self.fan_out('instrument', metrics)
+    # def instrument(self, metrics)
+
+
+    def stats(self):
+        '''
+        Report the timings and counts recorded, of all the shards
+        @return {dict}              counts, and timings with histograms keyed by
+                                    operation - empty if not instrumented
+        '''
+        if self.metrics is None:
+            return {}
+        # if self.metrics is None
+        report = self.metrics.report()
+        for wallet in self.wallets:
+            for k, v in wallet.stats()['counts'].items():
+                if k.endswith('_cache_hits') or k.endswith('_cache_misses'):
+                    report['counts'][k] = report['counts'].get(k, 0) + v
+                # if k.endswith('_cache_hits') or ...
+            # for k, v in wallet.stats()['counts'].items()
+        # for wallet in self.wallets
+        return report
+    # def stats(self)
+
+
+    def cache_info(self):
+        '''
+        Statistics of the caches of decrypted passwords, of all the shards
+        @return {dict}              hits, misses, hit ratio and size of the
+                                    caches - None if not cached
+        '''
+        infos = [w.cache_info() for w in self.wallets if w.cache is not None]
+        if not infos:
+            return None
+        # if not infos
+        info = dict([(k, sum([i[k] for i in infos])) \
+                     for k in ('hits', 'misses', 'size')])
+        total = info['hits'] + info['misses']
+        info['ratio'] = info['hits'] / total if total else 0.0
+        return info
+    # def cache_info(self)
+
+
+    def close(self):
+        '''
+        Close all the shards, then shut down their threads and the process pool
+        '''
+        if self.threads is not None:
+            self.fan_out('close')
+            for thread in self.threads:
+                thread.shutdown()
+            # for thread in self.threads
+            self.threads = None
+        # if self.threads is not None
+        if self.pool is not None:   # to be started again if used
+            self.pool.shutdown()
+        # if self.pool is not None
+        for wallet in self.wallets:
+            wallet.pool = self.pool
+        # for wallet in self.wallets
+    # def close(self)
+
+
+    def __enter__(self):
+        '''
+        Enter the context - open the shards
+        @return {ShardedWallet}     the wallet itself
+        '''
+        self.fan_out('connect')
+        return self
+    # def __enter__(self)
+
+
+    def __exit__(self, *args):
+        '''
+        Exit the context - close the shards
+        @param {list}   args        the exception info, to be ignored
+        '''
+        self.close()
+    # def __exit__(self, *args)
+
+
+    def explain(self, pattern=None):
+        '''
+        Explain how the records matching the pattern are found, in each of the
+        shards alike, see Wallet
+        @param {dict}   pattern     the patterns for filtering
+        @return {list}              lines of the explanation
+        '''
+        return ['Shards: %d, searched in parallel' % self.shards] + \
+               self.call(0, 'explain', pattern)
+    # def explain(self, pattern=None)
+
+
+    def search(self, pattern=None, show=False, fields=None):
+        '''
+        Find all password matching the filter regex pattern, in all the shards
+        at once. If show, then return decrypted "pwd" field
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {list}              the list of target passwords, as Records
+        '''
+        return list(self.iter_search(pattern, show, self.SEARCH_BATCH, fields))
+    # def search(self, pattern=None, show=False, fields=None)
+
+
+    def iter_search(self, pattern=None, show=False, batch_size=None,
+                    fields=None):
+        '''
+        Stream all password matching the filter regex pattern, batch by batch
+        from each of the shards in turn, while the next batches are fetched and
+        decrypted on all of them. If show, then yield decrypted "pwd" field
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {int}    batch_size  number of rows to fetch and decrypt at once
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {generator}         the target passwords, one by one, as
+                                    Records
+        '''
+        batch_size = batch_size or Wallet.BATCH_SIZE
+        records = self.fan_out('iter_search', pattern, show, batch_size,
+                               fields)
+        fetch = lambda wallet, records: list(islice(records, batch_size))
+        try:
+            pending = [self.run(i, fetch, records[i]) \
+                       for i in range(self.shards)]
+            while any(pending):
+                for i, future in enumerate(pending):
+                    results = future.result() if future else None
+                    if not results:
+                        pending[i] = None
+                        continue
+                    # if not results
+                    pending[i] = self.run(i, fetch, records[i])
+                    for record in results:
+                        if 'id' in record:
+                            record['id'] = record['id'] * self.shards + i
+                        # if 'id' in record
+                        yield record
+                    # for record in results
+                # for i, future in enumerate(pending)
+            # while any(pending)
+        finally:    # on the threads of the shards, after the batches pending
+            for i, generator in enumerate(records):
+                if self.threads is not None:
+                    self.run(i, lambda wallet, generator: generator.close(),
+                             generator)
+                # if self.threads is not None
+            # for i, generator in enumerate(records)
+        # try - finally
+    # def iter_search(self, pattern=None, show=False, ..., fields=None)
+
+
+    def add(self, pwd, name=None, site=None, desc=None):
+        '''
+        Add a new password, to the shard of its site, see Wallet
+        @param {str}    pwd     password of the record, to be encrypted
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        @param {str}    desc    description of the record
+        @return {tuple}         (status code in CODES, supplement message)
+        '''
+        return self.call(shard_of(site, self.shards), 'add', pwd, name, site,
+                         desc)
+    # def add(self, pwd, name=None, site=None, desc=None)
+
+
+    def add_many(self, records):
+        '''
+        Add new passwords in bulk, to the shards of their sites at once, within
+        a single transaction of each shard, see Wallet
+        @param {list}   records     the records, each of which is either a
+                                    tuple of (pwd, name, site, desc) as in
+                                    "add", or a dict with those keys
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the records
+        '''
+        def shard_of_record(record):
+            site = record.get('site') if isinstance(record, dict) else \
+                   (tuple(record) + (None, ) * 4)[2]
+            return (shard_of(site, self.shards), record, )
+        # def shard_of_record(record)
+        return self.fan_out_many('add_many', records, shard_of_record)
+    # def add_many(self, records)
+
+
+    def delete(self, id=None, name=None, site=None, pwd=None, desc=None):
+        '''
+        Delete a password, from the shard of its id or site, see Wallet
+        @param {int}    id      id of the record
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        @param {str}    pwd     password of the record, to be encrypted
+        @param {str}    desc    description of the record
+        @return {tuple}         (status code in CODES, supplement message)
+        '''
+        return self.delete_many([{ 'id': id, 'name': name, 'site': site }])[0]
+    # def delete(self, id=None, name=None, site=None, pwd=None, desc=None)
+
+
+    def delete_many(self, keys):
+        '''
+        Delete passwords in bulk, from the shards of their ids or sites at
+        once, within a single transaction of each shard, see Wallet
+        @param {list}   keys    the keys of the records, each of which is either
+                                an id, a tuple of (name, site), or a dict with
+                                "id" or "name" and "site"
+        @return {list}          (status code in CODES, supplement message) for
+                                each of the keys
+        '''
+        results = [None] * len(keys)
+        routed = []
+        for i, key in enumerate(keys):
+            if isinstance(key, dict):
+                id, name, site = [key.get(k) for k in ('id', 'name', 'site')]
+            elif isinstance(key, (tuple, list)):
+                id, name, site = (None, ) + (tuple(key) + (None, ) * 2)[:2]
+            else:
+                id, name, site = key, None, None
+            # else - if ... elif
+            if id and id > 0:
+                where = self.split(id)
+                if where is None:
+                    results[i] = (self.CODES['NOT_FOUND'],
+                                  'No record found to delete')
+                    continue
+                # if where is None
+                routed.append((i, where[0], { 'id': where[1] }, ))
+            else:
+                routed.append((i, shard_of(site, self.shards),
+                               { 'id': id, 'name': name, 'site': site }, ))
+            # else - if id and id > 0
+        # for i, key in enumerate(keys)
+        for (i, _, _), result in zip(routed, self.fan_out_many(
+                'delete_many', routed, lambda r: (r[1], r[2], ))):
+            results[i] = result
+        # for (i, _, _), result in zip(routed, self.fan_out_many( ... ))
+        return results
+    # def delete_many(self, keys)
+
+
+    def update(self, id=None, name=None, site=None, pwd=None, desc=None):
+        '''
+        Update a password, in the shard of its id or site, see Wallet
+        @param {int}    id      id of the record
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        @param {str}    pwd     password of the record, to be encrypted
+        @param {str}    desc    description of the record
+        @return {tuple}         (status code in CODES, supplement message)
+        '''
+        return self.update_many([(id, name, site, pwd, desc, )])[0]
+    # def update(self, id=None, name=None, site=None, pwd=None, desc=None)
+
+
+    def update_many(self, changes):
+        '''
+        Update passwords in bulk, in the shards of their ids or sites at once,
+        within a single transaction of each shard, see Wallet. A record whose
+        site changes to one of another shard moves there, with a new id
+        @param {list}   changes     the changes, each of which is either a
+                                    tuple of (id, name, site, pwd, desc) as in
+                                    "update", or a dict with those keys
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the changes
+        '''
+        results = [None] * len(changes)
+        routed = []
+        moves = []
+        for i, change in enumerate(changes):
+            if isinstance(change, dict):
+                id, name, site, pwd, desc = [change.get(k) for k in \
+                                             ('id', 'name', 'site', 'pwd', 'desc')]
+            else:
+                id, name, site, pwd, desc = (tuple(change) + (None, ) * 5)[:5]
+            # else - if isinstance(change, dict)
+            if not id:
+                shard = shard_of(site, self.shards)
+            else:
+                where = self.split(id)
+                if where is None:
+                    results[i] = (self.CODES['NOT_FOUND'],
+                                  'No record found to update')
+                    continue
+                # if where is None
+                shard, id = where
+                if site and site.strip() and \
+                   not shard_of(site, self.shards) == shard:
+                    moves.append((i, shard, id, name, site, pwd, desc, ))
+                    continue
+                # if site and site.strip() and ...
+            # else - if not id
+            routed.append((i, shard, (id, name, site, pwd, desc, ), ))
+        # for i, change in enumerate(changes)
+        for (i, _, _), result in zip(routed, self.fan_out_many(
+                'update_many', routed, lambda r: (r[1], r[2], ))):
+            results[i] = result
+        # for (i, _, _), result in zip(routed, self.fan_out_many( ... ))
+        for i, shard, id, name, site, pwd, desc in moves:
+            results[i] = self.move(shard, id, name, site, pwd, desc)
+        # for i, shard, id, name, site, pwd, desc in moves
+        return results
+    # def update_many(self, changes)
+
+
+    def move(self, shard, id, name, site, pwd, desc):
+        '''
+        Update a record with a site of another shard, by moving it there
+        @param {int}    shard   the index of the shard of the record
+        @param {int}    id      id of the record in the shard
+        @param {str}    name    new name of the record, optional
+        @param {str}    site    new site of the record
+        @param {str}    pwd     new password of the record, optional
+        @param {str}    desc    new description of the record, optional
+        @return {tuple}         (status code in CODES, supplement message)
+        '''
+        target = shard_of(site, self.shards)
+        row = self.call(shard, lambda wallet: wallet.connect().execute(
+            'SELECT %s FROM %s WHERE id=?;' % (', '.join(COLUMNS), self.table),
+            (id, )).fetchone())
+        if row is None:
+            return (self.CODES['NOT_FOUND'], 'No record found to update')
+        # if row is None
+        record = dict(zip(COLUMNS, row))
+        record['name'] = name or record['name']
+        record['site'] = site
+        record['desc'] = desc or record['desc']
+        record['modified'] = int(time.time())
+        if self.call(target, 'exists', record['name'], site):
+            return (self.CODES['FAILED'], 'Record already exists')
+        # if self.call(target, 'exists', record['name'], site)
+        if pwd:
+            record['pwd'] = sqlite3.Binary(self.cipher.encrypt(pwd))
+            record['kid'] = self.wallets[target].kid
+            record['fp'] = self.cipher.fingerprint_many([pwd])[0] \
+                           if self.wallets[target].fingerprints else None
+        # if pwd
+
+        # Insert into the other shard first, then delete from this one - if
+        # interrupted in between, the record is left in both, but not lost
+        def insert(wallet):
+            insert_rows(wallet, [tuple([record[k] for k in COLUMNS])])
+            wallet.commit()
+        # def insert(wallet)
+        self.call(target, insert)
+        self.call(shard, 'delete', id)
+        return (self.CODES['SUCCEED'], 'Update password succeeded')
+    # def move(self, shard, id, name, site, pwd, desc)
+
+
+    def migrate(self, batch_size=None, vacuum=True):
+        '''
+        Rewrite the passwords in the salted format into the compact one, in all
+        the shards at once, see Wallet
+        @param {int}    batch_size  number of records to rewrite at once
+        @param {bool}   vacuum      whether to reclaim the space freed at last
+        @return {int}               number of passwords rewritten
+        '''
+        return sum(self.fan_out('migrate', batch_size, vacuum))
+    # def migrate(self, batch_size=None, vacuum=True)
+
+
+    def reindex(self):
+        '''
+        Create or rebuild the full-text index of all the shards at once, see
+        Wallet
+        '''
+        self.fan_out('reindex')
+    # def reindex(self)
+
+
+    def rekey(self, key, batch_size=None, progress=None):
+        '''
+        Re-encrypt all the passwords by a new key, shard by shard, each of them
+        resumable on its own, see Wallet
+        @param {str}        key         the new key
+        @param {int}        batch_size  number of records to re-encrypt at once
+        @param {function}   progress    called as progress(done, total) after
+                                        each chunk, optional - with the totals
+                                        of the shards done so far
+        @return {int}                   number of passwords re-encrypted
+        '''
+        cnt = 0
+        for i in range(self.shards):
+            report = None
+            if progress is not None:
+                report = lambda done, total: progress(cnt + done, cnt + total)
+            # if progress is not None
+            cnt += self.call(i, 'rekey', key, batch_size, report)
+        # for i in range(self.shards)
+        self.key = key
+        self.cipher.key = key
+        return cnt
+    # def rekey(self, key, batch_size=None, progress=None)
+
+
+    def fingerprint(self, batch_size=None, progress=None):
+        '''
+        Fingerprint the passwords without one, shard by shard, see Wallet
+        @param {int}        batch_size  number of records to fingerprint at once
+        @param {function}   progress    called as progress(done, total) after
+                                        each chunk, optional - with the totals
+                                        of the shards done so far
+        @return {int}                   number of passwords fingerprinted
+        '''
+        cnt = 0
+        for i in range(self.shards):
+            report = None
+            if progress is not None:
+                report = lambda done, total: progress(cnt + done, cnt + total)
+            # if progress is not None
+            cnt += self.call(i, 'fingerprint', batch_size, report)
+        # for i in range(self.shards)
+        return cnt
+    # def fingerprint(self, batch_size=None, progress=None)
+
+
+    def fingerprint_counts(self, minimum=1):
+        '''
+        Count the records by fingerprint, in all the shards at once - a
+        password may be reused across them, see Wallet
+        @param {int}    minimum     least count of a fingerprint to report
+        @return {dict}              counts by fingerprint
+        '''
+        counts = {}
+        for found in self.fan_out('fingerprint_counts'):
+            for fp, cnt in found.items():
+                counts[fp] = counts.get(fp, 0) + cnt
+            # for fp, cnt in found.items()
+        # for found in self.fan_out('fingerprint_counts')
+        return dict([(fp, cnt) for fp, cnt in counts.items() if cnt >= minimum])
+    # def fingerprint_counts(self, minimum=1)
+
+
+    def find_fingerprints(self, fps):
+        '''
+        Find the records of the passwords with any of the fingerprints, in all
+        the shards at once, see Wallet
+        @param {list}   fps         the fingerprints
+        @return {dict}              lists of Records of "id", "name" and
+                                    "site", by fingerprint
+        '''
+        fps = list(fps)
+        groups = {}
+        for shard, found in enumerate(self.fan_out('find_fingerprints', fps)):
+            for fp, records in found.items():
+                for record in records:
+                    record['id'] = record['id'] * self.shards + shard
+                # for record in records
+                groups.setdefault(fp, []).extend(records)
+            # for fp, records in found.items()
+        # for shard, found in enumerate(self.fan_out( ... ))
+        for records in groups.values():
+            records.sort(key=lambda r: r['id'])
+        # for records in groups.values()
+        return groups
+    # def find_fingerprints(self, fps)
+
+
+    def find_reused(self):
+        '''
+        Find the passwords used by more than one record, across all the
+        shards, see Wallet
+        @return {list}              groups of Records sharing a password
+        '''
+        return sort_groups(self.find_fingerprints(
+            self.fingerprint_counts(2).keys()))
+    # def find_reused(self)
+
+
+    def find_breached(self, digests, batch_size=None):
+        '''
+        Find the passwords in a list of breached ones, in all the shards, see
+        Wallet
+        @param {iterable}   digests     SHA-1 digests of the breached
+                                        passwords, as hex
+        @param {int}        batch_size  number of digests to fingerprint at once
+        @return {list}                  groups of Records sharing a breached
+                                        password
+        '''
+        return sort_groups(self.find_fingerprints(match_digests(
+            self.cipher, digests, self.fingerprint_counts(),
+            batch_size or self.SEARCH_BATCH)))
+    # def find_breached(self, digests, batch_size=None)
+
+
+    def backup(self, path):
+        '''
+        Export all the records of all the shards to an encrypted file, see
+        Wallet
+        @param {str}    path    the path of the file
+        @return {int}           number of records exported
+        '''
+        return save_records(self.cipher, path, self.iter_search(show=True))
+    # def backup(self, path)
+
+
+    def restore(self, path, batch_size=None):
+        '''
+        Import the records of a file exported, into the shards of their sites,
+        see Wallet
+        @param {str}    path        the path of the file
+        @param {int}    batch_size  number of records to add at once
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the records
+        '''
+        return load_records(self.cipher, path, self.add_many,
+                            batch_size or self.SEARCH_BATCH)
+    # def restore(self, path, batch_size=None)
+
+
+    def __str__(self):
+        '''
+        To string
+        @returns {str}      the string format of the class
+        '''
+        return 'ShardedWallet<key="%s", target="%s/%s.[0-%d].%s">' % \
+               (self.key, FOLDER, self.db_name, self.shards - 1, self.table)
+    # def __str__(self)
+# class ShardedWallet(object)
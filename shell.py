@@ -4,18 +4,50 @@ The shell to access the wallet
 @author:  MarcoXZh3
 @version: 0.0.1
 '''
-import datetime
 import getpass
-import json
 import re
 import os
+import shlex
 import sys
 import time
+from encryption import Cipher
 from wallet import Wallet
 
 KEY_PATH = 'dist'
 KEY_FILE = 'key.log'
 RETRY = 3
+# Actions a running agent serves, without the key or the database opened here
+AGENT_ACTIONS = ('add', 'del', 'update', 'find', 'explain', 'import',
+                 'export')
+# The socket of the agent, as "agent.AGENT_SOCK" - checked before importing the
+# agent, which most of the actions run without
+AGENT_SOCK = os.environ.get('WALLET_AGENT_SOCK', 'dist/agent.sock')
+# Actions that open the wallet in the concurrent mode, to be shared with other
+# processes - as all of them do with $WALLET_CONCURRENT set
+CONCURRENT_ACTIONS = ('agent', 'serve')
+
+
+def refuse_agent(action):
+    '''
+    Refuse an action that rewrites the key or the files of the wallet, while
+    an agent is running - it keeps the wallet open as it was, and would go on
+    writing by the old key or into the old files
+    @param {str}    action  name of the action
+    @return {bool}          whether refused
+    '''
+    if not os.path.exists(AGENT_SOCK):
+        return False
+    # if not os.path.exists(AGENT_SOCK)
+    import agent
+    remote = agent.connect(AGENT_SOCK)
+    if remote is None:
+        return False
+    # if remote is None
+    remote.close()
+    print('An agent is running, stop it first by "shell.py agent stop", ' \
+          'then run %s again' % action)
+    return True
+# def refuse_agent(action)
 
 
 def action_add(wallet, *args):
@@ -167,44 +199,441 @@ def action_find(wallet, *args):
     '''
     pattern = {}
     show = False
-    for i, arg in enumerate(args[0]):
-        if not i == len(args[0]) - 1:
-            if re.search(r'^(name|site|desc)\=.+$', arg):
-                k, v = arg.split('=')
-                pattern[k] = v
-            else:
-                print('Unrecognized arg: "%s"' % arg)
-                return
-        elif arg.strip().lower() == 'true':
-            show = True
-        # if ... elif
-    # for i, arg in enumerate(args[0])
+    fields = None
+    args = list(args[0])
+    if len(args) > 0 and args[-1].strip().lower() in ('true', 'false'):
+        show = args.pop().strip().lower() == 'true'
+    # if len(args) > 0 and args[-1].strip().lower() in ('true', 'false')
+    for arg in args:
+        if re.search(r'^(name|site|desc)\=.+$', arg):
+            k, v = arg.split('=', 1)
+            pattern[k] = v
+        elif re.search(r'^fields\=.+$', arg):
+            fields = [f.strip() for f in arg.split('=', 1)[1].split(',')]
+        else:
+            print('Unrecognized arg: "%s"' % arg)
+            return
+        # else - if ... elif
+    # for arg in args
     if len(pattern.keys()) == 0:
         pattern = None
     # if len(pattern.keys()) == 0
 
-    # Find in wallet
-    results = wallet.search(pattern, show)
-    if results is None or results[0] == 0:
-        print('No records found')
-    else:
-        for i, result in enumerate(results):
-            result['created'] = datetime.datetime\
-                                        .fromtimestamp(result['created'])\
-                                        .isoformat()
-            result['modified'] = datetime.datetime\
-                                         .fromtimestamp(result['modified'])\
-                                         .isoformat()
-            if not show:
+    # Find in wallet, printing the records as they come
+    import json
+    cnt = 0
+    try:
+        for result in wallet.iter_search(pattern, show, fields=fields):
+            cnt += 1
+            result = dict(result.items())
+            for k in ('created', 'modified'):
+                if k in result:
+                    result[k] = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                              time.localtime(result[k]))
+                # if k in result
+            # for k in ('created', 'modified')
+            if not show and 'pwd' in result:
                 result['pwd'] = str(result['pwd'][:10]) + ' ...'
-            # if not show
-            print('%d/%d - %s' % (i+1, len(results), \
-                                  json.dumps(result, indent=4, ensure_ascii=False)))
-        # for i, result in enumerate(results)
-    # else - if results is None or results[0] == 0
+            # if not show and 'pwd' in result
+            print('%d - %s' % (cnt, json.dumps(result, indent=4,
+                                                ensure_ascii=False)))
+        # for result in wallet.iter_search(pattern, show, fields=fields)
+    except (ValueError, RuntimeError) as e:     # unknown fields, by the agent
+        print('Error: %s' % e)
+        return
+    # try - except (ValueError, RuntimeError) as e
+    if cnt == 0:
+        print('No records found')
+    # if cnt == 0
 # def action_find(wallet, *args)
 
 
+def action_explain(wallet, *args):
+    '''
+    Explain how target passwords are found
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments
+    '''
+    pattern = {}
+    for arg in args[0]:
+        if re.search(r'^(name|site|desc)\=.+$', arg):
+            k, v = arg.split('=', 1)
+            pattern[k] = v
+        else:
+            print('Unrecognized arg: "%s"' % arg)
+            return
+        # else - if re.search(r'^(name|site|desc)\=.+$', arg)
+    # for arg in args[0]
+
+    # Explain in wallet
+    for line in wallet.explain(pattern):
+        print(line)
+    # for line in wallet.explain(pattern)
+# def action_explain(wallet, *args)
+
+
+def action_import(wallet, *args):
+    '''
+    Import passwords in bulk from a file exported, or a CSV or JSON file
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - path of the file
+    '''
+    if len(args[0]) == 0:
+        print('Missing file to import')
+        return
+    # if len(args[0]) == 0
+    path = os.path.abspath(args[0][0])
+
+    if Cipher.is_stream(path):  # Exported by "export"
+        try:
+            results = wallet.restore(path)
+        except ValueError as e:     # wrong key, or damaged file
+            print('Error: %s' % e)
+            return
+        # try - except ValueError as e
+    else:
+        import csv
+        import json
+
+        # Read the records - a JSON list, or CSV with header "pwd,name,site,desc"
+        f = open(path, 'r', encoding='utf-8', newline='')
+        if path.lower().endswith('.json'):
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+        # else - if path.lower().endswith('.json')
+        f.close()
+
+        # Add to wallet
+        results = wallet.add_many(records)
+    # else - if Cipher.is_stream(path)
+    cnt = 0
+    for i, result in enumerate(results):
+        if (result[0] == 0):
+            cnt += 1
+        else:
+            print('Error: record %d: %s' % (i+1, result[1]))
+        # else - if (result[0] == 0)
+    # for i, result in enumerate(results)
+    print('%d/%d passwords imported to wallet' % (cnt, len(results)))
+# def action_import(wallet, *args)
+
+
+def action_export(wallet, *args):
+    '''
+    Export all passwords to an encrypted file, to be imported by "import"
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - path of the file
+    '''
+    if len(args[0]) == 0:
+        print('Missing file to export to')
+        return
+    # if len(args[0]) == 0
+    path = os.path.abspath(args[0][0])
+    print('%d passwords exported to %s' % (wallet.backup(path), path))
+# def action_export(wallet, *args)
+
+
+def action_migrate(wallet, *args):
+    '''
+    Rewrite the passwords into the compact format
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    to be ignored
+    '''
+    if refuse_agent('migrate'):
+        return
+    # if refuse_agent('migrate')
+    try:
+        cnt = wallet.migrate()
+    except RuntimeError as e:   # a re-key in progress
+        print('Error: %s' % e)
+        return
+    # try - except RuntimeError as e
+    print('%d passwords migrated' % cnt)
+# def action_migrate(wallet, *args)
+
+
+def action_rekey(wallet, *args):
+    '''
+    Change the key of the wallet, re-encrypting all passwords
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    to be ignored
+    '''
+    if refuse_agent('rekey'):
+        return
+    # if refuse_agent('rekey')
+    try:
+        key = getpass.getpass('Enter the new wallet key:').strip()
+        cnt = 1
+        while key == '':
+            if cnt == RETRY:
+                return
+            # if cnt == RETRY
+            key = getpass.getpass('Empty, try again:').strip()
+            cnt += 1
+        # while key == ''
+        key2 = getpass.getpass('Confirm the new wallet key:').strip()
+        if not key == key2:
+            print('Mismatch, quit')
+            return
+        # if not key == key2
+    except KeyboardInterrupt:
+        print()
+        return
+    # try - except KeyboardInterrupt
+
+    # Re-encrypt, then save the new key - once interrupted, run again with the
+    # same new key to resume
+    def progress(done, total):
+        sys.stdout.write('\r%d/%d passwords re-encrypted' % (done, total))
+        sys.stdout.flush()
+    # def progress(done, total)
+    try:
+        cnt = wallet.rekey(key, progress=progress)
+    except ValueError as e:
+        print('Error: %s' % e)
+        return
+    # try - except ValueError as e
+    print('\r\033[K%d passwords re-encrypted' % cnt)   # over the progress
+    f = open(os.path.join(KEY_PATH, KEY_FILE), 'w')
+    f.write(key + '\n')
+    f.close()
+# def action_rekey(wallet, *args)
+
+
+def action_reindex(wallet, *args):
+    '''
+    Create or rebuild the full-text index of substrings
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    to be ignored
+    '''
+    if refuse_agent('reindex'):
+        return
+    # if refuse_agent('reindex')
+    wallet.reindex()
+    print('Full-text index rebuilt')
+# def action_reindex(wallet, *args)
+
+
+def action_reshard(wallet, *args):
+    '''
+    Partition the records into a number of database files by site, or change
+    the number of them
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - the number of shards
+    '''
+    if refuse_agent('reshard'):
+        return
+    # if refuse_agent('reshard')
+    import sharded
+    try:
+        shards = int(args[0][0])
+    except (IndexError, ValueError):
+        print('Missing or invalid number of shards')
+        return
+    # try - except (IndexError, ValueError)
+    def progress(done, total):
+        sys.stdout.write('\r%d/%d passwords copied' % (done, total))
+        sys.stdout.flush()
+    # def progress(done, total)
+    wallet.close()
+    try:
+        cnt = sharded.reshard(wallet.key, shards, progress=progress)
+    except ValueError as e:
+        print('Error: %s' % e)
+        return
+    # try - except ValueError as e
+    print('\r\033[K%d passwords copied into %d shards' % (cnt, shards))
+    if isinstance(wallet, Wallet):
+        print('%s is kept as it is, remove it once checked' % wallet.db)
+    # if isinstance(wallet, Wallet)
+# def action_reshard(wallet, *args)
+
+
+def action_audit(wallet, *args):
+    '''
+    List the passwords reused by more than one record, and those in a list of
+    breached ones, by their keyed fingerprints - without decrypting them
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - path of the list of SHA-1 hashes of
+                            breached passwords, optional
+    '''
+    # Fingerprint those without one yet - all of them for the first time
+    def progress(done, total):
+        sys.stdout.write('\r%d/%d passwords fingerprinted' % (done, total))
+        sys.stdout.flush()
+    # def progress(done, total)
+    try:
+        cnt = wallet.fingerprint(progress=progress)
+        if cnt > 0:
+            print('\r\033[K%d passwords fingerprinted' % cnt)
+        # if cnt > 0
+        groups = [('Reused', wallet.find_reused(), )]
+    except RuntimeError as e:   # a re-key in progress
+        print('Error: %s' % e)
+        return
+    # try - except RuntimeError as e
+
+    # One hash per line, as hex, optionally followed by ":COUNT"
+    if len(args[0]) > 0:
+        if not os.path.exists(args[0][0]):
+            print('File not found: %s' % args[0][0])
+            return
+        # if not os.path.exists(args[0][0])
+        f = open(args[0][0], 'r')
+        try:
+            groups.append(('Breached', wallet.find_breached(
+                (line.split(':')[0].strip() for line in f if line.strip())), ))
+        except ValueError as e:
+            print('Invalid hash in %s: %s' % (args[0][0], e))
+            return
+        finally:
+            f.close()
+        # try - except ValueError as e - finally
+    # if len(args[0]) > 0
+
+    for label, found in groups:
+        print('%s passwords: %d' % (label, len(found)))
+        for i, records in enumerate(found):
+            print('%d - %s by %d records:' % (i + 1, label.lower(), len(records)))
+            for record in records:
+                print('    [%d] %s @ %s' % \
+                      (record['id'], record['name'], record['site']))
+            # for record in records
+        # for i, records in enumerate(found)
+    # for label, found in groups
+# def action_audit(wallet, *args)
+
+
+def action_serve(wallet, *args):
+    '''
+    Serve the wallet as JSON-RPC over HTTP on localhost
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - the port and number of workers
+    '''
+    if not isinstance(wallet, Wallet):
+        print('A sharded wallet is not served yet, run "agent" instead')
+        return
+    # if not isinstance(wallet, Wallet)
+    import server
+    try:
+        port = int(args[0][0]) if len(args[0]) > 0 else server.PORT
+        workers = int(args[0][1]) if len(args[0]) > 1 else 4
+    except ValueError:
+        print('Invalid port or number of workers')
+        return
+    # try - except ValueError
+    server.serve(wallet, port, workers)
+# def action_serve(wallet, *args)
+
+
+def action_stats(wallet, *args):
+    '''
+    Run another action, then print the timings and counts of its operations
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - the action and its arguments
+    '''
+    func = ACTIONS.get(args[0][0].strip()) if len(args[0]) > 0 else None
+    if func is None:
+        print('Missing or unrecognized action to run')
+        return
+    # if func is None
+    import json
+    from metrics import Metrics
+
+    # Reconnect once instrumented, so that connecting is recorded as well
+    wallet.close()
+    wallet.instrument(Metrics())
+    func(wallet, args[0][1:])
+    print(json.dumps(wallet.stats(), indent=4))
+# def action_stats(wallet, *args)
+
+
+def action_repl(wallet, *args):
+    '''
+    Run the actions interactively, on the same wallet
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    to be ignored
+    '''
+    print('Enter an action with its arguments, "exit" to quit')
+    while True:
+        try:
+            line = input('wallet> ').strip()
+        except (EOFError, KeyboardInterrupt):
+            print()
+            return
+        # try - except (EOFError, KeyboardInterrupt)
+        if line == '':
+            continue
+        elif line in ('exit', 'quit'):
+            return
+        # elif line in ('exit', 'quit')
+        try:
+            words = shlex.split(line)
+        except ValueError as e:
+            print('Error: %s' % e)
+            continue
+        # try - except ValueError as e
+        func = None
+        if words[0] not in ('repl', 'agent'):
+            func = ACTIONS.get(words[0])
+        # if words[0] not in ('repl', 'agent')
+        if func is None:
+            print('Unrecognized action: "%s"' % words[0])
+            continue
+        # if func is None
+        try:
+            func(wallet, words[1:])
+        except Exception as e:
+            print('Error: %s' % e)
+        # try - except Exception as e
+    # while True
+# def action_repl(wallet, *args)
+
+
+def action_agent(wallet, *args):
+    '''
+    Serve the wallet on a local socket, so that the other actions find it warm,
+    or stop the running agent
+    @param {Wallet} wallet  the wallet
+    @param {list}   args    arguments - "stop" to stop the running agent
+    '''
+    import agent
+    if len(args[0]) > 0 and args[0][0] == 'stop':
+        remote = agent.connect()
+        if remote is None:
+            print('No agent running')
+        else:
+            remote.shutdown()
+            print('Agent stopped')
+        # else - if remote is None
+        return
+    # if len(args[0]) > 0 and args[0][0] == 'stop'
+    agent.serve(wallet)
+# def action_agent(wallet, *args)
+
+
+# The actions, by their names on the command line
+ACTIONS = dict([
+    ('add',         action_add),
+    ('del',         action_del),
+    ('update',      action_update),
+    ('find',        action_find),
+    ('explain',     action_explain),
+    ('import',      action_import),
+    ('export',      action_export),
+    ('migrate',     action_migrate),
+    ('reindex',     action_reindex),
+    ('rekey',       action_rekey),
+    ('reshard',     action_reshard),
+    ('audit',       action_audit),
+    ('stats',       action_stats),
+    ('repl',        action_repl),
+    ('agent',       action_agent),
+    ('serve',       action_serve),
+]) # ACTIONS = dict([ ... ])
+
+
 def main():
     '''
     The main entry
@@ -214,15 +643,48 @@ def main():
         '  Usage: python3 shell.py add',
         '     or: python3 shell.py del',
         '     or: python3 shell.py update',
-        '     or: python3 shell.py find [name=R1 [site=R2 [desc=R3]] [True|False]]',
+        '     or: python3 shell.py find [name=R1 [site=R2 [desc=R3]]] [fields=F1,F2] [True|False]',
+        '     or: python3 shell.py explain [name=R1 [site=R2 [desc=R3]]]',
+        '     or: python3 shell.py import FILE',
+        '     or: python3 shell.py export FILE',
+        '     or: python3 shell.py migrate',
+        '     or: python3 shell.py reindex',
+        '     or: python3 shell.py rekey',
+        '     or: python3 shell.py reshard SHARDS',
+        '     or: python3 shell.py audit [HASHES]',
+        '     or: python3 shell.py stats ACTION [ARGS]',
+        '     or: python3 shell.py repl',
+        '     or: python3 shell.py agent [stop]',
+        '     or: python3 shell.py serve [PORT [WORKERS]]',
         '  R1, R2, R3: regular expression',
+        '  F1, F2: fields to show, of id, created, modified, name, pwd, site, desc',
+        '  FILE: CSV with header "pwd,name,site,desc", JSON list of records,',
+        '        or encrypted file exported',
+        '  HASHES: SHA-1 hashes of breached passwords, one per line',
+        '  ACTION, ARGS: any of the above, to be timed',
+        '  While an agent runs, %s are served by it' % ', '.join(AGENT_ACTIONS),
     ]) # help_msg = '\n'.join([ ... ])
 
+    func = ACTIONS.get(sys.argv[1].strip()) if len(sys.argv) > 1 else None
+    if func is None:
+        print(help_msg)
+        return
+    # if func is None
+
+    # Hand over to the running agent, if any
+    if sys.argv[1].strip() in AGENT_ACTIONS and os.path.exists(AGENT_SOCK):
+        import agent
+        remote = agent.connect(AGENT_SOCK)
+        if remote is not None:
+            with remote:
+                func(remote, sys.argv[2:])
+            # with remote
+            return
+        # if remote is not None
+    # if sys.argv[1].strip() in AGENT_ACTIONS and ...
+
     # Check keys
     key = None
-    if not os.path.exists(KEY_PATH):
-        os.makedirs(KEY_PATH)
-    # if not os.path.exists(KEY_PATH)
     key_file = os.path.join(KEY_PATH, KEY_FILE)
     if os.path.exists(key_file):    # Get key from file
         f = open(key_file, 'r')
@@ -238,24 +700,24 @@ def main():
             key = getpass.getpass('Empty, try again:').strip()
             cnt += 1
         # while key == ''
+        os.makedirs(KEY_PATH, exist_ok=True)
         f = open(key_file, 'w')
         f.write(key + '\n')
         f.close()
     # else - if os.path.exists(key_file)
 
-    # Initialize wallet
-    wallet = Wallet(key)
-
-    func = None
-    try:
-        func = getattr(sys.modules[__name__], 'action_%s' % sys.argv[1].strip())
-    except:
-        print(help_msg)
-        func = None
-    # try - except
-    if func:
+    # Initialize wallet - sharded, once "reshard" is run
+    concurrent = sys.argv[1].strip() in CONCURRENT_ACTIONS or \
+                 os.environ.get('WALLET_CONCURRENT', '') not in ('', '0')
+    if os.path.exists(os.path.join(KEY_PATH, 'data.0')):
+        from sharded import ShardedWallet
+        wallet = ShardedWallet(key, concurrent=concurrent)
+    else:
+        wallet = Wallet(key, concurrent=concurrent)
+    # else - if os.path.exists(os.path.join(KEY_PATH, 'data.0'))
+    with wallet:
         func(wallet, sys.argv[2:])
-    # if func
+    # with wallet
 # def main()
 
 
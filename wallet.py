@@ -4,15 +4,338 @@ The password wallet
 @author:  MarcoXZh3
 @version: 0.0.1
 '''
+import contextlib
+import functools
 import os
 import random
 import re
 import sqlite3
 import time
-from datetime import datetime
+from itertools import islice, repeat
 from encryption import Cipher
 
 
+def cipher_chunk(key, method, items, *args):
+    '''
+    Run a batch method of the cipher on a chunk of items, in a worker process
+    @param {str}    key     key of the cipher
+    @param {str}    method  name of the batch method, e.g. "encrypt_many"
+    @param {list}   items   the chunk of items
+    @param {list}   args    other arguments of the method
+    @return {list}          the results, one for each item
+    '''
+    return getattr(Cipher(key), method)(items, *args)
+# def cipher_chunk(key, method, items, *args)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(expr):
+    '''
+    Compile a regular expression, cached for the REGEXP function of SQLite
+    @param {str}    expr    the regular expression
+    @return {Pattern}       the compiled regular expression
+    '''
+    return re.compile(expr)
+# def compile_regex(expr)
+
+
+def escape_glob(text):
+    '''
+    Escape the text for GLOB of SQLite, so that it matches verbatim
+    @param {str}    text    the text
+    @return {str}           the escaped text
+    '''
+    return ''.join(['[%s]' % c if c in '*?[' else c for c in text])
+# def escape_glob(text)
+
+
+def split_literal(expr):
+    '''
+    Split the leading literal text off a regular expression
+    @param {str}    expr    the regular expression
+    @return {tuple}         (literal, rest) - the text matched verbatim, and
+                            the rest of the regular expression
+    '''
+    chars = []
+    starts = []
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if c == '\\' and i + 1 < len(expr) and not expr[i+1].isalnum():
+            chars.append(expr[i+1])
+            starts.append(i)
+            i += 2
+        elif c == '\\' or c in '.^$*+?{}[]|()':
+            break
+        else:
+            chars.append(c)
+            starts.append(i)
+            i += 1
+        # else - if ... elif
+    # while i < len(expr)
+
+    # A quantifier applies to the last character, which is not literal then
+    if i < len(expr) and expr[i] in '*+?{' and chars:
+        chars.pop()
+        i = starts.pop()
+    # if i < len(expr) and expr[i] in '*+?{' and chars
+    return (''.join(chars), expr[i:])
+# def split_literal(expr)
+
+
+def save_records(cipher, path, records):
+    '''
+    Export records, with passwords decrypted, to an encrypted file in the
+    streaming format - one JSON record per line
+    @param {Cipher}     cipher  the cipher to encrypt the file by
+    @param {str}        path    the path of the file
+    @param {iterable}   records the records, with passwords decrypted
+    @return {int}               number of records exported
+    '''
+    import json
+    cnt = [0]
+    def lines():
+        for record in records:
+            cnt[0] += 1
+            yield (json.dumps(dict(record.items()), ensure_ascii=False) + \
+                   '\n').encode()
+        # for record in records
+    # def lines()
+    cipher.save_stream(path, lines())
+    return cnt[0]
+# def save_records(cipher, path, records)
+
+
+def load_records(cipher, path, add_many, batch_size):
+    '''
+    Import the records from a file exported by "save_records", batch by
+    batch. The whole file is authenticated first, so that nothing is added
+    from one that is damaged
+    @param {Cipher}     cipher      the cipher to decrypt the file by
+    @param {str}        path        the path of the file
+    @param {function}   add_many    called to add each batch of records, as
+                                    "Wallet.add_many"
+    @param {int}        batch_size  number of records to add at once
+    @return {list}                  the results of "add_many", for each of the
+                                    records
+    '''
+    import json
+    for _ in cipher.load_stream(path):
+        pass
+    # for _ in cipher.load_stream(path)
+    results = []
+    records = []
+    rest = b''
+    for chunk in cipher.load_stream(path):
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        records += [json.loads(line.decode()) for line in lines if line]
+        if len(records) >= batch_size:
+            results += add_many(records)
+            records = []
+        # if len(records) >= batch_size
+    # for chunk in cipher.load_stream(path)
+    if rest.strip():
+        records.append(json.loads(rest.decode()))
+    # if rest.strip()
+    return results + add_many(records)
+# def load_records(cipher, path, add_many, batch_size)
+
+
+def match_digests(cipher, digests, known, batch_size):
+    '''
+    Fingerprint SHA-1 digests of passwords batch by batch, and keep those
+    among the fingerprints known
+    @param {Cipher}     cipher      the cipher to fingerprint by
+    @param {iterable}   digests     the SHA-1 digests, as hex
+    @param {dict}       known       the fingerprints known, as keys
+    @param {int}        batch_size  number of digests to fingerprint at once
+    @return {set}                   the fingerprints matched
+    '''
+    found = set()
+    digests = iter(digests)
+    batch = list(islice(digests, batch_size))
+    while batch:
+        found.update([fp for fp in cipher.fingerprint_digests(batch) \
+                      if fp in known])
+        batch = list(islice(digests, batch_size))
+    # while batch
+    return found
+# def match_digests(cipher, digests, known, batch_size)
+
+
+def sort_groups(groups):
+    '''
+    Sort the groups of records sharing passwords, the largest first
+    @param {dict}   groups  lists of Records, by fingerprint
+    @return {list}          the lists of Records
+    '''
+    return sorted(groups.values(), key=lambda g: (-len(g), g[0]['id'], ))
+# def sort_groups(groups)
+
+
+class Record(object):
+    '''
+    A record found, read by key as a dict, or as attributes. It keeps the row
+    as fetched, with the positions of the columns shared by all the records of
+    a search, so that it takes a fraction of the memory of a dict
+    '''
+    __slots__ = ('fields', 'index', 'row')
+
+
+    def __init__(self, fields, index, row):
+        '''
+        Initialize the record
+        @param {tuple}  fields  names of the fields shown, as the keys
+        @param {dict}   index   positions in the row, by name of the column -
+                                of those read but not shown as well
+        @param {tuple}  row     the row
+        '''
+        self.fields = fields
+        self.index = index
+        self.row = row
+    # def __init__(self, fields, index, row)
+
+
+    def __getitem__(self, key):
+        '''
+        Get a field
+        @param {str}    key     name of the field
+        @return {object}        value of the field
+        '''
+        return self.row[self.index[key]]
+    # def __getitem__(self, key)
+
+
+    def __setitem__(self, key, value):
+        '''
+        Set a field, as a dict - one not read yet is added to this record
+        alone, with a copy of the positions shared by the others
+        @param {str}    key     name of the field
+        @param {object} value   value of the field
+        '''
+        if key not in self.index:
+            self.index = dict(self.index)
+            self.index[key] = len(self.row)
+            self.row += (value, )
+        else:
+            i = self.index[key]
+            self.row = self.row[:i] + (value, ) + self.row[i+1:]
+        # else - if key not in self.index
+        if key not in self.fields:
+            self.fields += (key, )
+        # if key not in self.fields
+    # def __setitem__(self, key, value)
+
+
+    def __getattr__(self, name):
+        '''
+        Get a field as an attribute
+        @param {str}    name    name of the field
+        @return {object}        value of the field
+        '''
+        if name in self.__slots__:  # not set yet
+            raise AttributeError(name)
+        # if name in self.__slots__
+        try:
+            return self.row[self.index[name]]
+        except KeyError:
+            raise AttributeError(name)
+        # try - except KeyError
+    # def __getattr__(self, name)
+
+
+    def __contains__(self, key):
+        '''
+        Check whether a field is shown
+        @param {str}    key     name of the field
+        @return {bool}          whether the field is shown
+        '''
+        return key in self.fields
+    # def __contains__(self, key)
+
+
+    def __iter__(self):
+        '''
+        Iterate over the names of the fields shown, as a dict
+        @return {iterator}      names of the fields
+        '''
+        return iter(self.fields)
+    # def __iter__(self)
+
+
+    def __len__(self):
+        '''
+        Number of the fields shown
+        @return {int}           number of the fields
+        '''
+        return len(self.fields)
+    # def __len__(self)
+
+
+    def __eq__(self, other):
+        '''
+        Compare with another record, or a dict
+        @param {object} other   the record, or dict
+        @return {bool}          whether the fields shown are equal
+        '''
+        if isinstance(other, Record):
+            other = dict(other.items())
+        # if isinstance(other, Record)
+        return dict(self.items()) == other
+    # def __eq__(self, other)
+
+    __hash__ = None     # mutable, as a dict
+
+
+    def keys(self):
+        '''
+        Names of the fields shown
+        @return {tuple}         names of the fields
+        '''
+        return self.fields
+    # def keys(self)
+
+
+    def values(self):
+        '''
+        Values of the fields shown
+        @return {list}          values of the fields
+        '''
+        return [self.row[self.index[k]] for k in self.fields]
+    # def values(self)
+
+
+    def items(self):
+        '''
+        Names and values of the fields shown
+        @return {list}          (name, value) of the fields
+        '''
+        return [(k, self.row[self.index[k]]) for k in self.fields]
+    # def items(self)
+
+
+    def get(self, key, default=None):
+        '''
+        Get a field shown, or the default
+        @param {str}    key     name of the field
+        @param {object} default value if the field is not shown
+        @return {object}        value of the field, or the default
+        '''
+        return self.row[self.index[key]] if key in self.fields else default
+    # def get(self, key, default=None)
+
+
+    def __repr__(self):
+        '''
+        To string, as a dict
+        @returns {str}      the string format of the record
+        '''
+        return repr(dict(self.items()))
+    # def __repr__(self)
+# class Record(object)
+
+
 class Wallet(object):
     '''
     The wallet class
@@ -23,75 +346,769 @@ class Wallet(object):
         'NOT_FOUND':    1,
         'FAILED':       2,
     } # CODES = { ... }
+    PARALLEL_MIN = 256  # fewer items than this are not worth the process pool
+    BATCH_SIZE   = 256  # rows per batch when streaming search results
+    SEARCH_BATCH = 4096 # rows per batch when collecting all search results
+    FTS_MIN      = 3    # shortest substring the trigram index can look up
+    BUSY_TIMEOUT = 5.0  # seconds to wait for a lock, in the concurrent mode
+    RETRIES      = 5    # attempts of a write locked out, in the concurrent mode
+    BACKOFF      = 0.05 # seconds to wait before the first retry, then doubled
+    WRITES = ('add', 'add_many', 'delete_many', 'update_many', 'migrate',
+              'rekey', 'fingerprint')
+    HIDDEN = ('kid', 'fp')  # columns kept from the records found
+    TIMED = ('search', 'iter_search', 'explain', 'add', 'add_many', 'delete',
+             'delete_many', 'update', 'update_many', 'migrate', 'rekey',
+             'fingerprint', 'find_reused', 'find_breached', 'backup',
+             'restore', 'commit')
 
 
-    def __init__(self, key, db_name='data', table_name='data'):
+    def __init__(self, key, db_name='data', table_name='data', workers=None,
+                 metrics=None, cache=None, fts=False, concurrent=False,
+                 fingerprints=False):
         '''
         Initialize the wallet
         @param {str}    key         key to unlock the wallet
         @param {str}    db_name     name of the database
         @param {str}    table_name  name of the table
+        @param {int}    workers     size of the process pool for batch cipher
+                                    work, default to the number of CPU cores
+        @param {Metrics} metrics    where to record timings and counts of the
+                                    operations, optional
+        @param {PlainCache} cache   where to cache the decrypted passwords,
+                                    optional
+        @param {bool}   fts         whether to create the full-text index of
+                                    substrings, if not yet - once created, it
+                                    is kept and used anyway
+        @param {bool}   concurrent  whether to share the database with other
+                                    processes writing at the same time - in
+                                    WAL mode, waiting for locks, and retrying
+                                    the writes still locked out
+        @param {bool}   fingerprints    whether to create the index of keyed
+                                    fingerprints of the passwords, if not yet -
+                                    once created, it is kept and maintained
         '''
         folder = 'dist'
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+        os.makedirs(folder, exist_ok=True)
         self.key = key
         self.cipher = Cipher(key)
+        self._kid = None
         self.db = folder + '/' + db_name
         self.table = table_name
-    # def __init__(self, key, db_name='data', table_name='data')
+        self.conn = None
+        self.cols = None
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.cache = cache
+        self.fts = fts
+        self.fingerprints = fingerprints
+        self.concurrent = concurrent
+        self.grouped = 0
+        if concurrent:
+            for name in self.WRITES:
+                setattr(self, name, self.retrying(getattr(self, name)))
+            # for name in self.WRITES
+        # if concurrent
+        self.metrics = None
+        if metrics is not None:
+            self.instrument(metrics)
+        # if metrics is not None
+    # def __init__(self, key, db_name='data', ..., fingerprints=False)
+
+
+    @property
+    def kid(self):
+        '''
+        The id of the key, told on first use - only writes need it
+        @returns {str}          the id of the key
+        '''
+        if self._kid is None:
+            self._kid = self.cipher.key_id()
+        # if self._kid is None
+        return self._kid
+    # def kid(self)
 
 
-    def search(self, pattern=None, show=False):
+    def instrument(self, metrics):
+        '''
+        Record timings of the methods, and counts of the SQL statements, regex
+        evaluations, encryption and decryption. Nothing is recorded, nor does
+        it cost anything, until this is called
+        @param {Metrics}    metrics     where to record them
+        '''
+        self.metrics = metrics
+        self.cipher.instrument(metrics)
+        for name in self.TIMED:
+            setattr(self, name, metrics.wrap(name, getattr(self, name)))
+        # for name in self.TIMED
+        if self.conn is not None:
+            self.trace(self.conn)
+        # if self.conn is not None
+    # def instrument(self, metrics)
+
+
+    def trace(self, conn):
+        '''
+        Count the SQL statements and time the regex evaluations of a connection
+        @param {Connection} conn    the connection
+        '''
+        metrics = self.metrics
+        conn.set_trace_callback(lambda sql: metrics.count('sql'))
+        def regexp(expr, item):
+            start = time.perf_counter()
+            found = compile_regex(expr).search(item) is not None
+            metrics.record('regex', time.perf_counter() - start)
+            return found
+        # def regexp(expr, item)
+        conn.create_function('REGEXP', 2, regexp)
+    # def trace(self, conn)
+
+
+    def stats(self):
+        '''
+        Report the timings and counts recorded
+        @return {dict}              counts, and timings with histograms keyed by
+                                    operation - empty if not instrumented
+        '''
+        if self.metrics is None:
+            return {}
+        # if self.metrics is None
+        report = self.metrics.report()
+        report['counts']['cipher_cache_hits'] = self.cipher.cache_hits
+        if self.cache is not None:
+            report['counts']['plain_cache_hits'] = self.cache.hits
+            report['counts']['plain_cache_misses'] = self.cache.misses
+        # if self.cache is not None
+        return report
+    # def stats(self)
+
+
+    def cache_info(self):
+        '''
+        Statistics of the cache of decrypted passwords
+        @return {dict}              hits, misses, hit ratio and size of the
+                                    cache - None if not cached
+        '''
+        return None if self.cache is None else self.cache.info()
+    # def cache_info(self)
+
+
+    def connect(self):
+        '''
+        Open the connection, if not yet, and prepare the schema once
+        @return {Connection}        the connection to the database
+        '''
+        if self.conn is not None:
+            return self.conn
+        # if self.conn is not None
+        start = time.perf_counter()
+        if self.concurrent:     # readers and the writer do not block each other
+            conn = sqlite3.connect(self.db, timeout=self.BUSY_TIMEOUT)
+            conn.execute('PRAGMA journal_mode=WAL;')
+            conn.execute('PRAGMA synchronous=NORMAL;')
+        else:
+            conn = sqlite3.connect(self.db)
+        # else - if self.concurrent
+
+        # Define regex function for SQLite
+        conn.create_function('REGEXP', 2,
+                             lambda expr, item:\
+                                compile_regex(expr).search(item) is not None)
+
+        # Create the table and its indexes if not exist
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS %s (
+                id          INTEGER PRIMARY KEY,
+                created     INTEGER,
+                modified    INTEGER,
+                name        TEXT NOT NULL,
+                pwd         BLOB,
+                site        TEXT NOT NULL,
+                desc        TEXT,
+                kid         TEXT,
+                fp          TEXT,
+                UNIQUE(name, site)
+            );
+        ''' % self.table) # conn.execute(''' ... ''')
+        found = [col[1] for col in \
+                 conn.execute('PRAGMA table_info(%s);' % self.table)]
+        for col in self.HIDDEN:
+            if col not in found:    # saved by earlier versions - unknown
+                conn.execute('ALTER TABLE %s ADD COLUMN %s TEXT;' % \
+                             (self.table, col))
+            # if col not in found
+        # for col in self.HIDDEN
+        for col in ('name', 'site'):
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s);' % \
+                         (self.table, col, self.table, col))
+        # for col in ('name', 'site')
+
+        # Create the table of the next "~N" suffix for each name-site
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS %s_suffix (
+                name        TEXT NOT NULL,
+                site        TEXT NOT NULL,
+                next        INTEGER,
+                PRIMARY KEY(name, site)
+            );
+        ''' % self.table) # conn.execute(''' ... ''')
+
+        # Create the table of the progress of re-keying
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS %s_rekey (
+                old         TEXT,
+                new         TEXT,
+                last        INTEGER
+            );
+        ''' % self.table) # conn.execute(''' ... ''')
+
+        # Create the full-text index if asked, and use it whenever it is there
+        if self.fts:
+            self.create_index(conn)
+        # if self.fts
+        self.fts = conn.execute(
+            'SELECT 1 FROM sqlite_master WHERE type=? AND name=?;',
+            ('table', '%s_fts' % self.table, )).fetchone() is not None
+
+        # Likewise the index of fingerprints, filled by "fingerprint"
+        if self.fingerprints:
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_fp ON %s (fp);' % \
+                         (self.table, self.table))
+        # if self.fingerprints
+        self.fingerprints = conn.execute(
+            'SELECT 1 FROM sqlite_master WHERE type=? AND name=?;',
+            ('index', '%s_fp' % self.table, )).fetchone() is not None
+        conn.commit()
+
+        # Cache the column layout
+        self.cols = [col[1] for col in \
+                     conn.execute('PRAGMA table_info(%s);' % self.table) \
+                     if col[1] not in self.HIDDEN]
+        self.conn = conn
+        if self.metrics is not None:
+            self.trace(conn)
+            self.metrics.record('connect', time.perf_counter() - start)
+        # if self.metrics is not None
+        return conn
+    # def connect(self)
+
+
+    def create_index(self, conn):
+        '''
+        Create the full-text index of substrings of name, site and desc, if
+        not yet, with the triggers that keep it in sync with the table
+        @param {Connection} conn    the connection
+        @return {bool}              whether it is newly created, and filled
+        '''
+        fts = '%s_fts' % self.table
+        if conn.execute('SELECT 1 FROM sqlite_master WHERE type=? AND name=?;',
+                        ('table', fts, )).fetchone() is not None:
+            return False
+        # if conn.execute( ... ).fetchone() is not None
+        conn.execute('''
+            CREATE VIRTUAL TABLE %s USING fts5(
+                name, site, desc,
+                content='%s', content_rowid='id',
+                tokenize='trigram case_sensitive 1'
+            );
+        ''' % (fts, self.table)) # conn.execute(''' ... ''')
+        insert = 'INSERT INTO %s (rowid, name, site, desc) ' \
+                 'VALUES (new.id, new.name, new.site, new.desc);' % fts
+        delete = 'INSERT INTO %s (%s, rowid, name, site, desc) ' \
+                 'VALUES (\'delete\', old.id, old.name, old.site, old.desc);' % \
+                 (fts, fts)
+        conn.execute('CREATE TRIGGER %s_insert AFTER INSERT ON %s BEGIN %s END;' % \
+                     (fts, self.table, insert))
+        conn.execute('CREATE TRIGGER %s_delete AFTER DELETE ON %s BEGIN %s END;' % \
+                     (fts, self.table, delete))
+        conn.execute('CREATE TRIGGER %s_update AFTER UPDATE OF name, site, desc ' \
+                     'ON %s BEGIN %s %s END;' % (fts, self.table, delete, insert))
+        conn.execute('INSERT INTO %s (%s) VALUES (\'rebuild\');' % (fts, fts))
+        return True
+    # def create_index(self, conn)
+
+
+    def reindex(self):
+        '''
+        Create the full-text index of substrings if not yet, otherwise rebuild
+        it from the table
+        '''
+        conn = self.connect()
+        if not self.create_index(conn):
+            conn.execute('INSERT INTO %s_fts (%s_fts) VALUES (\'rebuild\');' % \
+                         (self.table, self.table))
+        # if not self.create_index(conn)
+        self.fts = True
+        self.commit()
+    # def reindex(self)
+
+
+    def commit(self):
+        '''
+        Commit the current transaction, unless grouped, then it is committed
+        once the group is over
+        '''
+        if self.grouped > 0:
+            return
+        # if self.grouped > 0
+        self.conn.commit()
+    # def commit(self)
+
+
+    @contextlib.contextmanager
+    def group(self):
+        '''
+        Group the writes within, so that they share one commit at the end, or
+        are rolled back all together on error. Groups may be nested
+        @return {Wallet}            the wallet itself
+        '''
+        self.connect()
+        self.grouped += 1
+        try:
+            yield self
+        except:
+            self.grouped -= 1
+            if self.grouped == 0:
+                self.conn.rollback()
+            # if self.grouped == 0
+            raise
+        # try - except
+        self.grouped -= 1
+        try:
+            self.commit()
+        except:     # not committed, so nothing is left pending either
+            if self.grouped == 0:
+                self.conn.rollback()
+            # if self.grouped == 0
+            raise
+        # try - except
+    # def group(self)
+
+
+    def retrying(self, func):
+        '''
+        Wrap a write method to retry it once rolled back, with backoff, if the
+        database is still locked by other processes after "BUSY_TIMEOUT". The
+        writes of a group are not retried one by one, but fail the group
+        @param {function}   func    the method
+        @return {function}          the wrapped method
+        '''
+        @functools.wraps(func)
+        def retried(*args, **kwargs):
+            delay = self.BACKOFF
+            for attempt in range(self.RETRIES):
+                try:
+                    return func(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if self.grouped > 0 or attempt == self.RETRIES - 1 or \
+                       not ('locked' in str(e) or 'busy' in str(e)):
+                        raise
+                    # if self.grouped > 0 or ...
+                    self.conn.rollback()
+                    if self.metrics is not None:
+                        self.metrics.count('retry')
+                    # if self.metrics is not None
+                    time.sleep(delay * random.uniform(0.5, 1.5))
+                    delay *= 2
+                # try - except sqlite3.OperationalError as e
+            # for attempt in range(self.RETRIES)
+        # def retried(*args, **kwargs)
+        return retried
+    # def retrying(self, func)
+
+
+    def close(self):
+        '''
+        Close the connection, shut down the process pool if any, and wipe the
+        cached passwords
+        '''
+        if self.cache is not None:
+            self.cache.clear()
+        # if self.cache is not None
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        # if self.conn is not None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        # if self.pool is not None
+    # def close(self)
+
+
+    def __enter__(self):
+        '''
+        Enter the context - open the connection
+        @return {Wallet}            the wallet itself
+        '''
+        self.connect()
+        return self
+    # def __enter__(self)
+
+
+    def __exit__(self, *args):
+        '''
+        Exit the context - close the connection
+        @param {list}   args        the exception info, to be ignored
+        '''
+        self.close()
+    # def __exit__(self, *args)
+
+
+    def map_cipher(self, method, items, *args):
+        '''
+        Run a batch method of the cipher over the items, split into chunks
+        across the process pool when there are enough of them
+        @param {str}    method  name of the batch method, e.g. "encrypt_many"
+        @param {list}   items   the items
+        @param {list}   args    other arguments of the method
+        @return {list}          the results, in the same order as the items
+        '''
+        if self.workers <= 1 or len(items) < self.PARALLEL_MIN:
+            return getattr(self.cipher, method)(items, *args)
+        # if self.workers <= 1 or len(items) < self.PARALLEL_MIN
+        if self.pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.workers)
+        # if self.pool is None
+
+        # A few chunks per worker to balance the load
+        size = max(-(-len(items) // (self.workers * 4)), self.PARALLEL_MIN // 4)
+        chunks = [items[i:i+size] for i in range(0, len(items), size)]
+        results = []
+        for chunk in self.pool.map(cipher_chunk, repeat(self.key),
+                                   repeat(method), chunks,
+                                   *[repeat(arg) for arg in args]):
+            results += chunk
+        # for chunk in self.pool.map( ... )
+        if self.metrics is not None:    # counted in the worker processes
+            self.metrics.count(method.split('_')[0], len(items))
+        # if self.metrics is not None
+        return results
+    # def map_cipher(self, method, items, *args)
+
+
+    def exists(self, name, site):
+        '''
+        Check whether a name-site is in use, by the unique index
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        @return {bool}          whether the name-site is in use
+        '''
+        return self.connect().execute(
+            'SELECT 1 FROM %s WHERE name=? AND site=?;' % self.table,
+            (name, site, )).fetchone() is not None
+    # def exists(self, name, site)
+
+
+    def rename(self, name, site, taken=None):
+        '''
+        Rename "name" with a free "~N" suffix, if name-site is in use. The next
+        "N" is kept per name-site, so that it takes no scan of the records
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        @param {set}    taken   name-site pairs in use but not saved yet
+        @return {str}           the name free to use
+        '''
+        taken = taken or set()
+        if (name, site, ) not in taken and not self.exists(name, site):
+            return name
+        # if (name, site, ) not in taken and not self.exists(name, site)
+        regex = r'\%s\d+$' % self.SEPARATOR
+        base = self.SEPARATOR.join(re.split(regex, name)[:-1]) \
+               if re.search(regex, name) else name
+
+        # Find the next "N", or start with the largest "N" in use
+        row = self.conn.execute(
+            'SELECT next FROM %s_suffix WHERE name=? AND site=?;' % self.table,
+            (base, site, )).fetchone()
+        if row is None:
+            cnt = 2
+            for other, in self.conn.execute(
+                    'SELECT name FROM %s WHERE site=? AND name GLOB ?;' % \
+                    self.table,
+                    (site, escape_glob(base + self.SEPARATOR) + '[0-9]*', )):
+                suffix = other[len(base) + len(self.SEPARATOR):]
+                if suffix.isdigit():
+                    cnt = max(cnt, int(suffix) + 1)
+                # if suffix.isdigit()
+            # for other, in self.conn.execute( ... )
+        else:
+            cnt = row[0]
+        # else - if row is None
+
+        # Skip those taken otherwise, e.g. named by hand
+        name = '%s%s%d' % (base, self.SEPARATOR, cnt)
+        while (name, site, ) in taken or self.exists(name, site):
+            cnt += 1
+            name = '%s%s%d' % (base, self.SEPARATOR, cnt)
+        # while (name, site, ) in taken or self.exists(name, site)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO %s_suffix (name, site, next) ' \
+            'VALUES (?, ?, ?);' % self.table, (base, site, cnt + 1, ))
+        return name
+    # def rename(self, name, site, taken=None)
+
+
+    def forget(self, id, name=None, site=None):
+        '''
+        Invalidate the cached password of a record, if cached at all
+        @param {int}    id      id of the record, or None to find by name-site
+        @param {str}    name    name of the record
+        @param {str}    site    site of the record
+        '''
+        if self.cache is None:
+            return
+        # if self.cache is None
+        if not id or id <= 0:
+            row = self.connect().execute(
+                'SELECT id FROM %s WHERE name=? AND site=?;' % self.table,
+                (name, site, )).fetchone()
+            if row is None:
+                return
+            # if row is None
+            id = row[0]
+        # if not id or id <= 0
+        self.cache.discard([id])
+    # def forget(self, id, name=None, site=None)
+
+
+    def plan(self, col, expr):
+        '''
+        Plan the cheapest SQL predicate to filter a column by a regex pattern:
+        "=" for anchored literals, GLOB for literal prefixes, the full-text
+        index or "instr" for literal substrings, and REGEXP only for what is
+        left
+        @param {str}    col     the column
+        @param {str}    expr    the regular expression
+        @return {tuple}         (kind of the plan, predicates, values)
+        '''
+        regexp = ('regexp', ['%s REGEXP ?' % col], [expr])
+        if '|' in expr:             # alternation - no literal to rely on
+            return regexp
+        # if '|' in expr
+        anchored = expr.startswith('^') or expr.startswith('\\A')
+        literal, rest = split_literal(expr[2 if expr.startswith('\\A') else \
+                                           1 if anchored else 0:])
+
+        if anchored and rest == '\\Z':
+            return ('equal', ['%s = ?' % col], [literal])
+        # if anchored and rest == '\\Z'
+        if anchored and rest == '$':    # "$" matches before a final newline
+            return ('equal', ['%s IN (?, ?)' % col],
+                    [literal, literal + '\n'])
+        # if anchored and rest == '$'
+        if anchored and literal:
+            glob = escape_glob(literal)
+            if rest == '':
+                return ('prefix', ['%s GLOB ?' % col], [glob + '*'])
+            # if rest == ''
+            return ('prefix+regexp', ['%s GLOB ?' % col, '%s REGEXP ?' % col],
+                    [glob + '*', expr])
+        # if anchored and literal
+        if not anchored and rest == '' and self.fts and \
+           len(literal) >= self.FTS_MIN:
+            return ('substring+fts', ['id IN (SELECT rowid FROM %s_fts ' \
+                                      'WHERE %s_fts MATCH ?)' % \
+                                      (self.table, self.table),
+                                      'instr(%s, ?) > 0' % col],
+                    ['{%s} : "%s"' % (col, literal.replace('"', '""')), literal])
+        # if not anchored and rest == '' and ...
+        if not anchored and rest == '':
+            return ('substring', ['instr(%s, ?) > 0' % col], [literal])
+        # if not anchored and rest == ''
+        return regexp
+    # def plan(self, col, expr)
+
+
+    def columns(self, fields=None, show=False):
+        '''
+        Tell the columns to read for the fields asked - with "pwd" to show, and
+        what the cache of decrypted passwords is keyed by
+        @param {list}   fields      names of the fields, or None for all
+        @param {bool}   show        whether to decrypt "pwd"
+        @return {tuple}             (columns to read, fields to show)
+        '''
+        self.connect()
+        if fields is None:
+            fields = tuple(self.cols)
+        else:
+            fields = tuple(fields)
+            unknown = [f for f in fields if f not in self.cols]
+            if unknown:
+                raise ValueError('Unknown fields: %s' % ', '.join(unknown))
+            # if unknown
+            if show and 'pwd' not in fields:
+                fields += ('pwd', )
+            # if show and 'pwd' not in fields
+        # else - if fields is None
+        cols = fields
+        if show and self.cache is not None:
+            cols += tuple([c for c in ('id', ) if c not in fields])
+        # if show and self.cache is not None
+        return (cols, fields, )
+    # def columns(self, fields=None, show=False)
+
+
+    def query(self, pattern=None, cols=None):
+        '''
+        Build the query of the records matching the filter regex pattern
+        @param {dict}   pattern     the patterns for filtering
+        @param {list}   cols        the columns to read, default to all
+        @return {tuple}             (SQL, values, plans of the columns)
+        '''
+        self.connect()
+        cols = cols or self.cols
+        if not pattern:
+            return ('SELECT %s FROM %s;' % (', '.join(cols), self.table),
+                    [], [])
+        # if not pattern
+        condisions = []
+        values = []
+        plans = []
+        for k, v in pattern.items():
+            kind, preds, vals = self.plan(k, v)
+            condisions += preds
+            values += vals
+            plans.append((k, v, kind, ' AND '.join(preds)))
+        # for k, v in pattern.items()
+        return ('SELECT %s FROM %s WHERE %s;' % \
+                (', '.join(cols), self.table, ' AND '.join(condisions)),
+                values, plans)
+    # def query(self, pattern=None)
+
+
+    def explain(self, pattern=None):
+        '''
+        Explain how the records matching the filter regex pattern are found
+        @param {dict}   pattern     the patterns for filtering
+        @return {list}              lines of the plans of the columns, followed
+                                    by the query plan of SQLite
+        '''
+        sql, values, plans = self.query(pattern)
+        lines = ['%s=%s: %s -- %s' % plan for plan in plans]
+        for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, values):
+            lines.append('SQLite: %s' % row[-1])
+        # for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, values)
+        return lines
+    # def explain(self, pattern=None)
+
+
+    def search(self, pattern=None, show=False, fields=None):
         '''
         Find all password matching the filter regex pattern.
         If pwd provided, then return decrypted "pwd" field
         @param {dict}   pattern     the patterns for filtering
         @param {str}    pwd         the owner password
-        @return {list}              the list of target passwords
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {list}              the list of target passwords, as Records
         '''
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
+        return list(self.iter_search(pattern, show, self.SEARCH_BATCH, fields))
+    # def search(self, pattern=None, show=False, fields=None)
 
-        # Find the "pwd" column
-        cols = cur.execute('PRAGMA table_info(%s);' % self.table).fetchall()
 
-        # Query the records
-        if not pattern:
-            rows = cur.execute('SELECT * FROM %s;' % self.table).fetchall()
-        else:
-            # Define regex function for SQLite
-            conn.create_function('REGEXP', 2,
-                                 lambda expr, item:\
-                                    re.compile(expr).search(item) is not None)
-            condisions = []
-            regexes = []
-            for k, v in pattern.items():
-                condisions.append('%s REGEXP ?' % k)
-                regexes.append(v)
-            # for k, v in pattern.items()
-            rows = cur.execute('SELECT * FROM %s WHERE %s;' %
-                               (self.table, ' AND '.join(condisions)),
-                               regexes \
-            ).fetchall() # rows = cur.execute( ... ).fetchall()
-        # else - if not pattern
-
-        # Prepare the records, with "pwd" decrypted
-        results = []
-        for row in rows:
-            record = {}
-            for i, col in enumerate(cols):
-                record[col[1]] = row[i]
-            # for i, col in enumerate(cols)
+    def iter_search(self, pattern=None, show=False, batch_size=None,
+                    fields=None):
+        '''
+        Stream all password matching the filter regex pattern, batch by batch.
+        If show, then yield decrypted "pwd" field
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {int}    batch_size  number of rows to fetch and decrypt at once
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {generator}         the target passwords, one by one, as
+                                    Records
+        '''
+        # Decrypt those not cached - in parallel chunks when there are many
+        for results, misses in self.iter_batches(pattern, show, batch_size,
+                                                 fields):
+            if misses:
+                self.remember(misses, self.map_cipher(
+                    'decrypt_many', [r['pwd'] for r in misses]))
+            # if misses
+            for record in results:
+                yield record
+            # for record in results
+        # for results, misses in self.iter_batches( ... )
+    # def iter_search(self, pattern=None, show=False, ..., fields=None)
+
+
+    def iter_batches(self, pattern=None, show=False, batch_size=None,
+                     fields=None):
+        '''
+        Stream the records matching the filter regex pattern, batch by batch.
+        If show, then with the cached passwords filled in, and those left to
+        be decrypted told apart
+        @param {dict}   pattern     the patterns for filtering
+        @param {bool}   show        whether to decrypt "pwd"
+        @param {int}    batch_size  number of rows to fetch at once
+        @param {list}   fields      names of the fields to read, default to
+                                    all - with "pwd" as well if shown
+        @return {generator}         (Records, those of them whose "pwd" is to
+                                    be decrypted) of each batch
+        '''
+        # Query the records, only the columns needed - with the ids of their
+        # keys while a re-key is in progress
+        cols, fields = self.columns(fields, show)
+        rekey = self.rekeying() if show else None
+        if rekey is not None:
+            cols += ('kid', )
+        # if rekey is not None
+        index = dict([(col, i) for i, col in enumerate(cols)])
+        sql, values = self.query(pattern, cols)[:2]
+        fetch = self.connect().execute
+        if self.metrics is not None:
+            fetch = self.metrics.wrap('query', fetch)
+        # if self.metrics is not None
+        cur = fetch(sql, values)
+        fetch = cur.fetchmany
+        if self.metrics is not None:
+            fetch = self.metrics.wrap('query', fetch)
+        # if self.metrics is not None
+
+        # Prepare the records batch by batch, with "pwd" from the cache
+        rows = fetch(batch_size or self.BATCH_SIZE)
+        while rows:
+            results = [Record(fields, index, row) for row in rows]
+            misses = []
             if show:
-                record['pwd'] = self.cipher.decrypt(record['pwd'])
+                misses = results
+                if self.cache is not None:
+                    misses = []
+                    for record in results:
+                        pwd = self.cache.get(record['id'], record['pwd'])
+                        if pwd is None:
+                            misses.append(record)
+                        else:
+                            record['pwd'] = pwd
+                        # else - if pwd is None
+                    # for record in results
+                # if self.cache is not None
+                if rekey is not None:
+                    self.check_keys(misses, rekey)
+                # if rekey is not None
             # if show
-            results.append(record)
-        # for row in rows
-        conn.close()
+            yield (results, misses, )
+            rows = fetch(batch_size or self.BATCH_SIZE)
+        # while rows
+        cur.close()
+    # def iter_batches(self, pattern=None, show=False, ..., fields=None)
 
-        return results
-    # def search(self, pattern=None, show=False)
+
+    def remember(self, records, pwds):
+        '''
+        Fill the decrypted passwords into their records, and cache them
+        @param {list}   records     the records, with "pwd" still encrypted
+        @param {list}   pwds        the decrypted passwords, one for each
+        '''
+        for record, pwd in zip(records, pwds):
+            if self.cache is not None:
+                self.cache.put(record['id'], record['pwd'], pwd)
+            # if self.cache is not None
+            record['pwd'] = pwd
+        # for record, pwd in zip(records, pwds)
+    # def remember(self, records, pwds)
 
 
     def add(self, pwd, name=None, site=None, desc=None):
@@ -119,55 +1136,107 @@ class Wallet(object):
             desc = ''
         # if desc is None
 
-        # Create the database if not exist
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS %s (
-                id          INTEGER PRIMARY KEY,
-                created     INTEGER,
-                modified    INTEGER,
-                name        TEXT NOT NULL,
-                pwd         BLOB,
-                site        TEXT NOT NULL,
-                desc        TEXT,
-                UNIQUE(name, site)
-            );
-        ''' % self.table) # cur.execute(''' ... ''')
-        conn.commit()
+        with self.group():
+            cur = self.connect().cursor()
 
-        # Prepare the data - when name-site provided, they should be new
-        rows = cur.execute('SELECT name, site FROM %s;' % self.table).fetchall()
-        if (old_name is not None and not old_name.strip() == '') and \
-           (old_site is not None and not old_site.strip() == '') and \
-           (old_name, old_site, ) in rows:
-            return (self.CODES['FAILED'], 'Record already exists')
-        # if ...
-        # Otherwise - rename "name" if necessary
-        cnt = 2
-        while (name, site, ) in rows:
-            regex = r'\%s\d+$' % self.SEPARATOR
-            old_name = self.SEPARATOR.join(re.split(regex, name)[:-1]) \
-                       if re.search(regex, name) else name
-            name = '%s%s%d' % (old_name, self.SEPARATOR, cnt)
-            cnt += 1
-        # while (name, site, ) in rows
-        created = int(time.mktime(datetime.now().timetuple()))
-        enc = self.cipher.encrypt(pwd)
-
-        # Save the data
-        cur.execute('''
-            INSERT INTO %s (created, modified, name, pwd, site, desc)
-                    VALUES (?, ?, ?, ?, ?, ?);
-            ''' % self.table, \
-            (created, created, name, sqlite3.Binary(enc), site, desc, ) \
-        ) # cur.execute(''' ... ''')
-        conn.commit()
-        conn.close()
+            # Prepare the data - when name-site provided, they should be new
+            if (old_name is not None and not old_name.strip() == '') and \
+               (old_site is not None and not old_site.strip() == '') and \
+               self.exists(old_name, old_site):
+                return (self.CODES['FAILED'], 'Record already exists')
+            # if ...
+            # Otherwise - rename "name" if necessary
+            name = self.rename(name, site)
+            created = int(time.time())
+            enc = self.cipher.encrypt(pwd)
+            fp = self.cipher.fingerprint_many([pwd])[0] if self.fingerprints \
+                 else None
+
+            # Save the data
+            cur.execute('''
+                INSERT INTO %s (created, modified, name, pwd, site, desc, kid, fp)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                ''' % self.table, \
+                (created, created, name, sqlite3.Binary(enc), site, desc,
+                 self.kid, fp, ) \
+            ) # cur.execute(''' ... ''')
+        # with self.group()
         return (self.CODES['SUCCEED'], 'Add password succeeded')
     # def add(self, pwd, name=None, site=None, desc=None)
 
 
+    def add_many(self, records):
+        '''
+        Add new passwords in bulk, within a single transaction
+        @param {list}   records     the records, each of which is either a
+                                    tuple of (pwd, name, site, desc) as in
+                                    "add", or a dict with those keys
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the records
+        '''
+        with self.group():
+            cur = self.connect().cursor()
+
+            # Verify and prepare the records, as in "add"
+            results = []
+            rows = []
+            taken = set()
+            for record in records:
+                if isinstance(record, dict):
+                    pwd, name, site, desc = [record.get(k) for k in \
+                                             ('pwd', 'name', 'site', 'desc')]
+                elif isinstance(record, (tuple, list)):
+                    pwd, name, site, desc = (tuple(record) + (None, ) * 4)[:4]
+                else:
+                    results.append((self.CODES['FAILED'], 'Invalid record to add'))
+                    continue
+                # else - if ... elif
+                if not all([v is None or isinstance(v, str) for v in \
+                            (pwd, name, site, desc)]):
+                    results.append((self.CODES['FAILED'],
+                                    'Non-text field of record to add'))
+                    continue
+                # if not all([ ... ])
+                if pwd is None or pwd.strip() == '':
+                    results.append((self.CODES['FAILED'], 'Empty password to add'))
+                    continue
+                # if pwd is None or pwd.strip() == ''
+                if (name is not None and not name.strip() == '') and \
+                   (site is not None and not site.strip() == '') and \
+                   ((name, site, ) in taken or self.exists(name, site)):
+                    results.append((self.CODES['FAILED'], 'Record already exists'))
+                    continue
+                # if ...
+                if name is None or name.strip() == '':
+                    name = 'Guest'
+                # if name is None or name.strip() == ''
+                if site is None or site.strip() == '':
+                    site = 'Default'
+                # if site is None or site.strip() == ''
+                name = self.rename(name, site, taken)
+                taken.add((name, site, ))
+                rows.append([name, pwd, site, desc or ''])
+                results.append((self.CODES['SUCCEED'], 'Add password succeeded'))
+            # for record in records
+
+            # Encrypt all passwords at once, then save them all
+            created = int(time.time())
+            encs = self.map_cipher('encrypt_many', [r[1] for r in rows])
+            fps = self.map_cipher('fingerprint_many', [r[1] for r in rows]) \
+                  if self.fingerprints else [None] * len(rows)
+            cur.executemany('''
+                INSERT INTO %s (created, modified, name, pwd, site, desc, kid, fp)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                ''' % self.table, \
+                [(created, created, name, sqlite3.Binary(enc), site, desc,
+                  self.kid, fp, ) for (name, _, site, desc), enc, fp in \
+                 zip(rows, encs, fps)] \
+            ) # cur.executemany(''' ... ''')
+        # with self.group()
+        return results
+    # def add_many(self, records)
+
+
     def delete(self, id=None, name=None, site=None, pwd=None, desc=None):
         '''
         Delete a password
@@ -178,41 +1247,64 @@ class Wallet(object):
         @param {str}    desc    description of the record
         @return {tuple}         (status code in CODES, supplement message)
         '''
-        # Verify parameters - either id or name-site is required
-        if not id or id <= 0:
-            if name is None or name.strip() == '':
-                return (self.CODES['FAILED'], 'Empty name to delete')
-            # if name is None or name.strip() == ''
-            if site is None or site.strip() == '':
-                return (self.CODES['FAILED'], 'Empty site to delete')
-            # if site is None or site.strip() == ''
-        # if not id or id <= 0
+        return self.delete_many([{ 'id': id, 'name': name, 'site': site }])[0]
+    # def delete(self, id=None, name=None, site=None, pwd=None, desc=None)
 
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
 
-        # Find the target record
-        if not id or id <= 0:
-            ids = cur.execute('SELECT id from %s WHERE name=? AND site=?;' % \
-                              self.table,
-                              (name, site, )).fetchall()
-            if len(ids) == 0:
-                return (self.CODES['NOT_FOUND'], 'No record found to delete')
-            # if len(ids) == 0
-            id = ids[0][0]
-        else:
-            ids = cur.execute('SELECT id from %s;' % self.table).fetchall()
-            if (id, ) not in ids:
-                return (self.CODES['NOT_FOUND'], 'No record found to delete')
-            # if (id, ) not in ids
-        # if not id or id <= 0
+    def delete_many(self, keys):
+        '''
+        Delete passwords in bulk, within a single transaction
+        @param {list}   keys    the keys of the records, each of which is either
+                                an id, a tuple of (name, site), or a dict with
+                                "id" or "name" and "site"
+        @return {list}          (status code in CODES, supplement message) for
+                                each of the keys
+        '''
+        with self.group():
+            cur = self.connect().cursor()
+            results = []
+            for key in keys:
+                if isinstance(key, dict):
+                    id, name, site = [key.get(k) for k in ('id', 'name', 'site')]
+                elif isinstance(key, (tuple, list)):
+                    id, name, site = (None, ) + (tuple(key) + (None, ) * 2)[:2]
+                else:
+                    id, name, site = key, None, None
+                # else - if ... elif
 
-        # Delete it
-        cur.execute('DELETE FROM %s WHERE id=?;' % self.table, (id, ))
-        conn.commit()
-        conn.close()
-        return (self.CODES['SUCCEED'], 'Delete password succeeded')
-    # def delete(self, id=None, name=None, site=None, pwd=None, desc=None)
+                # Verify parameters - either id or name-site is required
+                if not id or id <= 0:
+                    if name is None or name.strip() == '':
+                        results.append((self.CODES['FAILED'],
+                                        'Empty name to delete'))
+                        continue
+                    # if name is None or name.strip() == ''
+                    if site is None or site.strip() == '':
+                        results.append((self.CODES['FAILED'],
+                                        'Empty site to delete'))
+                        continue
+                    # if site is None or site.strip() == ''
+                # if not id or id <= 0
+
+                # Delete the target record, if found
+                self.forget(id, name, site)
+                if not id or id <= 0:
+                    cur.execute('DELETE FROM %s WHERE name=? AND site=?;' % \
+                                self.table, (name, site, ))
+                else:
+                    cur.execute('DELETE FROM %s WHERE id=?;' % self.table, (id, ))
+                # else - if not id or id <= 0
+                if cur.rowcount == 0:
+                    results.append((self.CODES['NOT_FOUND'],
+                                    'No record found to delete'))
+                else:
+                    results.append((self.CODES['SUCCEED'],
+                                    'Delete password succeeded'))
+                # else - if cur.rowcount == 0
+            # for key in keys
+        # with self.group()
+        return results
+    # def delete_many(self, keys)
 
 
     def update(self, id=None, name=None, site=None, pwd=None, desc=None):
@@ -225,78 +1317,439 @@ class Wallet(object):
         @param {str}    desc    description of the record
         @return {tuple}         (status code in CODES, supplement message)
         '''
-        # Verify parameters
-        if not id:  # name-site to search; password/description to be updated
-            if name is None or name.strip() == '':
-                return (self.CODES['FAILED'], 'Empty name to update')
-            # if name is None or name.strip() == ''
-            if site is None or site.strip() == '':
-                return (self.CODES['FAILED'], 'Empty site to update')
-            # if site is None or site.strip() == ''
-            if (pwd is None or pwd.strip() == '') and \
-               (desc is None or desc.strip() == ''):
-                return (self.CODES['FAILED'], 'Nothing to update')
-            # if ...
-        else:       # id to search; others to be updated
-            if (name is None or name.strip() == '') and \
-               (site is None or site.strip() == '') and \
-               (pwd is None or pwd.strip() == '') and \
-               (desc is None or desc.strip() == ''):
-                return (self.CODES['FAILED'], 'Nothing to update')
-            # if ...
-        # if not id
+        return self.update_many([(id, name, site, pwd, desc, )])[0]
+    # def update(self, id=None, name=None, site=None, pwd=None, desc=None)
 
-        conn = sqlite3.connect(self.db)
-        cur = conn.cursor()
 
-        # Prepare data while searching the target record
-        targets = []
-        values = []
-        if pwd:
-            targets.append('pwd=?')
-            values.append(self.cipher.encrypt(pwd))
-        # if password
-        if desc:
-            targets.append('desc=?')
-            values.append(desc)
-        # if desc
-
-        # Find the target record
-        if not id:
-            ids = cur.execute('SELECT id from %s WHERE name=? AND site=?;' % \
-                              self.table,
-                              (name, site, )).fetchall()
-            if len(ids) == 0:
-                return (self.CODES['NOT_FOUND'], 'No record found to update')
-            # if len(ids) == 0
-            id = ids[0][0]
+    def update_many(self, changes):
+        '''
+        Update passwords in bulk, within a single transaction
+        @param {list}   changes     the changes, each of which is either a
+                                    tuple of (id, name, site, pwd, desc) as in
+                                    "update", or a dict with those keys
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the changes
+        '''
+        results = [None] * len(changes)
+        checked = []
+        for i, change in enumerate(changes):
+            if isinstance(change, dict):
+                id, name, site, pwd, desc = [change.get(k) for k in \
+                                             ('id', 'name', 'site', 'pwd', 'desc')]
+            else:
+                id, name, site, pwd, desc = (tuple(change) + (None, ) * 5)[:5]
+            # else - if isinstance(change, dict)
+
+            # Verify parameters
+            if not id:  # name-site to search; password/description to be updated
+                if name is None or name.strip() == '':
+                    results[i] = (self.CODES['FAILED'], 'Empty name to update')
+                    continue
+                # if name is None or name.strip() == ''
+                if site is None or site.strip() == '':
+                    results[i] = (self.CODES['FAILED'], 'Empty site to update')
+                    continue
+                # if site is None or site.strip() == ''
+                if (pwd is None or pwd.strip() == '') and \
+                   (desc is None or desc.strip() == ''):
+                    results[i] = (self.CODES['FAILED'], 'Nothing to update')
+                    continue
+                # if ...
+            else:       # id to search; others to be updated
+                if (name is None or name.strip() == '') and \
+                   (site is None or site.strip() == '') and \
+                   (pwd is None or pwd.strip() == '') and \
+                   (desc is None or desc.strip() == ''):
+                    results[i] = (self.CODES['FAILED'], 'Nothing to update')
+                    continue
+                # if ...
+            # if not id
+            checked.append((i, id, name, site, pwd, desc, ))
+        # for i, change in enumerate(changes)
+
+        with self.group():
+            # Encrypt, and fingerprint if indexed, all new passwords at once
+            cur = self.connect().cursor()
+            pwds = [c[4] for c in checked if c[4]]
+            encs = iter(self.map_cipher('encrypt_many', pwds))
+            fps = iter(self.map_cipher('fingerprint_many', pwds) \
+                       if self.fingerprints else [None] * len(pwds))
+            modified = int(time.time())
+
+            for i, id, name, site, pwd, desc in checked:
+                # Prepare data
+                targets = []
+                values = []
+                if pwd:
+                    targets.append('pwd=?')
+                    values.append(next(encs))
+                    targets.append('kid=?')
+                    values.append(self.kid)
+                    targets.append('fp=?')
+                    values.append(next(fps))
+                # if password
+                if desc:
+                    targets.append('desc=?')
+                    values.append(desc)
+                # if desc
+                if id:      # name and/or site to be updated as well
+                    if name:
+                        targets.append('name=?')
+                        values.append(name)
+                    # if name
+                    if site:
+                        targets.append('site=?')
+                        values.append(site)
+                    # if site
+                # if id
+                targets.append('modified=?')
+                values.append(modified)
+
+                # Update the target record, if found
+                self.forget(id, name, site)
+                if not id:
+                    cur.execute('UPDATE %s SET %s WHERE name=? AND site=?;' % \
+                                (self.table, ', '.join(targets)),
+                                values + [name, site])
+                else:
+                    cur.execute('UPDATE %s SET %s WHERE id=?;' % \
+                                (self.table, ', '.join(targets)),
+                                values + [id])
+                # else - if not id
+                if cur.rowcount == 0:
+                    results[i] = (self.CODES['NOT_FOUND'],
+                                  'No record found to update')
+                else:
+                    results[i] = (self.CODES['SUCCEED'],
+                                  'Update password succeeded')
+                # else - if cur.rowcount == 0
+            # for i, id, name, site, pwd, desc in checked
+        # with self.group()
+        return results
+    # def update_many(self, changes)
+
+
+    def migrate(self, batch_size=None, vacuum=True):
+        '''
+        Rewrite the passwords in the salted format into the compact one, chunk
+        by chunk, each within a transaction of its own. Passwords too long for
+        the compact format stay as they are. Refused while a re-key is in
+        progress
+        @param {int}    batch_size  number of records to rewrite at once
+        @param {bool}   vacuum      whether to reclaim the space freed at last
+        @return {int}               number of passwords rewritten
+        '''
+        self.check_rekeying('migrating')
+        cur = self.connect().cursor()
+        batch_size = batch_size or self.SEARCH_BATCH
+        cnt = 0
+        last = 0
+        while True:
+            rows = cur.execute(
+                'SELECT id, pwd FROM %s WHERE id>? AND length(pwd)>=? ' \
+                'ORDER BY id LIMIT ?;' % self.table,
+                (last, self.cipher.DATA_LENGTH, batch_size, )).fetchall()
+            if not rows:
+                break
+            # if not rows
+            last = rows[-1][0]
+            encs = self.map_cipher('encrypt_many', self.map_cipher(
+                'decrypt_many', [row[1] for row in rows]))
+            changes = [(sqlite3.Binary(enc), row[0], ) for row, enc in \
+                       zip(rows, encs) if self.cipher.is_compact(enc)]
+            cur.executemany('UPDATE %s SET pwd=? WHERE id=?;' % self.table,
+                            changes)
+            self.commit()
+            cnt += len(changes)
+        # while True
+        if vacuum and cnt > 0:
+            self.conn.execute('VACUUM;')
+        # if vacuum and cnt > 0
+        return cnt
+    # def migrate(self, batch_size=None, vacuum=True)
+
+
+    def rekey(self, key, batch_size=None, progress=None):
+        '''
+        Re-encrypt all the passwords by a new key, chunk by chunk, in parallel
+        across the process pool. Each chunk is committed with the progress, so
+        that an interrupted run resumes when run again with the same keys -
+        meanwhile, the key of each record is told by its "kid"
+        @param {str}        key         the new key
+        @param {int}        batch_size  number of records to re-encrypt at once
+        @param {function}   progress    called as progress(done, total) after
+                                        each chunk, optional
+        @return {int}                   number of passwords re-encrypted
+        '''
+        conn = self.connect()
+        new = Cipher(key).key_id()
+        row = conn.execute('SELECT old, new, last FROM %s_rekey;' % \
+                           self.table).fetchone()
+        if row is not None and row[1] == self.kid:
+            raise ValueError('A re-key to this key is in progress, from key ' \
+                             '%s - resume it with the old key' % row[0])
+        # if row is not None and row[1] == self.kid
+        if row is not None and tuple(row[:2]) != (self.kid, new, ):
+            raise ValueError('Another re-key is in progress, from key %s to %s' % \
+                             tuple(row[:2]))
+        # if row is not None and tuple(row[:2]) != (self.kid, new, )
+        if row is None and new == self.kid:
+            return 0
+        # if row is None and new == self.kid
+        if row is None:
+            last = 0
+            conn.execute('INSERT INTO %s_rekey (old, new, last) VALUES (?, ?, ?);' % \
+                         self.table, (self.kid, new, last, ))
+            self.commit()
         else:
-            ids = cur.execute('SELECT id from %s;' % self.table).fetchall()
-            if (id,)  not in ids:
-                return (self.CODES['NOT_FOUND'], 'No record found to update')
-            # if (id,)  not in ids
-
-            # name and/or site, password, description to be updated
-            if name:
-                targets.append('name=?')
-                values.append(name)
-            # if name
-            if site:
-                targets.append('site=?')
-                values.append(site)
-            # if site
-        # if not id
-
-        # Finalize data and update
-        targets.append('modified=?')
-        values.append(int(time.mktime(datetime.now().timetuple())))
-        cur.execute('UPDATE %s SET %s WHERE id=%d;' % \
-                    (self.table, ', '.join(targets), id),
-                    values)
-        conn.commit()
-        conn.close()
-        return (self.CODES['SUCCEED'], 'Update password succeeded')
-    # def update(self, id=None, name=None, site=None, pwd=None, desc=None)
+            last = row[2]
+        # else - if row is None
+
+        # Re-encrypt those by other keys chunk by chunk, in the order of ids.
+        # Sweep once more from the start for those changed meanwhile
+        batch_size = batch_size or self.SEARCH_BATCH
+        total = conn.execute('SELECT COUNT(*) FROM %s WHERE kid IS NOT ?;' % \
+                             self.table, (new, )).fetchone()[0]
+        cnt = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, pwd FROM %s WHERE id>? AND kid IS NOT ? ' \
+                'ORDER BY id LIMIT ?;' % self.table,
+                (last, new, batch_size, )).fetchall()
+            if not rows and last > 0:
+                last = 0
+                continue
+            elif not rows:
+                break
+            # elif not rows
+            last = rows[-1][0]
+            if self.fingerprints:   # keyed by the new key as well
+                encs = self.map_cipher('reencrypt_fingerprint_many',
+                                       [r[1] for r in rows], key)
+            else:
+                encs = [(enc, None, ) for enc in self.map_cipher(
+                    'reencrypt_many', [r[1] for r in rows], key)]
+            # else - if self.fingerprints
+            conn.executemany('UPDATE %s SET pwd=?, fp=?, kid=? WHERE id=?;' % \
+                             self.table, [(sqlite3.Binary(enc), fp, new, r[0], ) \
+                                          for r, (enc, fp) in zip(rows, encs)])
+            conn.execute('UPDATE %s_rekey SET last=?;' % self.table, (last, ))
+            self.commit()
+            cnt += len(rows)
+            if progress is not None:
+                progress(cnt, max(cnt, total))
+            # if progress is not None
+        # while True
+
+        # Done - switch to the new key
+        conn.execute('DELETE FROM %s_rekey;' % self.table)
+        self.commit()
+        self.key = key
+        self.cipher.key = key
+        self._kid = new
+        if self.cache is not None:
+            self.cache.clear()
+        # if self.cache is not None
+        return cnt
+    # def rekey(self, key, batch_size=None, progress=None)
+
+
+    def rekeying(self):
+        '''
+        Tell the re-key in progress, if any
+        @return {tuple}             (id of the old key, id of the new key), or
+                                    None if not re-keying
+        '''
+        row = self.connect().execute('SELECT old, new FROM %s_rekey;' % \
+                                     self.table).fetchone()
+        return None if row is None else tuple(row)
+    # def rekeying(self)
+
+
+    def check_rekeying(self, action):
+        '''
+        Refuse an action that reads all the passwords by the key of the
+        wallet, while a re-key is in progress - those by the other key would
+        be garbled
+        @param {str}    action      what is refused, for the message
+        '''
+        rekey = self.rekeying()
+        if rekey is not None:
+            raise RuntimeError('A re-key is in progress, from key %s to %s - ' \
+                               'run "shell.py rekey" to finish it before %s' % \
+                               (rekey + (action, )))
+        # if rekey is not None
+    # def check_rekeying(self, action)
+
+
+    def check_keys(self, records, rekey):
+        '''
+        Check that the records are all encrypted by the key of the wallet,
+        while a re-key is in progress - those re-keyed already are by the new
+        key, the others by the old one
+        @param {list}   records     the records, with "kid" read
+        @param {tuple}  rekey       (id of the old key, id of the new key)
+        '''
+        for record in records:
+            kid = rekey[0] if record['kid'] is None else record['kid']
+            if not kid == self.kid:
+                raise RuntimeError('A re-key is in progress, from key %s to ' \
+                                   '%s - run "shell.py rekey" with the old ' \
+                                   'key and the same new key to resume it' % \
+                                   rekey)
+            # if not kid == self.kid
+        # for record in records
+    # def check_keys(self, records, rekey)
+
+
+    def fingerprint(self, batch_size=None, progress=None):
+        '''
+        Create the index of keyed fingerprints of the passwords if not yet,
+        then fingerprint those without one, chunk by chunk - those saved by
+        earlier versions, or before the index was created. Once indexed, "add"
+        and "update" keep the fingerprints of the passwords they save. Refused
+        while a re-key is in progress
+        @param {int}        batch_size  number of records to fingerprint at once
+        @param {function}   progress    called as progress(done, total) after
+                                        each chunk, optional
+        @return {int}                   number of passwords fingerprinted
+        '''
+        self.check_rekeying('fingerprinting')
+        conn = self.connect()
+        conn.execute('CREATE INDEX IF NOT EXISTS %s_fp ON %s (fp);' % \
+                     (self.table, self.table))
+        self.fingerprints = True
+        self.commit()
+        batch_size = batch_size or self.SEARCH_BATCH
+        total = conn.execute('SELECT COUNT(*) FROM %s WHERE fp IS NULL;' % \
+                             self.table).fetchone()[0]
+        cnt = 0
+        last = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, pwd FROM %s WHERE id>? AND fp IS NULL ' \
+                'ORDER BY id LIMIT ?;' % self.table,
+                (last, batch_size, )).fetchall()
+            if not rows:
+                break
+            # if not rows
+            last = rows[-1][0]
+            fps = self.map_cipher('fingerprint_blobs', [r[1] for r in rows])
+            conn.executemany('UPDATE %s SET fp=? WHERE id=?;' % self.table,
+                             [(fp, r[0], ) for r, fp in zip(rows, fps)])
+            self.commit()
+            cnt += len(rows)
+            if progress is not None:
+                progress(cnt, max(cnt, total))
+            # if progress is not None
+        # while True
+        return cnt
+    # def fingerprint(self, batch_size=None, progress=None)
+
+
+    def fingerprint_counts(self, minimum=1):
+        '''
+        Count the records by fingerprint, by the index alone - refused while a
+        re-key is in progress, as the fingerprints are keyed by either key
+        @param {int}    minimum     least count of a fingerprint to report
+        @return {dict}              counts by fingerprint
+        '''
+        conn = self.connect()
+        if not self.fingerprints:
+            raise RuntimeError('No fingerprints of the passwords, run ' \
+                               '"fingerprint" first')
+        # if not self.fingerprints
+        self.check_rekeying('auditing')
+        return dict(conn.execute(
+            'SELECT fp, COUNT(*) FROM %s WHERE fp IS NOT NULL GROUP BY fp ' \
+            'HAVING COUNT(*)>=?;' % self.table, (minimum, )).fetchall())
+    # def fingerprint_counts(self, minimum=1)
+
+
+    def find_fingerprints(self, fps):
+        '''
+        Find the records of the passwords with any of the fingerprints
+        @param {list}   fps         the fingerprints
+        @return {dict}              lists of Records of "id", "name" and
+                                    "site", by fingerprint
+        '''
+        conn = self.connect()
+        if not self.fingerprints:
+            raise RuntimeError('No fingerprints of the passwords, run ' \
+                               '"fingerprint" first')
+        # if not self.fingerprints
+        fields = ('id', 'name', 'site', )
+        index = dict([(col, i) for i, col in enumerate(fields)])
+        groups = {}
+        fps = list(fps)
+        for i in range(0, len(fps), self.BATCH_SIZE):
+            batch = fps[i:i+self.BATCH_SIZE]
+            for row in conn.execute(
+                    'SELECT id, name, site, fp FROM %s WHERE fp IN (%s) ' \
+                    'ORDER BY id;' % (self.table, ', '.join(['?'] * len(batch))),
+                    batch):
+                groups.setdefault(row[3], []).append(Record(fields, index,
+                                                            row[:3]))
+            # for row in conn.execute( ... )
+        # for i in range(0, len(fps), self.BATCH_SIZE)
+        return groups
+    # def find_fingerprints(self, fps)
+
+
+    def find_reused(self):
+        '''
+        Find the passwords used by more than one record, by their fingerprints
+        alone - none of them is decrypted
+        @return {list}              groups of Records of "id", "name" and
+                                    "site" sharing a password, the largest
+                                    first
+        '''
+        return sort_groups(self.find_fingerprints(
+            self.fingerprint_counts(2).keys()))
+    # def find_reused(self)
+
+
+    def find_breached(self, digests, batch_size=None):
+        '''
+        Find the passwords in a list of breached ones, by fingerprinting their
+        SHA-1 digests as those of the wallet - none of them is decrypted
+        @param {iterable}   digests     SHA-1 digests of the breached
+                                        passwords, as hex
+        @param {int}        batch_size  number of digests to fingerprint at once
+        @return {list}                  groups of Records of "id", "name" and
+                                        "site" sharing a breached password, the
+                                        largest first
+        '''
+        return sort_groups(self.find_fingerprints(match_digests(
+            self.cipher, digests, self.fingerprint_counts(),
+            batch_size or self.SEARCH_BATCH)))
+    # def find_breached(self, digests, batch_size=None)
+
+
+    def backup(self, path):
+        '''
+        Export all the records, with passwords decrypted, to an encrypted file
+        in the streaming format - one JSON record per line
+        @param {str}    path    the path of the file
+        @return {int}           number of records exported
+        '''
+        return save_records(self.cipher, path, self.iter_search(show=True))
+    # def backup(self, path)
+
+
+    def restore(self, path, batch_size=None):
+        '''
+        Import the records from a file exported by "backup", batch by batch.
+        The whole file is authenticated first, so that nothing is added from
+        one that is damaged
+        @param {str}    path        the path of the file
+        @param {int}    batch_size  number of records to add at once
+        @return {list}              (status code in CODES, supplement message)
+                                    for each of the records, as in "add_many"
+        '''
+        return load_records(self.cipher, path, self.add_many,
+                            batch_size or self.SEARCH_BATCH)
+    # def restore(self, path, batch_size=None)
 
 
     def __str__(self):
@@ -379,6 +1832,7 @@ def main():
     for i, r in enumerate(records):
         print('%d/%d - %s' % (i+1, len(records), r))
     # for i, r in enumerate(records)
+    wallet.close()
 # def main()
 
 